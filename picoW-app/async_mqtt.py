@@ -0,0 +1,271 @@
+import struct
+import time
+import uasyncio as asyncio
+from micropython import const
+
+# MQTT 3.1.1 control packet types
+_CONNECT = const(0x10)
+_CONNACK = const(0x20)
+_PUBLISH = const(0x30)
+_PUBACK = const(0x40)
+_PINGREQ = const(0xC0)
+_PINGRESP = const(0xD0)
+_DISCONNECT = const(0xE0)
+
+_DUP_FLAG = const(0x08)
+
+_RECONNECT_MIN_MS = const(1000)
+_RECONNECT_MAX_MS = const(30000)
+
+
+class AsyncMQTTClient:
+    """MQTT client built on uasyncio streams.
+
+    Socket reads and writes never block the event loop, so a slow broker only
+    delays the task that is publishing. QoS 1 messages stay in an in-flight
+    window until their PUBACK arrives and are re-sent with the DUP flag when
+    the ack times out or after a reconnect. on_ack, if given, is called with
+    the ms between the last send of a message and its PUBACK.
+    """
+    def __init__(self, client_id, server, port=1883, user=None, password=None,
+                 keepalive=30, ssl=None, max_inflight=8, ack_timeout_ms=5000,
+                 on_state=None, on_ack=None):
+        self.client_id = client_id
+        self.server = server
+        self.port = port
+        self.user = user
+        self.password = password
+        self.keepalive = keepalive
+        self.ssl = ssl
+        self.max_inflight = max_inflight
+        self.ack_timeout_ms = ack_timeout_ms
+        self.on_state = on_state
+        self.on_ack = on_ack
+        self.reader = None
+        self.writer = None
+        self.connected = False
+        self.write_lock = asyncio.Lock()
+        self.connect_lock = asyncio.Lock()
+        self.window = asyncio.Event()
+        self.disconnected = asyncio.Event()
+        self.header = bytearray(7)
+        self.inflight = {}
+        self.next_pid = 1
+        self.last_rx_ms = 0
+        self.last_tx_ms = 0
+        self.tasks = []
+        self.reconnects = 0
+        self.retransmits = 0
+
+    def is_connected(self):
+        return self.connected
+
+    def _set_connected(self, connected):
+        self.connected = connected
+        if connected:
+            self.disconnected.clear()
+        else:
+            self.disconnected.set()
+        if self.on_state:
+            self.on_state(connected)
+
+    def _fixed_header(self, packet_type, length):
+        header = self.header
+        header[0] = packet_type
+        i = 1
+        while True:
+            byte = length & 0x7F
+            length >>= 7
+            header[i] = byte | 0x80 if length else byte
+            i += 1
+            if not length:
+                return memoryview(header)[:i]
+
+    @staticmethod
+    def _string(value):
+        if isinstance(value, str):
+            value = value.encode()
+        return struct.pack("!H", len(value)) + value
+
+    async def connect(self, clean_session=True):
+        """Open the TCP connection and do the MQTT handshake. Raises OSError on failure."""
+        async with self.connect_lock:
+            await self._connect(clean_session)
+
+    async def _connect(self, clean_session):
+        await self._close()
+        # Bounded, so a dead broker can't hold connect_lock forever
+        if self.ssl:
+            opening = asyncio.open_connection(self.server, self.port, ssl=self.ssl)
+        else:
+            opening = asyncio.open_connection(self.server, self.port)
+        self.reader, self.writer = await asyncio.wait_for_ms(opening, self.ack_timeout_ms)
+        flags = 0x02 if clean_session else 0
+        payload = self._string(self.client_id)
+        if self.user:
+            flags |= 0x80
+            payload += self._string(self.user)
+            if self.password:
+                flags |= 0x40
+                payload += self._string(self.password)
+        variable = b"\x00\x04MQTT\x04" + struct.pack("!BH", flags, self.keepalive)
+        self.writer.write(self._fixed_header(_CONNECT, len(variable) + len(payload)))
+        self.writer.write(variable)
+        self.writer.write(payload)
+        await self.writer.drain()
+        resp = await asyncio.wait_for_ms(self.reader.readexactly(4), self.ack_timeout_ms)
+        if resp[0] != _CONNACK or resp[3] != 0:
+            await self._close()
+            raise OSError("MQTT connection refused: %d" % resp[3])
+        self.last_rx_ms = self.last_tx_ms = time.ticks_ms()
+        self._set_connected(True)
+        self.tasks = [asyncio.create_task(self._read_loop()), asyncio.create_task(self._ping_loop())]
+        # Anything still unacknowledged from the previous session goes out
+        # again; _read_loop may remove acked pids while this yields
+        for pid in list(self.inflight):
+            message = self.inflight.get(pid)
+            if message:
+                await self._send_publish(pid, message, _DUP_FLAG)
+
+    async def _close(self):
+        current = asyncio.current_task()
+        for task in self.tasks:
+            if task is not current:
+                task.cancel()
+        self.tasks = []
+        if self.writer:
+            try:
+                self.writer.close()
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+        self.reader = self.writer = None
+        if self.connected:
+            self._set_connected(False)
+
+    async def disconnect(self):
+        if self.connected:
+            try:
+                await self._send(_DISCONNECT)
+            except OSError:
+                pass
+        await self._close()
+
+    async def _send(self, packet_type, *parts):
+        """Write one control packet. The lock keeps packets from concurrent tasks whole."""
+        if not self.connected:
+            raise OSError("MQTT not connected")
+        length = 0
+        for part in parts:
+            length += len(part)
+        try:
+            async with self.write_lock:
+                self.writer.write(self._fixed_header(packet_type, length))
+                for part in parts:
+                    self.writer.write(part)
+                await self.writer.drain()
+        except OSError:
+            await self._close()
+            raise
+        self.last_tx_ms = time.ticks_ms()
+
+    async def _send_publish(self, pid, message, flags=0):
+        topic, payload, qos, _ = message
+        message[3] = time.ticks_ms()
+        if qos:
+            await self._send(_PUBLISH | flags | (qos << 1), self._string(topic), struct.pack("!H", pid), payload)
+        else:
+            await self._send(_PUBLISH | flags, self._string(topic), payload)
+
+    async def publish(self, topic, payload, qos=0):
+        """Publish a message. Raises OSError if it couldn't be handed to the broker.
+
+        For QoS 1 this waits for room in the in-flight window, at most
+        ack_timeout_ms. The payload is copied, so the caller may reuse its buffer.
+        """
+        if qos == 0:
+            await self._send_publish(0, [topic, payload, 0, 0])
+            return
+        if not self.connected:
+            raise OSError("MQTT not connected")
+        while len(self.inflight) >= self.max_inflight:
+            self.window.clear()
+            try:
+                await asyncio.wait_for_ms(self.window.wait(), self.ack_timeout_ms)
+            except asyncio.TimeoutError:
+                raise OSError("MQTT in-flight window full")
+        pid = self.next_pid
+        self.next_pid = pid % 0xFFFF + 1
+        message = [topic, bytes(payload), qos, 0]
+        self.inflight[pid] = message
+        try:
+            await self._send_publish(pid, message)
+        except OSError:
+            # The message is in the window now and is re-sent after reconnect
+            pass
+
+    async def _read_loop(self):
+        try:
+            while True:
+                header = await self.reader.readexactly(1)
+                length = 0
+                shift = 0
+                while True:
+                    byte = (await self.reader.readexactly(1))[0]
+                    length |= (byte & 0x7F) << shift
+                    shift += 7
+                    if not byte & 0x80:
+                        break
+                body = await self.reader.readexactly(length) if length else b""
+                self.last_rx_ms = time.ticks_ms()
+                packet_type = header[0] & 0xF0
+                if packet_type == _PUBACK:
+                    pid = struct.unpack("!H", body)[0]
+                    message = self.inflight.pop(pid, None)
+                    if message is not None:
+                        self.window.set()
+                        if self.on_ack:
+                            self.on_ack(time.ticks_diff(self.last_rx_ms, message[3]))
+        except (OSError, EOFError):
+            pass
+        # Let the supervisor notice the dead link and reconnect
+        asyncio.create_task(self._close())
+
+    async def _ping_loop(self):
+        interval_ms = self.keepalive * 500
+        while True:
+            await asyncio.sleep_ms(min(interval_ms, self.ack_timeout_ms))
+            now = time.ticks_ms()
+            if time.ticks_diff(now, self.last_rx_ms) > self.keepalive * 1500:
+                print("MQTT keepalive timeout")
+                await self._close()
+                return
+            try:
+                if time.ticks_diff(now, self.last_tx_ms) >= interval_ms:
+                    await self._send(_PINGREQ)
+                for pid in list(self.inflight):
+                    message = self.inflight.get(pid)
+                    if message and time.ticks_diff(now, message[3]) > self.ack_timeout_ms:
+                        self.retransmits += 1
+                        await self._send_publish(pid, message, _DUP_FLAG)
+            except OSError:
+                return
+
+    async def keep_connected(self):
+        """Task that reconnects with exponential backoff whenever the link drops."""
+        delay = _RECONNECT_MIN_MS
+        while True:
+            if self.connected:
+                await self.disconnected.wait()
+                continue
+            await asyncio.sleep_ms(delay)
+            if self.connected:
+                continue
+            try:
+                await self.connect()
+                self.reconnects += 1
+                delay = _RECONNECT_MIN_MS
+                print("MQTT broker reconnected")
+            except (OSError, asyncio.TimeoutError, EOFError) as e:
+                delay = min(delay * 2, _RECONNECT_MAX_MS)
+                print(f"MQTT reconnect failed: {e}, retrying in {delay} ms")
@@ -0,0 +1,48 @@
+import json
+import aioble
+
+
+class BleAddressCache:
+    """Flash-backed map of Movesense serial to its last known BLE address.
+
+    Entries are saved as {serial: [addr_type, addr_hex, failures]}. An entry
+    whose direct connects failed max_failures times in a row is stale and
+    is no longer returned, so the caller falls back to scanning.
+    """
+    def __init__(self, path, max_failures):
+        self.path = path
+        self.max_failures = max_failures
+        try:
+            with open(path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def _save(self):
+        try:
+            with open(self.path, "w") as f:
+                json.dump(self.entries, f)
+        except OSError as e:
+            print(f"Can't save BLE address cache: {e}")
+
+    def get(self, ms_series):
+        """Return an aioble.Device for the cached address, or None if unknown or stale."""
+        entry = self.entries.get(ms_series)
+        if not entry or entry[2] >= self.max_failures:
+            return None
+        return aioble.Device(entry[0], bytes.fromhex(entry[1]))
+
+    def store(self, ms_series, device):
+        entry = [device.addr_type, bytes(device.addr).hex(), 0]
+        if self.entries.get(ms_series) != entry:
+            self.entries[ms_series] = entry
+            self._save()
+
+    def mark_failed(self, ms_series):
+        """Count a failed connect. Returns True if the entry just became stale."""
+        entry = self.entries.get(ms_series)
+        if not entry or entry[2] >= self.max_failures:
+            return False
+        entry[2] += 1
+        self._save()
+        return entry[2] >= self.max_failures
@@ -1,15 +1,30 @@
 import machine
-import usocket
 import time
-import ubinascii
-import uselect
-import os
 import uasyncio as asyncio
-import json
 
-from config import TX_PIN, RX_PIN, UART_BAUD_RATE
+from config import (TX_PIN, RX_PIN, UART_BAUD_RATE, RTCM_DROP_TYPES, NTRIP_DNS_TTL_S,
+                    TELEMETRY_ENABLED)
 from password import NTRIP_CONFIG
-from data_queue import state, gnss_queue
+from data_queue import gnss_queue
+from nmea_parser import NmeaParser, GGA, RMC, ZDA
+from time_sync import utc_clock
+from rtcm_relay import RtcmRelay
+from ntrip_client import NtripClient
+
+# UART bytes are read into one reused buffer and parsed in place
+_uart_buf = bytearray(256)
+_parser = NmeaParser()
+
+if TELEMETRY_ENABLED:
+    import telemetry
+    telemetry.gauge("nmea_sentences", lambda: _parser.sentences)
+    telemetry.gauge("nmea_checksum_errors", lambda: _parser.checksum_errors)
+
+
+def _sync_clock(parser, kind):
+    """Discipline the UTC clock with every sentence that carries a date."""
+    if kind == ZDA or (kind == RMC and parser.rmc_valid):
+        utc_clock.set_from_gnss(parser.year, parser.month, parser.day, parser.utc_ms)
 
 
 async def gnss_setup():
@@ -17,147 +32,89 @@ async def gnss_setup():
 
     # UART setup (GPIO 4 and 5 on Raspberry Pi Pico WH)
     rtk_uart = machine.UART(1, baudrate=UART_BAUD_RATE, tx=machine.Pin(TX_PIN), rx=machine.Pin(RX_PIN))
-    auth = ubinascii.b2a_base64(
-        f"{NTRIP_CONFIG['username_ntrip']}:{NTRIP_CONFIG['password_ntrip']}".encode()).decode().strip()
     gga = None
-    i = 0
-
-    # Waits for sensor to connect to satellites (valid GPGGA fix is =! 0)
-    while True:
-        if rtk_uart.any():
-            initial_GPGGA = rtk_uart.readline()
-            if initial_GPGGA.startswith(b"$GPGGA"):
-                try:
-                    gga_str = initial_GPGGA.decode().strip()
-                    fields = gga_str.split(',')
-                    fix_quality = fields[6]
-                    # Check fix > 0 + lat and lon != empty
-                    if fix_quality != '0' and fields[2] != '' and fields[4] != '':
-                        print("GNSS successfully connected")
-                        gga = gga_str
-                        break
-                    else:
-                        # print(f">> GGA {i} found but no coordinates:", gga_str)
-                        i += 1
-                except Exception:
-                    pass
-        await asyncio.sleep(0.5)
-
-    # NTRIP request
-    request = (
-        "GET /{} HTTP/1.1\r\n"
-        "Host: {}\r\n"
-        "Ntrip-Version: Ntrip/2.0\r\n"
-        "User-Agent: MicroPython NTRIP Client\r\n"
-        "Authorization: Basic {}\r\n"
-        "Ntrip-GGA: {}\r\n"
-        "\r\n"
-    ).format(NTRIP_CONFIG['mountpoint'], NTRIP_CONFIG['host'], auth, gga)
-
-    # Ping opencater
-    addr = usocket.getaddrinfo("opencaster.nls.fi", 2101)
-    ip_address = addr[0][-1][0]
-
-    # TCP connection to NTRIP caster
-    sock = usocket.socket()
-    # sock.connect((ip_address, NTRIP_CONFIG['port'])) # TO DO: Check IP functionality
-    sock.connect(("195.156.69.210", NTRIP_CONFIG['port']))
-    sock.send(request.encode())
-
-    while True:
-        line = sock.readline()
-        if not line or line == b'\r\n':
-            break
-    print("Connected to NTRIP caster")
-    return sock, rtk_uart, gga
 
+    # Waits for sensor to connect to satellites (valid GGA fix is != 0)
+    def on_sentence(parser, kind):
+        nonlocal gga
+        _sync_clock(parser, kind)
+        if kind == GGA and gga is None and parser.fix_quality and not parser.is_empty(2) and not parser.is_empty(4):
+            gga = bytes(parser.line()).decode().strip()
+
+    _parser.handler = on_sentence
+    while gga is None:
+        n = rtk_uart.readinto(_uart_buf) if rtk_uart.any() else 0
+        if n:
+            _parser.feed(_uart_buf, n)
+        else:
+            await asyncio.sleep(0.5)
+    print("GNSS successfully connected")
+
+    ntrip = NtripClient(NTRIP_CONFIG['host'], NTRIP_CONFIG['port'], NTRIP_CONFIG['mountpoint'],
+                        NTRIP_CONFIG['username_ntrip'], NTRIP_CONFIG['password_ntrip'],
+                        NTRIP_DNS_TTL_S * 1000)
+    ntrip.gga = gga.encode() + b"\r\n"
+    return ntrip, rtk_uart, gga
+
+
+async def read_gnss(rtk_uart, ntrip, picoW_id):
+    """Parse NMEA from the receiver, forward GGA to NTRIP every 1 sec and queue RTK positions."""
+    last_gga_ms = time.ticks_ms()
 
-def parse_gpgga(sentence):
-    field = sentence.split(',')
-    if field[0] != "$GPGGA":
-        return None
-    try:
-        fix_quality = int(field[6])
-        if fix_quality < 4:
-            return None
-        lat_raw = field[2]
-        lon_raw = field[4]
-        lat_dir = field[3]
-        lon_dir = field[5]
-        if not lat_raw or not lon_raw:
-            return None
-
-        lat_deg = int(lat_raw[:2])
-        lat_min = float(lat_raw[2:])
-        lat = lat_deg + (lat_min / 60)
-        if lat_dir == 'S':
-            lat = -lat
-
-        lon_deg = int(lon_raw[:3])
-        lon_min = float(lon_raw[3:])
-        lon = lon_deg + (lon_min / 60)
-        if lon_dir == 'W':
-            lon = -lon
-
-        return {
-            "lat": lat,
-            "lon": lon,
-            "fix_quality": fix_quality
+    def on_sentence(parser, kind):
+        nonlocal last_gga_ms
+        _sync_clock(parser, kind)
+        if kind != GGA:
+            return
+        # Send new coordinates to NTRIP every 1 sec
+        now = time.ticks_ms()
+        if time.ticks_diff(now, last_gga_ms) > 1000:
+            ntrip.send_gga(parser.line())
+            last_gga_ms = now
+
+        # Only RTK fixed/float solutions go to the queue
+        if parser.fix_quality < 4 or parser.is_empty(2) or parser.is_empty(4):
+            return
+        # The fix's own epoch time, not the time it was parsed
+        utc_ms = utc_clock.utc_from_ms_of_day(parser.utc_ms) if parser.utc_ms >= 0 else utc_clock.now_ms()
+        gnss_data = {
+            "Pico_ID": picoW_id,
+            "Date": utc_ms // 1000,
+            "Date_ms": utc_ms,
+            "Latitude": parser.lat_e7 / 1e7,
+            "Longitude": parser.lon_e7 / 1e7,
+            "Latitude_e7": parser.lat_e7,
+            "Longitude_e7": parser.lon_e7,
+            "Fix_quality": parser.fix_quality,
         }
-    except (ValueError, IndexError):
-        return None
-
-
-async def gnss_task(sock, rtk_uart, picoW_id):
-    poller = uselect.poll()
-    poller.register(sock, uselect.POLLIN)
-    last_gga_ms = time.ticks_ms()
-    # print("Polling")
+        print(f"GNSS data: {gnss_data}")
+        gnss_queue.enqueue(gnss_data)
 
-    # Receive RTK correction data
+    _parser.handler = on_sentence
+    uart_stream = asyncio.StreamReader(rtk_uart)
     while True:
-        events = poller.poll(10)
-        for fileno, event in events:
-            # print('Poll test 1')
-            if event & uselect.POLLIN:
-                try:
-                    rtk_data = sock.recv(512)
-                    if rtk_data:
-                        rtk_uart.write(rtk_data)
-                        # print("RTK data forwarded via UART')
-                    else:
-                        print("No RTK correction data")
-                        return
-                except OSError as e:
-                    print("Socket error:", e)
-                    return
-
-        # Send new coordinates to NTRIP every 1 sec
-        if rtk_uart.any():
-            rtk_line = rtk_uart.readline()
-            if rtk_line.startswith(b"$GPGGA"):
-                now = time.ticks_ms()
-                if time.ticks_diff(now, last_gga_ms) > 1000:
-                    try:
-                        sock.send(rtk_line)
-                        last_gga_ms = now
-                    except Exception as e:
-                        print("FAILED to send new coordinates:", e)
-
-                # Parse and send data to queue
-                try:
-                    rtk_str = rtk_line.decode()
-                    result = parse_gpgga(rtk_str)
-                    if result:
-                        gnss_data = {
-                            "Pico_ID": picoW_id,
-                            "Date": time.time(),
-                            "Latitude": result['lat'],
-                            "Longitude": result['lon'],
-                        }
-                        if gnss_data:
-                            print(f"GNSS data: {gnss_data}")
-                            gnss_queue.enqueue(gnss_data)
-                except Exception as e:
-                    print("Parsing or logging error:", e)
-        await asyncio.sleep_ms(50)
+        n = await uart_stream.readinto(_uart_buf)
+        if n:
+            _parser.feed(_uart_buf, n)
+
+
+async def gnss_task(ntrip, rtk_uart, picoW_id):
+    # Corrections and NMEA run in separate tasks so an RTCM burst is
+    # forwarded immediately instead of waiting behind UART reads
+    relay = RtcmRelay(rtk_uart, UART_BAUD_RATE, RTCM_DROP_TYPES, lambda: _parser.utc_ms)
+    if TELEMETRY_ENABLED:
+        framer = relay.framer
+        telemetry.gauge("rtcm_bytes", lambda: relay.bytes_in)
+        telemetry.gauge("rtcm_bytes_per_s", lambda: relay.bytes_per_s)
+        telemetry.gauge("rtcm_forwarded_bytes", lambda: relay.bytes_out)
+        telemetry.gauge("rtcm_uart_load_pct", lambda: relay.uart_load_pct)
+        telemetry.gauge("rtcm_crc_errors", lambda: framer.crc_errors)
+        telemetry.gauge("rtcm_filtered", lambda: framer.filtered)
+        telemetry.gauge("rtcm_congested", lambda: int(relay.congested))
+        telemetry.gauge("rtcm_congestions", lambda: relay.congestions)
+        telemetry.gauge("ntrip_reconnects", lambda: ntrip.reconnects)
+    reader = asyncio.create_task(read_gnss(rtk_uart, ntrip, picoW_id))
+    try:
+        await ntrip.run(relay)
+    finally:
+        reader.cancel()
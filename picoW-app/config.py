@@ -11,4 +11,140 @@ LED3 = 20
 # UART Pin
 TX_PIN = 4
 RX_PIN = 5
-UART_BAUD_RATE = 115200
\ No newline at end of file
+UART_BAUD_RATE = 115200
+
+# Movesense sensors known to this gateway. The list index is the device id
+# carried in binary MQTT frames, so only append to keep ids stable.
+MOVESENSE_SERIES_LIST = ["174630000192", "213230000105"]
+
+# MQTT payload format per stream: "json" or "binary" (see payload_codec.py)
+PAYLOAD_FORMAT = {
+    "imu": "binary",
+    "ecg": "binary",
+    "hr": "json",
+    "gnss": "json",
+    "features": "json",  # JSON only
+}
+
+# IMU samples are kept and sent as int16 instead of float32 (imu_quant.py),
+# halving IMU frames and sample pool memory. IMU_FULL_SCALE is the range of
+# each sensor as configured on the Movesense, in its units: acc m/s^2
+# (16 g), gyro dps, magn uT; larger values saturate
+IMU_QUANTIZE = False
+IMU_FULL_SCALE = {"acc": 156.9, "gyro": 2000.0, "magn": 4900.0}
+
+# What is published of the IMU stream: "raw" sends every sample; "summary"
+# sends only activity features (imu_features.py), one JSON record per
+# sensor every FEATURE_WINDOW_MS on sensors/imu_features; "hybrid" sends the
+# features plus raw IMU averaged over IMU_DECIMATION samples. The features
+# are computed on int16 samples, so summary and hybrid quantize the IMU
+# stream as IMU_QUANTIZE does
+IMU_STREAM_MODE = "raw"
+FEATURE_WINDOW_MS = 1000
+IMU_DECIMATION = 4
+# A peak is the acceleration magnitude rising more than PEAK_THRESHOLD
+# (m/s^2) above 1 g; it ends when it falls back below half that. Peaks
+# closer than STEP_MIN_INTERVAL_MS (240 steps/min) aren't counted as steps.
+# Activity counts integrate the magnitude's distance from 1 g beyond
+# ACTIVITY_DEADBAND (m/s^2), in mg*s
+PEAK_THRESHOLD = 2.5
+STEP_MIN_INTERVAL_MS = 250
+ACTIVITY_DEADBAND = 0.5
+
+# Binary ECG bodies are delta coded (ecg_codec.py): lossless, about one
+# byte per sample instead of four. A new chain starts every
+# ECG_KEY_INTERVAL blocks, so a decoder recovers from a lost frame within
+# that many blocks
+ECG_COMPRESSION = True
+ECG_KEY_INTERVAL = 8
+
+# MQTT client: QoS for sensor data, QoS 1 messages awaiting PUBACK at once,
+# and keepalive in seconds
+MQTT_QOS = 1
+MQTT_MAX_INFLIGHT = 8
+MQTT_KEEPALIVE_S = 30
+
+# MQTT batching: a topic's batch is published once it holds
+# MQTT_BATCH_MAX_BYTES or its oldest record is MQTT_BATCH_MAX_AGE_MS old
+MQTT_BATCH_MAX_BYTES = 1024
+MQTT_BATCH_MAX_AGE_MS = 500
+
+# Store-and-forward spool on flash, used while the broker is unreachable or
+# a queue fills past SPOOL_QUEUE_WATERMARK (fraction of its capacity)
+SPOOL_DIR = "/spool"
+SPOOL_SEGMENT_BYTES = 16384
+SPOOL_MAX_BYTES = 262144
+SPOOL_QUEUE_WATERMARK = 0.75
+# Pause between replayed spool records so live data keeps priority
+SPOOL_REPLAY_INTERVAL_MS = 50
+
+# BLE address cache: a cached address is dropped for a rescan after
+# BLE_CACHE_MAX_FAILURES failed direct connects in a row
+BLE_CACHE_PATH = "/ble_cache.json"
+BLE_CACHE_MAX_FAILURES = 2
+
+# RTCM 3 message types not forwarded to the GNSS receiver, to save UART
+# bandwidth, e.g. (1230,) if the receiver doesn't use GLONASS biases
+RTCM_DROP_TYPES = ()
+
+# While the corrections take RTCM_CONGESTED_PCT of the UART's bandwidth or
+# more, these message types are dropped as well, until the load falls back
+# under RTCM_CLEAR_PCT: antenna and receiver descriptors, system parameters
+# and text, none of which the RTK fix depends on
+RTCM_CONGESTION_DROP_TYPES = (1007, 1008, 1013, 1029, 1033)
+RTCM_CONGESTED_PCT = 90
+RTCM_CLEAR_PCT = 75
+
+# NTRIP caster address lookups are cached this long
+NTRIP_DNS_TTL_S = 3600
+
+# Pipeline telemetry (telemetry.py): counters and histograms published as a
+# JSON summary on sensors/metrics every TELEMETRY_INTERVAL_MS. False skips
+# loading the module and every measurement
+TELEMETRY_ENABLED = True
+TELEMETRY_INTERVAL_MS = 30000
+
+# Heap management (mem_manager.py). gc.threshold is the automatic
+# collection trigger; normally the publisher collects first, in the idle
+# gap after it drained the queues, once GC_IDLE_BYTES were allocated or
+# GC_MAX_INTERVAL_MS passed. Free heap after a collection below
+# MEM_LOW_BYTES is low pressure until it is back above MEM_LOW_BYTES +
+# MEM_HYSTERESIS_BYTES, which holds rate_control.py's step ups; below
+# MEM_CRITICAL_BYTES rate_control.py lowers the sensor rates, or
+# mem_manager.py itself with RATE_CONTROL_ENABLED off
+GC_THRESHOLD_BYTES = 24576
+GC_IDLE_BYTES = 8192
+GC_MAX_INTERVAL_MS = 2000
+MEM_CHECK_INTERVAL_MS = 10000
+MEM_LOW_BYTES = 24576
+MEM_CRITICAL_BYTES = 12288
+MEM_HYSTERESIS_BYTES = 8192
+
+# Publish scheduling (publish_scheduler.py). Every round, streams are served
+# in priority order (0 first), each up to weight * PUBLISH_QUANTUM_BYTES of
+# encoded records. Records queued longer than deadline_ms are still sent
+# ("keep"), moved to the spool ("spool") or discarded ("drop"), so under
+# congestion raw IMU degrades before ECG, position and heart rate
+PUBLISH_QUANTUM_BYTES = 256
+PUBLISH_SCHEDULE = {
+    "gnss": {"priority": 0, "weight": 4, "deadline_ms": 5000, "drop": "keep"},
+    "hr": {"priority": 1, "weight": 4, "deadline_ms": 5000, "drop": "keep"},
+    "ecg": {"priority": 2, "weight": 2, "deadline_ms": 3000, "drop": "spool"},
+    "imu": {"priority": 3, "weight": 1, "deadline_ms": 2000, "drop": "drop"},
+    "features": {"priority": 1, "weight": 1, "deadline_ms": 5000, "drop": "keep"},
+}
+
+# Adaptive sample rates (rate_control.py), checked every
+# RATE_CHECK_INTERVAL_MS. The rates set in movesense_controller.py are the
+# ceilings. One step down the rate ladder (IMU first) when an IMU/ECG queue
+# is RATE_HIGH_FILL_PCT full, records were dropped or expired, latency
+# passed RATE_HIGH_LATENCY_PCT of the stream deadline or the heap is
+# critical. One step up (ECG first) after RATE_UP_CHECKS calm checks in a
+# row; a step up that has to be undone doubles that, up to RATE_UP_CHECKS_MAX
+RATE_CONTROL_ENABLED = True
+RATE_CHECK_INTERVAL_MS = 5000
+RATE_HIGH_FILL_PCT = 50
+RATE_LOW_FILL_PCT = 10
+RATE_HIGH_LATENCY_PCT = 80
+RATE_UP_CHECKS = 6
+RATE_UP_CHECKS_MAX = 48
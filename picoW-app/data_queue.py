@@ -1,3 +1,10 @@
+import time
+import uasyncio as asyncio
+from array import array
+from sample_block import BlockPool, release_record
+from config import TELEMETRY_ENABLED
+from imu_quant import QUANTIZED
+
 class MachineState:
     running_state = False
     network_connection_state = False
@@ -7,33 +14,137 @@ class MachineState:
     def change_state(self):
         MachineState.running_state = not MachineState.running_state
 
+DROP_OLDEST = 0
+DROP_NEWEST = 1
+
 class Queue:
-    """Queue to handle data"""
-    def __init__(self, max_len):
-        self.queue_list = []
+    """Fixed-size ring buffer of records, allocated once.
+
+    A full queue applies its policy: DROP_OLDEST overwrites the oldest record,
+    DROP_NEWEST rejects the new one. Either way the drop is counted and the
+    record handed to on_drop for recycling. Each push stamps the record with
+    ticks_ms() and sets signal to wake a consumer. The first push also sets
+    first_push_ms and the started event.
+    """
+    def __init__(self, max_len, policy=DROP_OLDEST, on_drop=None, signal=None):
+        self.slots = [None] * max_len
+        self.stamps = array("i", [0] * max_len)
         self.max_len = max_len
+        self.policy = policy
+        self.on_drop = on_drop
+        self.signal = signal
+        self.head = 0
+        self.length = 0
+        self.drops = 0
+        self.high_water = 0
+        self.first_push_ms = None
+        self.started = asyncio.Event()
+
+    def push(self, value):
+        """Add a record. Returns False if a record had to be dropped."""
+        if self.signal:
+            self.signal.set()
+        if self.first_push_ms is None:
+            self.first_push_ms = time.ticks_ms()
+            self.started.set()
+        accepted = True
+        if self.length >= self.max_len:
+            self.drops += 1
+            accepted = False
+            if self.policy == DROP_NEWEST:
+                if self.on_drop:
+                    self.on_drop(value)
+                return False
+            dropped = self.pop()
+            if self.on_drop:
+                self.on_drop(dropped)
+        tail = (self.head + self.length) % self.max_len
+        self.slots[tail] = value
+        self.stamps[tail] = time.ticks_ms()
+        self.length += 1
+        if self.length > self.high_water:
+            self.high_water = self.length
+        return accepted
+
+    def age_ms(self, now_ms):
+        """Time the oldest record has been queued, or 0 if the queue is empty."""
+        if self.length == 0:
+            return 0
+        return time.ticks_diff(now_ms, self.stamps[self.head])
+
+    def oldest_ms(self):
+        """ticks_ms() at which the oldest record was pushed."""
+        return self.stamps[self.head]
+
+    def pop(self):
+        if self.length == 0:
+            return None
+        value = self.slots[self.head]
+        self.slots[self.head] = None
+        self.head = (self.head + 1) % self.max_len
+        self.length -= 1
+        return value
 
-    def enqueue(self, value):
-        self.queue_list.append(value)
-        if len(self.queue_list) > self.max_len:
-            print("Queue got overloaded, data is removed from queue. Extend queue size to avoid this")
-            self.queue_list.pop(0)
+    def drain(self, n):
+        """Pop up to n records, oldest first."""
+        n = min(n, self.length)
+        return [self.pop() for _ in range(n)]
 
-    def dequeue(self):
-        if len(self.queue_list) != 0:
-            return self.queue_list.pop(0)
-        return None
+    def take_high_water(self):
+        """High-water mark since the last call, restarting from the current depth."""
+        high_water = self.high_water
+        self.high_water = self.length
+        return high_water
+
+    def clear(self):
+        while self.length:
+            record = self.pop()
+            if self.on_drop:
+                self.on_drop(record)
+
+    # Original Queue interface
+    enqueue = push
+    dequeue = pop
 
     def get_length(self):
-        return len(self.queue_list)
+        return self.length
 
     def is_empty(self):
-        return len(self.queue_list) == 0
+        return self.length == 0
+
+async def wait_signal(flag, timeout_ms):
+    """Wait until flag is set or timeout_ms passes. Returns True if it was set."""
+    try:
+        await asyncio.wait_for_ms(flag.wait(), timeout_ms)
+        return True
+    except asyncio.TimeoutError:
+        return False
 
 QUEUE_SIZE = 50
 
-ecg_queue = Queue(QUEUE_SIZE*2)
-imu_queue = Queue(QUEUE_SIZE*2)
-hr_queue = Queue(QUEUE_SIZE)
-gnss_queue = Queue(QUEUE_SIZE)
-state = MachineState()
\ No newline at end of file
+# Set on every enqueue, waited on by the MQTT publisher
+data_ready = asyncio.ThreadSafeFlag()
+# Set by the button IRQ handler to wake the Movesense and network tasks
+movesense_wakeup = asyncio.ThreadSafeFlag()
+network_wakeup = asyncio.ThreadSafeFlag()
+
+# Sample blocks for IMU/ECG notifications: one per queue slot plus a few in flight
+imu_pool = BlockPool(QUEUE_SIZE*2 + 4, "h" if QUANTIZED else "f")
+ecg_pool = BlockPool(QUEUE_SIZE*2 + 4, "i")
+
+ecg_queue = Queue(QUEUE_SIZE*2, on_drop=release_record, signal=data_ready)
+imu_queue = Queue(QUEUE_SIZE*2, on_drop=release_record, signal=data_ready)
+hr_queue = Queue(QUEUE_SIZE, signal=data_ready)
+gnss_queue = Queue(QUEUE_SIZE, signal=data_ready)
+# IMU feature records of the summary and hybrid modes (imu_features.py)
+features_queue = Queue(QUEUE_SIZE, signal=data_ready)
+state = MachineState()
+
+if TELEMETRY_ENABLED:
+    import telemetry
+    for _name, _queue in (("imu", imu_queue), ("ecg", ecg_queue), ("hr", hr_queue), ("gnss", gnss_queue),
+                          ("features", features_queue)):
+        telemetry.gauge(f"queue_{_name}_high_water", _queue.take_high_water)
+        telemetry.gauge(f"queue_{_name}_drops", lambda queue=_queue: queue.drops)
+    telemetry.gauge("pool_imu_misses", lambda: imu_pool.misses)
+    telemetry.gauge("pool_ecg_misses", lambda: ecg_pool.misses)
\ No newline at end of file
@@ -0,0 +1,85 @@
+import micropython
+from micropython import const
+
+# Compressed ECG body (frame flag FLAG_ECG_DELTA), little-endian:
+#   count u16 | key u16 | chain u8 | count zig-zag varints
+# Every sample is stored as its difference to the previous sample of the
+# same sensor, carried across notifications. chain 0 is a key block whose
+# first difference is taken from 0, i.e. the absolute sample; blocks
+# chain 1, 2, ... continue from the block before. key numbers the chains,
+# so a decoder can follow a chain replayed from the spool next to the live
+# one; the publisher keeps separate encoders with disjoint keys for the
+# two (KEY_BASE_SPOOL). python_client/decode_frames.py has the decoder.
+ECG_DELTA_HEADER_SIZE = const(5)
+# Keys count in the low 15 bits, the top bit tells the encoders apart
+KEY_BASE_LIVE = const(0)
+KEY_BASE_SPOOL = const(0x8000)
+_KEY_MASK = const(0x7FFF)
+# Worst case varint length of a difference of two int32 samples
+MAX_VARINT_SIZE = const(5)
+
+
+@micropython.native
+def encode_deltas(values, count, prev, out, offset):
+    """Write zig-zag varint differences of values[:count], starting from prev.
+
+    Returns the offset after the last byte written. Typical ECG differences
+    are below 64 and take a single byte instead of four.
+    """
+    for i in range(count):
+        v = values[i]
+        d = v - prev
+        prev = v
+        z = d << 1 if d >= 0 else ((-d) << 1) - 1
+        while z > 0x7F:
+            out[offset] = (z & 0x7F) | 0x80
+            z >>= 7
+            offset += 1
+        out[offset] = z
+        offset += 1
+    return offset
+
+
+class EcgDeltaEncoder:
+    """Per-sensor chain state of the compressed ECG stream.
+
+    A new chain, starting with a key block, begins every key_interval
+    blocks, so a decoder that missed a frame (or joined late) resyncs
+    within key_interval blocks. Chains only decode if their blocks arrive
+    in order, so the caller restart()s them when blocks end up on a
+    different path than the ones before.
+    """
+    def __init__(self, key_interval, key_base=KEY_BASE_LIVE):
+        self.key_interval = key_interval
+        self.key_base = key_base
+        # device -> [key, chain position of the next block, last sample]
+        self.chains = {}
+        self.key_blocks = 0
+
+    def restart(self):
+        """Start every sensor's next block with a new key."""
+        for state in self.chains.values():
+            state[1] = self.key_interval
+
+    def encode(self, device, values, count, out, offset):
+        """Write a compressed body for values[:count] at out[offset:]. Returns the body length."""
+        state = self.chains.get(device)
+        if state is None:
+            state = self.chains[device] = [self.key_base, 0, 0]
+        elif state[1] >= self.key_interval:
+            state[0] = self.key_base | ((state[0] + 1) & _KEY_MASK)
+            state[1] = 0
+        chain = state[1]
+        if chain == 0:
+            self.key_blocks += 1
+        prev = state[2] if chain else 0
+        out[offset] = count & 0xFF
+        out[offset + 1] = count >> 8
+        out[offset + 2] = state[0] & 0xFF
+        out[offset + 3] = state[0] >> 8
+        out[offset + 4] = chain
+        end = encode_deltas(values, count, prev, out, offset + ECG_DELTA_HEADER_SIZE)
+        if count:
+            state[2] = values[count - 1]
+        state[1] = chain + 1
+        return end - offset
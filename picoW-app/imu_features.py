@@ -0,0 +1,295 @@
+import math
+import micropython
+from array import array
+from micropython import const
+
+from config import FEATURE_WINDOW_MS, PEAK_THRESHOLD, STEP_MIN_INTERVAL_MS, ACTIVITY_DEADBAND
+from imu_quant import SCALES
+from sample_block import IMU_AXES
+
+# IMU stream modes (config.IMU_STREAM_MODE)
+RAW = "raw"          # every sample, no features
+SUMMARY = "summary"  # features only
+HYBRID = "hybrid"    # features plus decimated samples
+
+STANDARD_GRAVITY = 9.80665
+
+# int16 samples are shifted right by _SHIFT before squaring, so that the
+# sums of a notification (at most 25 samples) stay small ints and never
+# allocate: 0.077 m/s^2 and 1 dps resolution at the default ranges
+_SHIFT = const(4)
+
+# FeatureWindow.state: last acc sample, peak detector and step spacing
+# carried between notifications, then the sums of the latest notification
+_LAST_X = const(0)
+_LAST_Y = const(1)
+_LAST_Z = const(2)
+_HAVE_LAST = const(3)
+_ABOVE = const(4)
+_SINCE_STEP = const(5)
+_STEP_GAP = const(6)
+_ACC_SQ = const(7)
+_GYRO_SQ = const(8)
+_JERK_SQ = const(9)
+_ACTIVITY = const(10)
+_PEAKS = const(11)
+_STEPS = const(12)
+_STATE_SIZE = const(13)
+
+# _accumulate parameters, in shifted acc LSBs
+_PEAK_HIGH_SQ = const(0)
+_PEAK_LOW_SQ = const(1)
+_G_SQ = const(2)
+_TWO_G = const(3)
+_DEADBAND = const(4)
+
+_SINCE_STEP_MAX = const(0x10000)
+
+# Physical units of one shifted LSB
+_ACC_LSB = SCALES[0] * (1 << _SHIFT)
+_GYRO_LSB = SCALES[1] * (1 << _SHIFT)
+
+
+def _lsb(value):
+    return int(value / _ACC_LSB + 0.5)
+
+
+_PARAMS = array("i", [
+    _lsb(STANDARD_GRAVITY + PEAK_THRESHOLD) ** 2,
+    _lsb(STANDARD_GRAVITY + PEAK_THRESHOLD / 2) ** 2,
+    _lsb(STANDARD_GRAVITY) ** 2,
+    2 * _lsb(STANDARD_GRAVITY),
+    _lsb(ACTIVITY_DEADBAND),
+])
+
+
+@micropython.native
+def _accumulate(values, count, sensors, state, params):
+    """Add one int16 IMU block to the running sums in state.
+
+    Magnitudes stay squared, so no sample needs a square root or a float:
+    | |a| - g | is taken as | |a|^2 - g^2 | / 2g, exact enough near 1 g.
+    """
+    high = params[_PEAK_HIGH_SQ]
+    low = params[_PEAK_LOW_SQ]
+    g_sq = params[_G_SQ]
+    two_g = params[_TWO_G]
+    deadband = params[_DEADBAND]
+    gap = state[_STEP_GAP]
+    lx = state[_LAST_X]
+    ly = state[_LAST_Y]
+    lz = state[_LAST_Z]
+    have_last = state[_HAVE_LAST]
+    above = state[_ABOVE]
+    since = state[_SINCE_STEP]
+    acc_sq = 0
+    gyro_sq = 0
+    jerk_sq = 0
+    activity = 0
+    peaks = 0
+    steps = 0
+    gyro = count * IMU_AXES
+    for i in range(0, count * IMU_AXES, IMU_AXES):
+        x = values[i] >> _SHIFT
+        y = values[i + 1] >> _SHIFT
+        z = values[i + 2] >> _SHIFT
+        m = x * x + y * y + z * z
+        acc_sq += m
+        if have_last:
+            dx = x - lx
+            dy = y - ly
+            dz = z - lz
+            jerk_sq += (dx * dx + dy * dy + dz * dz) >> 2
+        have_last = 1
+        lx = x
+        ly = y
+        lz = z
+        dev = m - g_sq
+        if dev < 0:
+            dev = -dev
+        dev = dev // two_g
+        if dev > deadband:
+            activity += dev - deadband
+        if since < _SINCE_STEP_MAX:
+            since += 1
+        if above:
+            if m < low:
+                above = 0
+        elif m > high:
+            above = 1
+            peaks += 1
+            if since >= gap:
+                steps += 1
+                since = 0
+        if sensors > 1:
+            j = gyro + i
+            x = values[j] >> _SHIFT
+            y = values[j + 1] >> _SHIFT
+            z = values[j + 2] >> _SHIFT
+            gyro_sq += x * x + y * y + z * z
+    state[_LAST_X] = lx
+    state[_LAST_Y] = ly
+    state[_LAST_Z] = lz
+    state[_HAVE_LAST] = have_last
+    state[_ABOVE] = above
+    state[_SINCE_STEP] = since
+    state[_ACC_SQ] = acc_sq
+    state[_GYRO_SQ] = gyro_sq
+    state[_JERK_SQ] = jerk_sq
+    state[_ACTIVITY] = activity
+    state[_PEAKS] = peaks
+    state[_STEPS] = steps
+
+
+class FeatureWindow:
+    """Activity features of one sensor's IMU stream over FEATURE_WINDOW_MS.
+
+    Every int16 block is folded into a fixed set of sums, so memory doesn't
+    grow with the window or the sample rate. When a block starts past the
+    window, add() returns the finished window as a record of RMS
+    acceleration and rotation magnitude, RMS jerk, peak and step counts,
+    cadence and activity counts, and a new window starts with that block.
+    Windows follow the sensor's own timestamps; a gap or restart in them
+    discards the window in progress.
+    """
+    def __init__(self, ms_series, picoW_id):
+        self.ms_series = ms_series
+        self.picoW_id = picoW_id
+        self.state = array("i", [0] * _STATE_SIZE)
+        self.period_ms = 0.0
+        self.last_ts = None
+        self.last_count = 0
+        self.windows = 0
+        self._start(None)
+
+    def _start(self, block):
+        self.samples = 0
+        self.gyro_samples = 0
+        self.acc_sq = 0.0
+        self.gyro_sq = 0.0
+        self.jerk_sq = 0.0
+        self.activity = 0.0
+        self.peaks = 0
+        self.steps = 0
+        self.start_ts = block.timestamp_ms if block else None
+        self.start_utc_ms = block.timestamp_utc_ms if block else 0
+        state = self.state
+        state[_HAVE_LAST] = 0
+        if self.period_ms:
+            state[_STEP_GAP] = int(STEP_MIN_INTERVAL_MS / self.period_ms)
+
+    def add(self, block):
+        """Fold an int16 IMU block into the window. Returns the finished window's record or None."""
+        ts = block.timestamp_ms
+        record = None
+        if self.last_ts is not None:
+            elapsed = ts - self.last_ts
+            if elapsed <= 0 or elapsed > FEATURE_WINDOW_MS:
+                self._start(block)
+            elif self.last_count:
+                self.period_ms = elapsed / self.last_count
+        if self.start_ts is None:
+            self._start(block)
+        elif ts - self.start_ts >= FEATURE_WINDOW_MS:
+            record = self.record(ts)
+            self._start(block)
+        self.last_ts = ts
+        self.last_count = block.count
+        state = self.state
+        _accumulate(block.values, block.count, block.sensors, state, _PARAMS)
+        self.samples += block.count
+        if block.sensors > 1:
+            self.gyro_samples += block.count
+        self.acc_sq += state[_ACC_SQ]
+        self.gyro_sq += state[_GYRO_SQ]
+        self.jerk_sq += state[_JERK_SQ]
+        self.activity += state[_ACTIVITY]
+        self.peaks += state[_PEAKS]
+        self.steps += state[_STEPS]
+        return record
+
+    def record(self, end_ts):
+        """The features of the window from start_ts up to end_ts."""
+        window_ms = end_ts - self.start_ts
+        n = self.samples
+        period_s = self.period_ms / 1000
+        jerk = 0.0
+        if n > 1 and period_s:
+            jerk = math.sqrt(4 * self.jerk_sq / (n - 1)) * _ACC_LSB / period_s
+        self.windows += 1
+        return {
+            "Movesense_series": self.ms_series,
+            "Pico_ID": self.picoW_id,
+            "Timestamp_UTC": self.start_utc_ms // 1000,
+            "Timestamp_UTC_ms": self.start_utc_ms,
+            "Timestamp_ms": self.start_ts,
+            "Window_ms": window_ms,
+            "Sample_count": n,
+            "Acc_rms": round(math.sqrt(self.acc_sq / n) * _ACC_LSB, 3) if n else 0.0,
+            "Gyro_rms": round(math.sqrt(self.gyro_sq / self.gyro_samples) * _GYRO_LSB, 3)
+            if self.gyro_samples else 0.0,
+            "Jerk_rms": round(jerk, 1),
+            "Peaks": self.peaks,
+            "Steps": self.steps,
+            "Cadence_spm": round(self.steps * 60000 / window_ms, 1) if window_ms else 0.0,
+            "Activity_counts": int(self.activity * _ACC_LSB * 1000 / STANDARD_GRAVITY * period_s),
+        }
+
+
+@micropython.native
+def _decimate(values, count, sensors, factor, sums):
+    """Average groups of factor samples of an int16 IMU block in place.
+
+    sums carries each axis's partial group, and its last item the group's
+    length, into the next block. Returns the samples per sensor left.
+    """
+    start = sums[9]
+    out_count = (start + count) // factor
+    n3 = count * IMU_AXES
+    m3 = out_count * IMU_AXES
+    filled = start
+    for s in range(sensors):
+        # Sensor by sensor, every write lands at or below the sample just read
+        filled = start
+        src = s * n3
+        dst = s * m3
+        k = s * IMU_AXES
+        sx = sums[k]
+        sy = sums[k + 1]
+        sz = sums[k + 2]
+        for _ in range(count):
+            sx += values[src]
+            sy += values[src + 1]
+            sz += values[src + 2]
+            src += IMU_AXES
+            filled += 1
+            if filled == factor:
+                values[dst] = sx // factor
+                values[dst + 1] = sy // factor
+                values[dst + 2] = sz // factor
+                dst += IMU_AXES
+                sx = 0
+                sy = 0
+                sz = 0
+                filled = 0
+        sums[k] = sx
+        sums[k + 1] = sy
+        sums[k + 2] = sz
+    sums[9] = filled
+    return out_count
+
+
+class Decimator:
+    """Reduce one sensor's int16 IMU blocks to every factor-th sample, box filtered.
+
+    Averaging rather than picking samples keeps motion above the new
+    Nyquist rate from folding into the decimated stream.
+    """
+    def __init__(self, factor):
+        self.factor = factor
+        self.sums = array("i", [0] * 10)
+
+    def apply(self, block):
+        """Decimate a block in place. Returns False if no sample is left in it."""
+        block.count = _decimate(block.values, block.count, block.sensors, self.factor, self.sums)
+        return block.count > 0
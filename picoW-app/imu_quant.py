@@ -0,0 +1,38 @@
+import micropython
+from micropython import const
+
+from config import IMU_FULL_SCALE, IMU_QUANTIZE, IMU_STREAM_MODE
+
+# int16 IMU samples (frame flag FLAG_IMU_INT16): value = q * scale, with
+# one scale per sensor in acc, gyro, magn order
+_Q_MAX = const(32767)
+
+SENSOR_NAMES = ("acc", "gyro", "magn")
+# Physical units per LSB, sent in the frame body
+SCALES = tuple(IMU_FULL_SCALE[name] / _Q_MAX for name in SENSOR_NAMES)
+# LSBs per physical unit, used on the Pico
+_FACTORS = tuple(_Q_MAX / IMU_FULL_SCALE[name] for name in SENSOR_NAMES)
+
+# The feature stage of the summary and hybrid modes works on int16 samples
+QUANTIZED = IMU_QUANTIZE or IMU_STREAM_MODE != "raw"
+
+
+@micropython.native
+def _quantize(samples, values, start, end, factor):
+    for i in range(start, end):
+        x = samples[i] * factor
+        # Round half away from zero and saturate at the configured range
+        q = int(x + 0.5) if x >= 0 else int(x - 0.5)
+        if q > _Q_MAX:
+            q = _Q_MAX
+        elif q < -_Q_MAX:
+            q = -_Q_MAX
+        values[i] = q
+
+
+def quantize_into(samples, values, count, sensors):
+    """Store count float samples, sensors blocks of xyz triplets, as int16 in values."""
+    per_sensor = count // sensors
+    for sensor in range(sensors):
+        start = sensor * per_sensor
+        _quantize(samples, values, start, start + per_sensor, _FACTORS[sensor])
@@ -2,14 +2,17 @@ import uasyncio as asyncio
 import machine
 import time
 
-from config import (SW_0_PIN, SW_1_PIN, SW_2_PIN, LED1, LED2, LED3)
+from config import (SW_0_PIN, SW_1_PIN, SW_2_PIN, LED1, LED2, LED3, TELEMETRY_ENABLED,
+                    RATE_CONTROL_ENABLED)
 
 from wifi_connection import connect_wifi
-from data_queue import state
+from data_queue import state, movesense_wakeup, network_wakeup
 from movesense_controller import movesense_task, blink_task, movesense_tasks
 from led import Led
-from mqtt import connect_mqtt, publish_to_mqtt
-from bynav_GNSS import gnss_setup, gnss_task
+from mqtt import connect_mqtt, create_mqtt_client, publish_to_mqtt, replay_spool, publish_metrics
+from startup import bring_up_network, bring_up_gnss, report_first_samples
+from mem_manager import memory
+from rate_control import control_rates
 
 led1 = Led(LED1)
 led2 = Led(LED2)
@@ -29,11 +32,14 @@ def button_handler(pin):
     if time.ticks_diff(current_time, last_pressed_btn) > DEBOUNCE_MS:
         if pin == button1:
             state.running_state = not state.running_state
+            movesense_wakeup.set()
         # print(f"Button pressed. Running state {state.running_state}")
         elif pin == button2:
             state.trigger_connecting_network = True
+            network_wakeup.set()
         elif pin == button0:
             state.trigger_ble_scan = True
+            movesense_wakeup.set()
         last_pressed_btn = current_time
 
 async def running_state_on_led():
@@ -61,27 +67,37 @@ def read_picoW_unique_id():
     return picoW_id
 
 async def reconnect_network():
-    """Check and reconnect to the network if triggered."""
+    """Reconnect to the network when sw_2 triggers it."""
     while True:
+        await network_wakeup.wait()
         if state.trigger_connecting_network:
             await connect_wifi()
             mqtt_client = await connect_mqtt()
             state.trigger_connecting_network = False
-        await asyncio.sleep_ms(100)
 
 
 async def main():
     try:
         picoW_id = read_picoW_unique_id()
         print(f"PicoW ID is {picoW_id}")
-        await connect_wifi()
-        sock, rtk_uart, gga = await gnss_setup()
-        mqtt_client = await connect_mqtt()
+        # Every subsystem comes up on its own: BLE data flows while Wi-Fi
+        # connects and is spooled until MQTT is ready, and NTRIP attaches
+        # whenever the first GNSS fix arrives
+        memory.setup()
+        mqtt_client = create_mqtt_client()
+        if TELEMETRY_ENABLED:
+            asyncio.create_task(publish_metrics(mqtt_client, picoW_id))
+        if RATE_CONTROL_ENABLED:
+            asyncio.create_task(control_rates())
         await asyncio.gather(
-            movesense_task(picoW_id),
-            # movesense_tasks(picoW_id),
-            gnss_task(sock, rtk_uart, picoW_id),
+            bring_up_network(),
+            # movesense_task(picoW_id),
+            movesense_tasks(picoW_id),
+            bring_up_gnss(picoW_id),
+            report_first_samples(),
             publish_to_mqtt(mqtt_client),
+            replay_spool(mqtt_client),
+            memory.run(),
             # blink_task(),
             running_state_on_led(),
             network_status_led(),
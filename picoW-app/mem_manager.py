@@ -0,0 +1,155 @@
+import gc
+import micropython
+import time
+import uasyncio as asyncio
+from micropython import const
+
+import movesense_controller
+from config import (GC_THRESHOLD_BYTES, GC_IDLE_BYTES, GC_MAX_INTERVAL_MS, MEM_CHECK_INTERVAL_MS,
+                    MEM_LOW_BYTES, MEM_CRITICAL_BYTES, MEM_HYSTERESIS_BYTES, TELEMETRY_ENABLED,
+                    RATE_CONTROL_ENABLED)
+
+NORMAL = 0
+LOW = 1
+CRITICAL = 2
+_LEVEL_NAMES = ("normal", "low", "critical")
+
+# Without rate_control, critical memory steps the rates down to these at most
+_MIN_IMU_RATE = const(26)
+_MIN_ECG_RATE = const(125)
+
+
+def _rate_below(rates, rate, minimum):
+    """The next supported rate below rate, but not below minimum."""
+    lower = rate
+    for candidate in rates:
+        if minimum <= candidate < rate:
+            lower = candidate
+    return lower
+
+
+class MemoryManager:
+    """Keep GC pauses short and predictable and react to a shrinking heap.
+
+    A collection's pause grows with the heap, not with the garbage, so the
+    aim is to collect where a pause does no harm rather than less often.
+    idle() is called by the publisher when it has drained every queue,
+    which is the gap between BLE connection events. It collects once
+    GC_IDLE_BYTES were allocated or GC_MAX_INTERVAL_MS passed, well before
+    gc.threshold would force a collection in the middle of a notification
+    burst.
+
+    run() rates the heap every MEM_CHECK_INTERVAL_MS by the free memory
+    after the latest collection, collecting itself only if idle() hasn't
+    within that interval. Queues and sample pools are preallocated, so
+    there is nothing to shrink; the level holds back rate_control's step
+    ups when LOW and makes it step the sensor rates down when CRITICAL.
+    With RATE_CONTROL_ENABLED off, run() itself lowers the rates a rung per
+    critical check and restores them once the heap is back to NORMAL.
+    Level changes are logged with micropython.mem_info(), whose largest
+    free block shows fragmentation without probe allocations.
+    """
+    def __init__(self):
+        self.level = NORMAL
+        self.collections = 0
+        self.last_pause_us = 0
+        self.max_pause_us = 0
+        self.last_collect_ms = time.ticks_ms()
+        self.alloc_after_gc = 0
+        self.free_after_gc = 0
+        self.min_free_after_gc = None
+        self.used_pct = 0
+        self.base_rates = None
+        self.on_pause = None
+
+    def setup(self):
+        """Set the automatic collection threshold, starting from a clean heap."""
+        self.collect()
+        gc.threshold(GC_THRESHOLD_BYTES)
+
+    def collect(self):
+        start = time.ticks_us()
+        gc.collect()
+        pause = time.ticks_diff(time.ticks_us(), start)
+        self.collections += 1
+        self.last_pause_us = pause
+        if pause > self.max_pause_us:
+            self.max_pause_us = pause
+        if self.on_pause:
+            self.on_pause(pause)
+        self.last_collect_ms = time.ticks_ms()
+        self.alloc_after_gc = gc.mem_alloc()
+        self.free_after_gc = gc.mem_free()
+        if self.min_free_after_gc is None or self.free_after_gc < self.min_free_after_gc:
+            self.min_free_after_gc = self.free_after_gc
+        self.used_pct = self.alloc_after_gc * 100 // (self.alloc_after_gc + self.free_after_gc)
+
+    def idle(self):
+        """Collect now if enough was allocated since the last collection."""
+        allocated = gc.mem_alloc() - self.alloc_after_gc
+        if allocated >= GC_IDLE_BYTES or (
+                allocated > 0 and time.ticks_diff(time.ticks_ms(), self.last_collect_ms) >= GC_MAX_INTERVAL_MS):
+            self.collect()
+
+    def check(self):
+        """Return the pressure level by the free heap after the latest collection."""
+        if time.ticks_diff(time.ticks_ms(), self.last_collect_ms) >= MEM_CHECK_INTERVAL_MS:
+            self.collect()
+        free = self.free_after_gc
+        if free < MEM_CRITICAL_BYTES:
+            return CRITICAL
+        if free < MEM_LOW_BYTES:
+            return max(self.level, LOW)
+        if free >= MEM_LOW_BYTES + MEM_HYSTERESIS_BYTES:
+            return NORMAL
+        return self.level
+
+    def log(self, msg):
+        print(f"Memory: {msg}, {self.free_after_gc} B free after GC ({self.used_pct}% used), "
+              f"max GC pause {self.max_pause_us} us")
+        micropython.mem_info()
+
+    async def _lower_rates(self):
+        imu_rate = movesense_controller.IMU_RATE
+        ecg_rate = movesense_controller.ECG_RATE
+        new_imu_rate = _rate_below(movesense_controller.IMU_RATES, imu_rate, _MIN_IMU_RATE)
+        new_ecg_rate = _rate_below(movesense_controller.ECG_RATES, ecg_rate, _MIN_ECG_RATE)
+        if (new_imu_rate, new_ecg_rate) == (imu_rate, ecg_rate):
+            return
+        if self.base_rates is None:
+            self.base_rates = (imu_rate, ecg_rate)
+        self.log(f"lowering IMU to {new_imu_rate} Hz and ECG to {new_ecg_rate} Hz")
+        await movesense_controller.set_rates(new_imu_rate, new_ecg_rate)
+
+    async def _restore_rates(self):
+        imu_rate, ecg_rate = self.base_rates
+        self.base_rates = None
+        self.log(f"restoring IMU {imu_rate} Hz and ECG {ecg_rate} Hz")
+        await movesense_controller.set_rates(imu_rate, ecg_rate)
+
+    async def run(self):
+        """Task: rate the heap periodically, and without rate_control adjust the sensor rates."""
+        while True:
+            await asyncio.sleep_ms(MEM_CHECK_INTERVAL_MS)
+            level = self.check()
+            if level != self.level:
+                self.log(f"pressure {_LEVEL_NAMES[level]}")
+            self.level = level
+            if RATE_CONTROL_ENABLED:
+                continue
+            if level == CRITICAL:
+                await self._lower_rates()
+            elif level == NORMAL and self.base_rates is not None:
+                await self._restore_rates()
+
+
+memory = MemoryManager()
+
+if TELEMETRY_ENABLED:
+    import telemetry
+    memory.on_pause = telemetry.histogram("gc_pause_us").add
+    telemetry.gauge("mem_level", lambda: memory.level)
+    telemetry.gauge("gc_collections", lambda: memory.collections)
+    telemetry.gauge("mem_free_after_gc", lambda: memory.free_after_gc)
+    telemetry.gauge("mem_min_free_after_gc", lambda: memory.min_free_after_gc)
+    telemetry.gauge("mem_used_pct", lambda: memory.used_pct)
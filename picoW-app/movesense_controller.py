@@ -2,41 +2,68 @@ import aioble
 import uasyncio as asyncio
 import machine
 from movesense_device import MovesenseDevice
-from data_queue import state
+from data_queue import state, movesense_wakeup
+from config import MOVESENSE_SERIES_LIST, BLE_CACHE_PATH, BLE_CACHE_MAX_FAILURES
+from ble_cache import BleAddressCache
 
 # Movesense series ID
 _MOVESENSE_SERIES = "174630000192"
 # _MOVESENSE_SERIES_2 = "213230000105"
-_MOVESENSE_SERIES_LIST = ["174630000192", "213230000105"]
+_MOVESENSE_SERIES_LIST = MOVESENSE_SERIES_LIST
 
 # Sensor Data Rate
 IMU_RATE = 26   #Sample rate can be 13, 26, 52, 104, 208, 416, 833, 1666
 ECG_RATE = 125  #Sample rate can be 125, 128, 200, 250, 256, 500, 512
 
+# Sample rates the Movesense firmware accepts, lowest first
+IMU_RATES = (13, 26, 52, 104, 208, 416, 833, 1666)
+ECG_RATES = (125, 128, 200, 250, 256, 500, 512)
+
 # Onboard LED
 led = machine.Pin("LED", machine.Pin.OUT)
 
 SCAN_DURATION_MS = 10000
 
-async def find_movesense(ms_series):
-    print(f"Scanning BLE to find Movesense sensors {ms_series} ...")
+# Known sensor addresses, tried with a direct connect before scanning
+ble_cache = BleAddressCache(BLE_CACHE_PATH, BLE_CACHE_MAX_FAILURES)
+
+async def scan_movesense(serials):
+    """Scan once for every serial in serials. Returns {serial: device} of the ones found.
+
+    The scan ends as soon as all serials are found. Matching runs on the raw
+    advertising and scan response payloads, so names are never decoded.
+    """
+    pending = {("Movesense " + ms_series).encode(): ms_series for ms_series in serials}
+    found = {}
+    print(f"Scanning BLE to find Movesense sensors {', '.join(serials)} ...")
     async with aioble.scan(duration_ms=SCAN_DURATION_MS, interval_us=30000, window_us=30000, active=True) as scanner:
         async for result in scanner:
-            if result.name() == f"Movesense {ms_series}":
-                print("Found Movesense sensor:", result.device)
-                state.movesense_detect = True
-                return result.device
-    print(f"Movesense series {ms_series} not found")
-    state.movesense_detect = False
-    return None
+            for needle in pending:
+                if (result.adv_data and needle in result.adv_data) or (result.resp_data and needle in result.resp_data):
+                    ms_series = pending.pop(needle)
+                    print(f"Found Movesense sensor {ms_series}:", result.device)
+                    found[ms_series] = result.device
+                    break
+            if not pending:
+                break
+    for ms_series in pending.values():
+        print(f"Movesense series {ms_series} not found")
+    return found
+
+async def find_movesense(ms_series):
+    device = (await scan_movesense([ms_series])).get(ms_series)
+    state.movesense_detect = device is not None
+    return device
 
 
 async def movesense_task(pico_id, movesense_series=_MOVESENSE_SERIES):
-    device = await find_movesense(movesense_series)
+    device = ble_cache.get(movesense_series) or await find_movesense(movesense_series)
+    state.movesense_detect = device is not None
     if not device:
         print(f"Can't find any movesense device {device}")
     connected = False
     ms = MovesenseDevice(movesense_series, pico_id)
+    delay = _RECONNECT_MIN_MS
     while True:
         if state.trigger_ble_scan:
             print("Rescanning BLE to find Movesense sensor")
@@ -46,74 +73,181 @@ async def movesense_task(pico_id, movesense_series=_MOVESENSE_SERIES):
         if state.movesense_detect and state.running_state and not connected:
             if not device:
                 print(f"Can't find Movesense device {device} to connect to PicoW. No Movesense data will be recorded")
-            else:
-                await ms.connect_ble(device)
+            elif await ms.connect_ble(device):
+                ble_cache.store(movesense_series, device)
                 await ms.subscribe_sensor("IMU9", IMU_RATE)
                 await ms.subscribe_sensor("HR")
                 await ms.subscribe_sensor("ECG", ECG_RATE)
                 connected = True
+                delay = _RECONNECT_MIN_MS
+            else:
+                ble_cache.mark_failed(movesense_series)
+                device = ble_cache.get(movesense_series) or await find_movesense(movesense_series)
+                if device:
+                    # Found again, retry the connection instead of waiting for a
+                    # button press, backing off like supervise_movesense
+                    print(f"Connecting movesense {movesense_series} failed, retrying in {delay} ms")
+                    await asyncio.sleep_ms(delay)
+                    delay = min(delay * 2, _RECONNECT_MAX_MS)
+                    continue
         elif not state.running_state and connected:
             print(f"Unsubscribing and disconnecting movesense {movesense_series}")
             await ms.disconnect_ble()
             connected = False
         if connected:
             await ms.process_notification()
+            if state.running_state:
+                # Link dropped while running, don't spin on a dead connection
+                await asyncio.sleep_ms(100)
         else:
-            await asyncio.sleep_ms(100)
-        await asyncio.sleep_ms(100)
+            # Nothing to do until a button press changes the state
+            await movesense_wakeup.wait()
+
+class DeviceHealth:
+    """Lifecycle state and counters of one supervised Movesense sensor."""
+    IDLE = "idle"
+    SCANNING = "scanning"
+    CONNECTING = "connecting"
+    STREAMING = "streaming"
+    BACKOFF = "backoff"
+
+    def __init__(self):
+        self.state = DeviceHealth.IDLE
+        self.connects = 0
+        self.failures = 0
+        self.link_drops = 0
+        self.last_error = None
+
+# Health of every sensor in _MOVESENSE_SERIES_LIST, keyed by series
+device_health = {}
+# MovesenseDevice of every supervised sensor, keyed by series
+_devices = {}
+
+_RECONNECT_MIN_MS = 1000
+_RECONNECT_MAX_MS = 30000
+# Rescan for a sensor after this many failed connects in a row
+_RESCAN_AFTER_FAILURES = 3
+
+_scan_lock = asyncio.Lock()
+_control_event = asyncio.Event()
+
+def device_refs(index):
+    """Reference ids (imu, hr, ecg) for the sensor at index, unique per sensor."""
+    imu_ref = 99 - 3 * index
+    return imu_ref, imu_ref - 1, imu_ref - 2
+
+async def _scan_for(serials, devices):
+    async with _scan_lock:
+        devices.update(await scan_movesense(serials))
+    state.movesense_detect = bool(devices)
+
+async def _subscribe_all(ms):
+    await ms.subscribe_sensor("IMU9", IMU_RATE)
+    await ms.subscribe_sensor("HR")
+    await ms.subscribe_sensor("ECG", ECG_RATE)
+
+async def set_rates(imu_rate, ecg_rate):
+    """Change the IMU and ECG sample rates, resubscribing every streaming sensor."""
+    global IMU_RATE, ECG_RATE
+    imu_changed = imu_rate != IMU_RATE
+    ecg_changed = ecg_rate != ECG_RATE
+    IMU_RATE = imu_rate
+    ECG_RATE = ecg_rate
+    for ms_series, ms in _devices.items():
+        if device_health[ms_series].state != DeviceHealth.STREAMING:
+            continue
+        try:
+            if imu_changed:
+                await ms.resubscribe(ms.imu_sensor, imu_rate)
+            if ecg_changed:
+                await ms.resubscribe("ECG", ecg_rate)
+        except Exception as e:
+            device_health[ms_series].last_error = str(e)
+
+async def supervise_movesense(index, ms_series, pico_id, devices):
+    """Connect/subscribe/receive/reconnect lifecycle of one sensor.
+
+    Each sensor runs in its own task, so a slow connect or a dropout only
+    affects that sensor. Failed connects back off exponentially and trigger
+    a rescan after _RESCAN_AFTER_FAILURES attempts, or right away when the
+    cached address has gone stale.
+    """
+    ms = _devices[ms_series] = MovesenseDevice(ms_series, pico_id, *device_refs(index))
+    health = device_health[ms_series] = DeviceHealth()
+    delay = _RECONNECT_MIN_MS
+    while True:
+        device = devices.get(ms_series)
+        if not state.running_state or device is None:
+            health.state = DeviceHealth.IDLE
+            await _control_event.wait()
+            continue
+
+        health.state = DeviceHealth.CONNECTING
+        try:
+            connected = await ms.connect_ble(device)
+            if connected:
+                await _subscribe_all(ms)
+        except Exception as e:
+            health.last_error = str(e)
+            connected = False
+
+        if not connected:
+            health.failures += 1
+            try:
+                await ms.disconnect_ble()
+            except Exception as e:
+                health.last_error = str(e)
+            if ble_cache.mark_failed(ms_series) or health.failures % _RESCAN_AFTER_FAILURES == 0:
+                health.state = DeviceHealth.SCANNING
+                await _scan_for([ms_series], devices)
+            else:
+                health.state = DeviceHealth.BACKOFF
+                ms.log(f"Connect failed ({health.failures}), retrying in {delay} ms")
+                await asyncio.sleep_ms(delay)
+                delay = min(delay * 2, _RECONNECT_MAX_MS)
+            continue
+
+        ble_cache.store(ms_series, device)
+        health.connects += 1
+        health.state = DeviceHealth.STREAMING
+        delay = _RECONNECT_MIN_MS
+        try:
+            await ms.process_notification()
+        except Exception as e:
+            health.last_error = str(e)
+        if state.running_state:
+            health.link_drops += 1
+            ms.log("Connection lost, reconnecting")
+        else:
+            ms.log("Unsubscribing and disconnecting")
+        try:
+            await ms.disconnect_ble()
+        except Exception as e:
+            health.last_error = str(e)
 
 async def movesense_tasks(pico_id):
+    """Run one supervisor task per sensor and forward button events to them."""
     devices = {}
-    connections = {}
-    connected = False
     for ms_series in _MOVESENSE_SERIES_LIST:
-        print(f"Scanning for Movesense sensor {ms_series}...")
-        device = await find_movesense(ms_series)
+        device = ble_cache.get(ms_series)
         if device:
             devices[ms_series] = device
-            print(f"Found Movesense sensor {ms_series}.")
-        else:
-            print(f"Failed to find Movesense sensor {ms_series}.")  
+    missing = [ms_series for ms_series in _MOVESENSE_SERIES_LIST if ms_series not in devices]
+    if missing:
+        await _scan_for(missing, devices)
+    state.movesense_detect = bool(devices)
+    for index, ms_series in enumerate(_MOVESENSE_SERIES_LIST):
+        asyncio.create_task(supervise_movesense(index, ms_series, pico_id, devices))
 
     while True:
+        await movesense_wakeup.wait()
         if state.trigger_ble_scan:
-            for ms_series in _MOVESENSE_SERIES_LIST:
-                print(f"Scanning for Movesense sensor {ms_series}...")
-                device = await find_movesense(ms_series)
-                if device:
-                    devices[ms_series] = device
-                    print(f"Found Movesense sensor {ms_series}.")
-                else:
-                    print(f"Failed to find Movesense sensor {ms_series}.")  
+            await _scan_for(_MOVESENSE_SERIES_LIST, devices)
             state.trigger_ble_scan = False
-        if state.movesense_detect and state.running_state and not connected:
-            if devices:
-                for ms_series, device in devices.items():
-                    try:
-                        print(f"Connecting to Movesense sensor {ms_series}...")
-                        ms = MovesenseDevice(ms_series, pico_id)
-                        await ms.connect_ble(device)
-                        await ms.subscribe_sensor("IMU9", IMU_RATE)
-                        await ms.subscribe_sensor("HR")
-                        await ms.subscribe_sensor("ECG", ECG_RATE)
-                        connections[ms_series] = ms
-                        print(f"Connected and subscribed to Movesense sensor {ms_series}.")
-                    except Exception as e:
-                        print(f"Error connecting to or subscribing to Movesense sensor {ms_series}: {e}")
-            connected = True
-        elif not state.running_state and connected:
-            for ms_series, ms in connections.items():
-                print(f"Unsubscribing and disconnecting movesense {ms_series}")
-                await ms.disconnect_ble()
-            connected = False
-        if connected:
-            for ms_series, ms in connections.items():
-                await asyncio.gather(*(ms.process_notification() for ms in connections.values()))
-                await asyncio.sleep_ms(200)
-        else:
-            await asyncio.sleep_ms(100)
-        await asyncio.sleep_ms(100)
-            
+        # Wake every idle supervisor to re-check running state and devices
+        _control_event.set()
+        _control_event.clear()
+
 async def blink_task():
     while True:
         led.value(not led.value())
@@ -2,10 +2,23 @@ import time
 import bluetooth
 import uasyncio as asyncio
 from micropython import const
-from struct import unpack
+from struct import unpack, unpack_from
 import machine  
 import json
-from data_queue import ecg_queue, imu_queue, hr_queue, state
+from data_queue import ecg_queue, imu_queue, hr_queue, features_queue, state, imu_pool, ecg_pool
+from sample_block import MAX_SAMPLE_VALUES
+from time_sync import SensorClock, utc_clock
+from config import TELEMETRY_ENABLED, IMU_STREAM_MODE, IMU_DECIMATION
+from imu_quant import quantize_into, QUANTIZED
+from imu_features import FeatureWindow, Decimator, RAW, SUMMARY, HYBRID
+
+if TELEMETRY_ENABLED:
+    import telemetry
+    _notify_imu = telemetry.counter("notify_imu")
+    _notify_ecg = telemetry.counter("notify_ecg")
+    _notify_hr = telemetry.counter("notify_hr")
+    _decode_imu_us = telemetry.histogram("decode_imu_us")
+    _decode_ecg_us = telemetry.histogram("decode_ecg_us")
 
 
 # GSP Service and Characteristic UUIDs
@@ -18,6 +31,65 @@ _CMD_HELLO = const(0)
 _CMD_SUBSCRIBE = const(1)
 _CMD_UNSUBSCRIBE = const(2)
 
+# Notification packet types (Responses in GATTSensorDataClient.cpp)
+_PACKET_COMMAND_RESULT = const(1)
+_PACKET_DATA = const(2)
+_PACKET_DATA_PART2 = const(3)
+
+# The firmware sends at most 150 payload bytes in a DATA packet and the
+# rest in a DATA_PART2 packet of up to 156 payload bytes
+_DATA_PART1_SIZE = const(152)
+_MAX_NOTIFICATION_SIZE = const(308)
+
+# Notification header: packet type, reference, uint32 timestamp
+_HEADER_SIZE = const(6)
+
+# unpack_from formats for every possible sample count, built once
+_FLOAT_FORMATS = ["<%df" % n for n in range(MAX_SAMPLE_VALUES + 1)]
+_INT_FORMATS = ["<%di" % n for n in range(MAX_SAMPLE_VALUES + 1)]
+
+
+class NotificationAssembler:
+    """Join DATA and DATA_PART2 notifications split by the firmware.
+
+    A full sized DATA packet is held in a per-reference buffer until its
+    DATA_PART2 arrives. A new DATA packet while one is held means the second
+    part was lost, and a DATA_PART2 with nothing held arrived out of order;
+    both are counted and the incomplete data is dropped.
+    """
+    def __init__(self, refs):
+        self.buffers = {ref: bytearray(_MAX_NOTIFICATION_SIZE) for ref in refs}
+        self.held = {ref: 0 for ref in refs}
+        self.lost_parts = 0
+        self.orphan_parts = 0
+
+    def feed(self, data):
+        """Return a complete data notification, or None if there's nothing to process yet."""
+        packet_type = data[0]
+        ref = data[1]
+        buf = self.buffers.get(ref)
+        if buf is None or packet_type == _PACKET_COMMAND_RESULT:
+            return None
+        if packet_type == _PACKET_DATA:
+            if self.held[ref]:
+                self.lost_parts += 1
+                self.held[ref] = 0
+            if len(data) == _DATA_PART1_SIZE:
+                buf[:_DATA_PART1_SIZE] = data
+                self.held[ref] = _DATA_PART1_SIZE
+                return None
+            return data
+        if packet_type == _PACKET_DATA_PART2:
+            held = self.held[ref]
+            self.held[ref] = 0
+            size = held + len(data) - 2
+            if not held or size > _MAX_NOTIFICATION_SIZE:
+                self.orphan_parts += 1
+                return None
+            buf[held:size] = memoryview(data)[2:]
+            return memoryview(buf)[:size]
+        return None
+
 
 class MovesenseDevice:
     BYTES_PER_ELEMENT = 4
@@ -32,17 +104,30 @@ class MovesenseDevice:
         self.sensor_service = None
         self.write_char = None
         self.notify_char = None
+        self.assembler = NotificationAssembler((imu_ref, hr_ref, ecg_ref))
+        self.clock = SensorClock()
+        self.features = FeatureWindow(self.ms_series, self.picoW_id) if IMU_STREAM_MODE != RAW else None
+        self.decimator = Decimator(IMU_DECIMATION) if IMU_STREAM_MODE == HYBRID else None
+        if TELEMETRY_ENABLED:
+            assembler = self.assembler
+            telemetry.gauge(f"ble_{self.ms_series}_lost_parts", lambda: assembler.lost_parts)
+            telemetry.gauge(f"ble_{self.ms_series}_orphan_parts", lambda: assembler.orphan_parts)
 
     def log(self, msg):
         print(f"[Movesense {self.ms_series}]: {msg}")
 
     async def connect_ble(self, device):
+        """Connect and enable notifications. Returns True on success."""
+        # Characteristics of an earlier connection are stale
+        self.sensor_service = None
+        self.notify_char = None
+        self.write_char = None
         try:
             self.log(f"Connecting to BLE device {device}...")
             self.connection = await device.connect(timeout_ms=10000)
         except asyncio.TimeoutError:
             self.log("Connection timeout")
-            return
+            return False
         self.log("Connected")
 
         try:
@@ -51,13 +136,14 @@ class MovesenseDevice:
             self.write_char = await self.sensor_service.characteristic(_GSP_WRITE_UUID)
         except asyncio.TimeoutError:
             self.log("Timeout discovering services/characteristics")
-            return
+            return False
 
         if not self.sensor_service or not self.write_char or not self.notify_char:
             self.log("Required service/characteristics not found")
-            return
+            return False
 
         await self.notify_char.subscribe(notify=True)
+        return True
 
     async def subscribe_sensor(self, sensor_type, sensor_rate=None):
         if sensor_type == "IMU9":
@@ -77,65 +163,97 @@ class MovesenseDevice:
         self.log(f"Subscribing to {sensor_type} with command: {cmd.hex()}")
         await self.write_char.write(cmd)
 
+    async def resubscribe(self, sensor_type, sensor_rate):
+        """Move a running IMU or ECG subscription to a new sample rate."""
+        ref = self.ecg_ref if sensor_type == "ECG" else self.imu_ref
+        await self.write_char.write(bytearray([_CMD_UNSUBSCRIBE, ref]))
+        await self.subscribe_sensor(sensor_type, sensor_rate)
+
     async def process_notification(self):
         self.log("Waiting for notifications...")
 
         while state.running_state and self.connection.is_connected():
             try:
                 data = await self.notify_char.notified(timeout_ms=300)
+                if data:
+                    data = self.assembler.feed(data)
                 if data:
                     ref_code = data[1]
                     if ref_code == self.imu_ref:
-                        self._process_imu_data(data)
+                        if TELEMETRY_ENABLED:
+                            start = time.ticks_us()
+                            self._process_imu_data(data)
+                            _decode_imu_us.add(time.ticks_diff(time.ticks_us(), start))
+                            _notify_imu.add()
+                        else:
+                            self._process_imu_data(data)
                     elif ref_code == self.ecg_ref:
-                        self._process_ecg_data(data)
+                        if TELEMETRY_ENABLED:
+                            start = time.ticks_us()
+                            self._process_ecg_data(data)
+                            _decode_ecg_us.add(time.ticks_diff(time.ticks_us(), start))
+                            _notify_ecg.add()
+                        else:
+                            self._process_ecg_data(data)
                     elif ref_code == self.hr_ref:
                         self._process_hr_data(data)
+                        if TELEMETRY_ENABLED:
+                            _notify_hr.add()
                     else:
                         self.log("Unknown data received")
             except asyncio.TimeoutError:
                 continue
 
+    def _fill_block(self, pool, formats, data, sensors, quantize=False):
+        """Decode a notification into a pooled SampleBlock, or None if the pool is empty.
+
+        With quantize, the float samples are stored as int16 (see imu_quant.py).
+        """
+        block = pool.acquire()
+        if block is None:
+            return None
+        mv = memoryview(data)
+        count = min((len(data) - _HEADER_SIZE) // MovesenseDevice.BYTES_PER_ELEMENT, MAX_SAMPLE_VALUES)
+        values = block.values
+        if quantize:
+            quantize_into(unpack_from(formats[count], mv, _HEADER_SIZE), values, count, sensors)
+        else:
+            i = 0
+            for v in unpack_from(formats[count], mv, _HEADER_SIZE):
+                values[i] = v
+                i += 1
+        block.timestamp_ms = unpack_from("<I", mv, 2)[0]
+        block.timestamp_utc_ms = self.clock.to_utc_ms(block.timestamp_ms)
+        block.ms_series = self.ms_series
+        block.picoW_id = self.picoW_id
+        block.sensors = sensors
+        block.count = count // (3 * sensors) if sensors else count
+        return block
+
     def _process_imu_data(self, data):
         sensor_count = 3 if self.imu_sensor == "IMU9" else 2
-        sample_count = len(data[6:]) // MovesenseDevice.BYTES_PER_ELEMENT
-        unpacked_data = list(unpack(f'<BBI{sample_count}f', data))
-        timestamp = unpacked_data[2]
-        sensordata = [round(v, 3) for v in unpacked_data[3:]]
-        sensordata = list(zip(sensordata[::3], sensordata[1::3], sensordata[2::3]))
-        samples_per_sensor = len(sensordata) // sensor_count
-        json_data = {
-            "Movesense_series": self.ms_series,
-            "Pico_ID": self.picoW_id,
-            "Timestamp_UTC": time.time(),
-            "Timestamp_ms": timestamp,
-            "ArrayAcc": [],
-            "ArrayGyro": [],
-            "ArrayMagn": []
-        }
-        for i in range(samples_per_sensor):
-            if self.imu_sensor in ["IMU6", "IMU9"]:
-                acc = sensordata[i]
-                acc_dict = {"x": acc[0], "y": acc[1], "z": acc[2]}
-                gyro = sensordata[i + samples_per_sensor]
-                gyro_dict = {"x": gyro[0], "y": gyro[1], "z": gyro[2]}
-                json_data["ArrayAcc"].append(acc_dict)
-                json_data["ArrayGyro"].append(gyro_dict)
-            if self.imu_sensor == "IMU9":
-                magn = sensordata[i + samples_per_sensor * 2]
-                magn_dict = {"x": magn[0], "y": magn[1], "z": magn[2]}
-                json_data["ArrayMagn"].append(magn_dict)
-        self.log(f"{self.imu_sensor} _json data {json_data}")
-        imu_queue.enqueue(json_data)
+        block = self._fill_block(imu_pool, _FLOAT_FORMATS, data, sensor_count, QUANTIZED)
+        if block is None:
+            return
+        if self.features is not None:
+            record = self.features.add(block)
+            if record is not None:
+                features_queue.enqueue(record)
+            if IMU_STREAM_MODE == SUMMARY or not self.decimator.apply(block):
+                block.release()
+                return
+        imu_queue.enqueue(block)
 
     def _process_hr_data(self, data):
         unpacked_data = list(unpack('<BBfH', data))
         avg_hr = unpacked_data[2]
         rr_interval = unpacked_data[3]
+        utc_ms = utc_clock.now_ms()
         json_data = {
             "Movesense_series": self.ms_series,
             "Pico_ID": self.picoW_id,
-            "Timestamp_UTC": time.time(),
+            "Timestamp_UTC": utc_ms // 1000,
+            "Timestamp_UTC_ms": utc_ms,
             "average": avg_hr,
             "rrData": [rr_interval]
         }
@@ -143,19 +261,9 @@ class MovesenseDevice:
         hr_queue.enqueue(json_data)
 
     def _process_ecg_data(self, data):
-        sample_count = len(data[6:]) // self.BYTES_PER_ELEMENT
-        unpacked_data = list(unpack(f'<BBI{sample_count}i', data))
-        ts = unpacked_data[2]
-        sensordata = unpacked_data[3:]
-        json_data = {
-            "Movesense_series": self.ms_series,
-            "Pico_ID": self.picoW_id,
-            "Timestamp_UTC": time.time(),
-            "Timestamp_ms": ts,
-            "Samples": sensordata
-        }
-        self.log(f"ECG json data:{json_data}")
-        ecg_queue.enqueue(json_data)
+        block = self._fill_block(ecg_pool, _INT_FORMATS, data, 0)
+        if block is not None:
+            ecg_queue.enqueue(block)
 
     async def disconnect_ble(self):
         unsub_cmds = [
@@ -164,10 +272,12 @@ class MovesenseDevice:
             bytearray([_CMD_UNSUBSCRIBE, self.ecg_ref]),
         ]
         if self.connection and self.connection.is_connected():
-            self.log("Unsubscribing from sensors...")
-            for cmd in unsub_cmds:
-                await self.write_char.write(cmd)
-                await asyncio.sleep_ms(100)
+            # After a partial service discovery there's nothing to unsubscribe through
+            if self.write_char:
+                self.log("Unsubscribing from sensors...")
+                for cmd in unsub_cmds:
+                    await self.write_char.write(cmd)
+                    await asyncio.sleep_ms(100)
             await self.connection.disconnect()
             self.log("Disconnected")
 
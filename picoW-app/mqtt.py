@@ -1,7 +1,22 @@
 import uasyncio as asyncio
-from umqtt.robust import MQTTClient
-from data_queue import ecg_queue, hr_queue, imu_queue, gnss_queue, state
+import time
+import json
+from async_mqtt import AsyncMQTTClient
+from data_queue import ecg_queue, hr_queue, imu_queue, gnss_queue, features_queue, state, data_ready, wait_signal
 from password import MQTT_CONFIG
+from config import (PAYLOAD_FORMAT, MQTT_BATCH_MAX_BYTES, MQTT_BATCH_MAX_AGE_MS, SPOOL_DIR,
+                    SPOOL_SEGMENT_BYTES, SPOOL_MAX_BYTES, SPOOL_QUEUE_WATERMARK,
+                    SPOOL_REPLAY_INTERVAL_MS, MQTT_QOS, MQTT_MAX_INFLIGHT, MQTT_KEEPALIVE_S,
+                    TELEMETRY_ENABLED, TELEMETRY_INTERVAL_MS, PUBLISH_SCHEDULE, PUBLISH_QUANTUM_BYTES,
+                    ECG_COMPRESSION, ECG_KEY_INTERVAL)
+from spool import Spool
+from publish_batch import Batch
+from sample_block import release_record
+from mem_manager import memory
+from publish_scheduler import StreamSchedule, PublishScheduler, DROP, SPOOL
+from ecg_codec import EcgDeltaEncoder, KEY_BASE_LIVE, KEY_BASE_SPOOL
+from payload_codec import (FrameEncoder, encode_json, max_payload_size, FORMAT_BINARY,
+                           STREAM_IMU, STREAM_ECG, STREAM_HR, STREAM_GNSS, STREAM_FEATURES)
 
 own_mqtt_broker_enabled = True
 
@@ -11,53 +26,296 @@ IMU_TOPIC = "sensors/imu"
 ECG_TOPIC = "sensors/ecg"
 HR_TOPIC = "sensors/hr"
 GNSS_TOPIC = "sensors/gnss"
+FEATURES_TOPIC = "sensors/imu_features"
+METRICS_TOPIC = "sensors/metrics"
+
+# (topic, stream type, queue, payload format) in publishing order
+_STREAMS = (
+    (IMU_TOPIC, STREAM_IMU, imu_queue, PAYLOAD_FORMAT["imu"]),
+    (ECG_TOPIC, STREAM_ECG, ecg_queue, PAYLOAD_FORMAT["ecg"]),
+    (HR_TOPIC, STREAM_HR, hr_queue, PAYLOAD_FORMAT["hr"]),
+    (GNSS_TOPIC, STREAM_GNSS, gnss_queue, PAYLOAD_FORMAT["gnss"]),
+    (FEATURES_TOPIC, STREAM_FEATURES, features_queue, PAYLOAD_FORMAT["features"]),
+)
+
+_STREAM_NAMES = ("imu", "ecg", "hr", "gnss", "features")
+
+_encoder = FrameEncoder()
+_batches = [Batch(topic, payload_format, MQTT_BATCH_MAX_BYTES, MQTT_BATCH_MAX_AGE_MS)
+            for topic, _, _, payload_format in _STREAMS]
+
+# A spooled payload is a batch, or a record too large for one and sent alone
+_spool = Spool(SPOOL_DIR, SPOOL_SEGMENT_BYTES, SPOOL_MAX_BYTES,
+               max([MQTT_BATCH_MAX_BYTES] + [max_payload_size(stream, payload_format)
+                                            for _, stream, _, payload_format in _STREAMS]))
+
+_SPOOL_IDLE_MS = 1000
+
+# Scheduling policy per stream, in _STREAMS order
+_schedules = [StreamSchedule(name, PUBLISH_SCHEDULE[name]["priority"], PUBLISH_SCHEDULE[name]["weight"],
+                             PUBLISH_SCHEDULE[name]["deadline_ms"], PUBLISH_SCHEDULE[name]["drop"])
+              for name in _STREAM_NAMES]
+_scheduler = PublishScheduler(_schedules, [queue for _, _, queue, _ in _STREAMS], PUBLISH_QUANTUM_BYTES)
+# Queue length at which a stream's batches spill to the spool, as an int
+# so the per-round check doesn't allocate floats
+_spill_marks = [int(queue.max_len * SPOOL_QUEUE_WATERMARK) for _, _, queue, _ in _STREAMS]
+_spill = [False] * len(_STREAMS)
+
+# Where the records in each stream's batch are headed
+_LIVE = 0
+_SPOOLED = 1
+_routes = [_LIVE] * len(_STREAMS)
+# Delta coded ECG chains only decode in order, and spooled frames reach
+# the broker after live ones, so each path has its own chains
+_ecg_chains = (EcgDeltaEncoder(ECG_KEY_INTERVAL, KEY_BASE_LIVE),
+               EcgDeltaEncoder(ECG_KEY_INTERVAL, KEY_BASE_SPOOL)) if ECG_COMPRESSION else None
+
+_mqtt_client = None
+
+if TELEMETRY_ENABLED:
+    import telemetry
+    _published = telemetry.counter("published")
+    _spooled = telemetry.counter("spooled")
+    _publish_ms = telemetry.histogram("publish_ms")
+    _puback_ms = telemetry.histogram("puback_ms")
+    _batch_age_ms = telemetry.histogram("batch_age_ms")
+    for _schedule in _schedules:
+        _schedule.on_latency = telemetry.histogram(f"latency_{_schedule.name}_ms").add
+        telemetry.gauge(f"{_schedule.name}_late", lambda schedule=_schedule: schedule.late)
+        telemetry.gauge(f"{_schedule.name}_expired_dropped", lambda schedule=_schedule: schedule.dropped)
+        telemetry.gauge(f"{_schedule.name}_expired_spooled", lambda schedule=_schedule: schedule.spooled)
+    telemetry.gauge("spool_bytes", lambda: _spool.total_bytes)
+    telemetry.gauge("spool_evicted", lambda: _spool.evicted)
+    telemetry.gauge("spool_rejected", lambda: _spool.rejected)
+
+def _on_mqtt_state(connected):
+    state.network_connection_state = connected
+
+def _ssl_context():
+    import ssl
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    cadata = MQTT_CONFIG['ssl_params'].get('cadata')
+    if cadata:
+        context.load_verify_locations(cadata=cadata)
+        context.verify_mode = ssl.CERT_REQUIRED
+    else:
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+def create_mqtt_client():
+    """Create the shared MQTT client without connecting it."""
+    global _mqtt_client
+    if _mqtt_client is None:
+        _mqtt_client = AsyncMQTTClient(client_id=_MQTT_CLIENT_ID,
+                                       server=MQTT_CONFIG['server'],
+                                       port=MQTT_CONFIG['port'],
+                                       user=MQTT_CONFIG['username'],
+                                       password=MQTT_CONFIG['password'],
+                                       keepalive=MQTT_KEEPALIVE_S,
+                                       ssl=None if own_mqtt_broker_enabled else _ssl_context(),
+                                       max_inflight=MQTT_MAX_INFLIGHT,
+                                       on_state=_on_mqtt_state,
+                                       on_ack=_puback_ms.add if TELEMETRY_ENABLED else None)
+        if TELEMETRY_ENABLED:
+            client = _mqtt_client
+            telemetry.gauge("mqtt_reconnects", lambda: client.reconnects)
+            telemetry.gauge("mqtt_retransmits", lambda: client.retransmits)
+            telemetry.gauge("mqtt_inflight", lambda: len(client.inflight))
+    return _mqtt_client
 
 async def connect_mqtt():
+    """Connect the shared MQTT client. Returns the client even if the broker is unreachable."""
+    create_mqtt_client()
     try:
         print("Connecting MQTT broker...")
-        if own_mqtt_broker_enabled:
-            mqtt_client = MQTTClient(client_id=_MQTT_CLIENT_ID,
-                                     server=MQTT_CONFIG['server'],
-                                     port=MQTT_CONFIG['port'],
-                                     user=MQTT_CONFIG['username'],
-                                     password=MQTT_CONFIG['password'])
-        else:
-            mqtt_client = MQTTClient(client_id=_MQTT_CLIENT_ID,
-                                    server=MQTT_CONFIG['server'], 
-                                    port=MQTT_CONFIG['port'], 
-                                    user=MQTT_CONFIG['username'], 
-                                    password=MQTT_CONFIG['password'],
-                                    keepalive=True,
-                                    ssl=True,
-                                    ssl_params=MQTT_CONFIG['ssl_params'])
-        mqtt_client.connect()
-    except Exception as e:
+        await _mqtt_client.connect()
+        print("MQTT broker connected")
+    except (OSError, asyncio.TimeoutError, EOFError) as e:
         print(f"Error connecting to MQTT: {e}")
-        state.network_connection_state = False
-        return None
-    else:
-        if mqtt_client is not None:
-            state.network_connection_state = True
-            print("MQTT broker connected")
-        else:
-            state.network_connection_state = False
-            print(f"MQTT broker is {mqtt_client}")
-    return mqtt_client
+    return _mqtt_client
+
+async def keep_mqtt_connected(mqtt_client):
+    """Task to reconnect the MQTT client with backoff whenever the link drops."""
+    await mqtt_client.keep_connected()
+
+def stream_schedule(name):
+    """The StreamSchedule of a stream by name ("imu", "ecg", "hr", "gnss" or "features")."""
+    return _schedules[_STREAM_NAMES.index(name)]
+
+def encode_payload(stream, record, payload_format, route=_LIVE):
+    """Render a queued record headed for route as JSON or as a binary frame."""
+    if payload_format == FORMAT_BINARY:
+        if _ecg_chains:
+            _encoder.ecg = _ecg_chains[route]
+        return _encoder.encode(stream, record)
+    return encode_json(stream, record)
+
+def _rerouted(index):
+    """Frames encoded for the broker went to the spool: end the chains they belong to."""
+    if _ecg_chains and _STREAMS[index][1] == STREAM_ECG:
+        _ecg_chains[_LIVE].restart()
+
+def is_online(mqtt_client):
+    return mqtt_client is not None and mqtt_client.is_connected()
+
+async def deliver(mqtt_client, index, payload, spill=False):
+    """Publish a payload, or write it to the flash spool while the broker is unreachable.
+
+    Returns True if it was published.
+    """
+    if not spill and is_online(mqtt_client):
+        try:
+            if TELEMETRY_ENABLED:
+                start = time.ticks_ms()
+                await mqtt_client.publish(_STREAMS[index][0], payload, MQTT_QOS)
+                _publish_ms.add(time.ticks_diff(time.ticks_ms(), start))
+                _published.add()
+            else:
+                await mqtt_client.publish(_STREAMS[index][0], payload, MQTT_QOS)
+            return True
+        except OSError as e:
+            print(f"MQTT publish failed, spooling data: {e}")
+    if not _spool.append(index, payload):
+        print(f"Spool: dropped a {len(payload)} B payload, larger than a spool record")
+    elif TELEMETRY_ENABLED:
+        _spooled.add()
+    return False
+
+async def flush_batch(mqtt_client, index):
+    """Send a stream's batch on its route. Returns True if it was published."""
+    batch = _batches[index]
+    if TELEMETRY_ENABLED:
+        _batch_age_ms.add(time.ticks_diff(time.ticks_ms(), batch.started_ms))
+    delivered = await deliver(mqtt_client, index, batch.payload(), _routes[index] == _SPOOLED)
+    if delivered:
+        _schedules[index].record_latency(time.ticks_diff(time.ticks_ms(), batch.oldest_ms))
+    elif _routes[index] == _LIVE:
+        _rerouted(index)
+    batch.reset()
+    return delivered
+
+async def serve_record(mqtt_client, index):
+    """Move the oldest record of one stream into its batch, publishing the batch when full.
+
+    Records past the stream's deadline are handled by its drop policy.
+    A batch only holds records for one route, the broker or the spool, so
+    the records of a stream reach either one in order. Returns the encoded
+    size, which the scheduler charges to the stream.
+    """
+    batch = _batches[index]
+    topic, stream, queue, payload_format = _STREAMS[index]
+    schedule = _schedules[index]
+    now = time.ticks_ms()
+    produced = queue.oldest_ms()
+    late = schedule.is_late(time.ticks_diff(now, produced))
+    record = queue.dequeue()
+    if late:
+        schedule.late += 1
+        if schedule.drop_policy == DROP:
+            schedule.dropped += 1
+            release_record(record)
+            return 0
+    spool = late and schedule.drop_policy == SPOOL
+    if spool:
+        schedule.spooled += 1
+    route = _SPOOLED if spool or _spill[index] or not is_online(mqtt_client) else _LIVE
+    if route != _routes[index]:
+        if not batch.is_empty():
+            await flush_batch(mqtt_client, index)
+        _routes[index] = route
+    payload = encode_payload(stream, record, payload_format, route)
+    release_record(record)
+    if batch.add(payload, now, produced):
+        return len(payload)
+    if not await flush_batch(mqtt_client, index) and route == _LIVE:
+        # The live chain this payload continues went to the spool, so it follows
+        _routes[index] = _SPOOLED
+    if not batch.add(payload, now, produced):
+        # Larger than the batch budget, send on its own
+        if not await deliver(mqtt_client, index, payload, _routes[index] == _SPOOLED) and route == _LIVE:
+            _rerouted(index)
+    return len(payload)
+
+def next_deadline_ms(now):
+    """Time until the oldest pending batch is due, or None if all batches are empty."""
+    deadline = None
+    for batch in _batches:
+        remaining = batch.remaining_ms(now)
+        if remaining is not None and (deadline is None or remaining < deadline):
+            deadline = remaining
+    return deadline
 
 async def publish_to_mqtt(mqtt_client):
-    """Task to publish data from queues to MQTT broker."""
+    """Task to publish data from queues to MQTT broker.
+
+    Queues are served by the deficit round robin scheduler until they are
+    empty, then due batches are flushed. A queue filled past the watermark
+    means publishing can't keep up, so its batches go to the spool and are
+    replayed later. Sleeps until a queue signals new data or a pending
+    batch is due; with every queue drained, this is where a garbage
+    collection hurts least.
+    """
+    async def serve(index):
+        return await serve_record(mqtt_client, index)
+
+    while True:
+        for index in range(len(_STREAMS)):
+            queue = _STREAMS[index][2]
+            _spill[index] = queue.get_length() >= _spill_marks[index]
+        await _scheduler.run_round(serve)
+        if _scheduler.is_backlogged():
+            continue
+        now = time.ticks_ms()
+        for index in range(len(_STREAMS)):
+            if _batches[index].is_due(now):
+                await flush_batch(mqtt_client, index)
+        memory.idle()
+        deadline = next_deadline_ms(now)
+        if deadline is None:
+            await data_ready.wait()
+        else:
+            await wait_signal(data_ready, deadline)
+
+def live_data_pending():
+    for _, _, queue, _ in _STREAMS:
+        if not queue.is_empty():
+            return True
+    return False
+
+async def replay_spool(mqtt_client):
+    """Task to replay spooled payloads in order once the broker is reachable again.
+
+    One record is sent per SPOOL_REPLAY_INTERVAL_MS and only while the live
+    queues are empty, so live data keeps priority.
+    """
+    while True:
+        if not is_online(mqtt_client) or _spool.is_empty():
+            await asyncio.sleep_ms(_SPOOL_IDLE_MS)
+            continue
+        if not live_data_pending():
+            record = _spool.peek()
+            if record:
+                index, payload = record
+                try:
+                    await mqtt_client.publish(_STREAMS[index][0], payload, MQTT_QOS)
+                    _spool.consume()
+                except OSError as e:
+                    print(f"MQTT publish failed during spool replay: {e}")
+        await asyncio.sleep_ms(SPOOL_REPLAY_INTERVAL_MS)
+
+async def publish_metrics(mqtt_client, picoW_id):
+    """Task to publish the telemetry summary every TELEMETRY_INTERVAL_MS.
+
+    Metrics go out at QoS 0 and are skipped while offline, so they never
+    take in-flight window slots or spool space from sensor data.
+    """
     while True:
-        if mqtt_client:
-            if not imu_queue.is_empty():
-                imu_data = imu_queue.dequeue()
-                mqtt_client.publish(IMU_TOPIC, str(imu_data).encode())
-            if not ecg_queue.is_empty():
-                ecg_data = ecg_queue.dequeue()
-                mqtt_client.publish(ECG_TOPIC, str(ecg_data).encode())
-            if not hr_queue.is_empty():
-                hr_data = hr_queue.dequeue()
-                mqtt_client.publish(HR_TOPIC, str(hr_data).encode())
-            if not gnss_queue.is_empty():
-                gnss_data = gnss_queue.dequeue()
-                mqtt_client.publish(GNSS_TOPIC, str(gnss_data).encode())
-        await asyncio.sleep_ms(100)
\ No newline at end of file
+        await asyncio.sleep_ms(TELEMETRY_INTERVAL_MS)
+        metrics = telemetry.summary()
+        if not is_online(mqtt_client):
+            continue
+        metrics["Pico_ID"] = picoW_id
+        try:
+            await mqtt_client.publish(METRICS_TOPIC, json.dumps(metrics).encode(), 0)
+        except OSError as e:
+            print(f"MQTT metrics publish failed: {e}")
@@ -0,0 +1,239 @@
+import micropython
+from array import array
+from micropython import const
+
+# NMEA 0183 sentences are at most 82 characters including "$" and CRLF
+_MAX_SENTENCE = const(96)
+_MAX_FIELDS = const(24)
+
+_DOLLAR = const(0x24)
+_STAR = const(0x2A)
+_COMMA = const(0x2C)
+_DOT = const(0x2E)
+_LF = const(0x0A)
+
+# Sentence types, the three letters after the talker id packed into an int
+GGA = const(0x474741)
+RMC = const(0x524D43)
+VTG = const(0x565447)
+GST = const(0x475354)
+ZDA = const(0x5A4441)
+
+_HEX = b"0123456789ABCDEF"
+
+
+class NmeaParser:
+    """Incremental NMEA parser working in place on a preallocated buffer.
+
+    Raw UART bytes go in through feed(). Every complete sentence with a
+    valid "*hh" checksum is split into fields by offset, and GGA, RMC, VTG,
+    GST and ZDA fields are converted straight from the bytes into integer
+    attributes (fixed point, no floats or strings). handler(parser, kind)
+    is then called with the sentence type; line() gives the raw sentence.
+    """
+    def __init__(self, handler=None):
+        self.handler = handler
+        self.buf = bytearray(_MAX_SENTENCE)
+        self.fields = array("B", [0] * (_MAX_FIELDS + 1))
+        self.nfields = 0
+        self.pos = 0
+        self.length = 0
+        self.in_sentence = False
+        self.sentences = 0
+        self.checksum_errors = 0
+        self.overflows = 0
+        # GGA
+        self.utc_ms = -1
+        self.lat_e7 = 0
+        self.lon_e7 = 0
+        self.fix_quality = 0
+        self.num_sats = 0
+        self.hdop_x100 = 0
+        self.alt_mm = 0
+        # RMC / VTG
+        self.rmc_valid = False
+        self.speed_mm_s = 0
+        self.course_x100 = 0
+        # RMC / ZDA
+        self.day = 0
+        self.month = 0
+        self.year = 0
+        # GST
+        self.std_lat_mm = 0
+        self.std_lon_mm = 0
+        self.std_alt_mm = 0
+
+    def line(self):
+        """The last complete sentence, "$" to "\\n" inclusive, valid until the next feed()."""
+        return memoryview(self.buf)[:self.length]
+
+    @micropython.native
+    def feed(self, data, n=-1):
+        """Consume n raw bytes from data (all of it by default)."""
+        if n < 0:
+            n = len(data)
+        buf = self.buf
+        pos = self.pos
+        in_sentence = self.in_sentence
+        for i in range(n):
+            b = data[i]
+            if b == _DOLLAR:
+                in_sentence = True
+                pos = 0
+            elif not in_sentence:
+                continue
+            if pos >= _MAX_SENTENCE:
+                self.overflows += 1
+                in_sentence = False
+                continue
+            buf[pos] = b
+            pos += 1
+            if b == _LF:
+                in_sentence = False
+                self.length = pos
+                self._sentence(pos)
+        self.pos = pos
+        self.in_sentence = in_sentence
+
+    @micropython.native
+    def _sentence(self, length):
+        buf = self.buf
+        fields = self.fields
+        checksum = 0
+        nfields = 0
+        star = -1
+        fields[0] = 1
+        for i in range(1, length):
+            b = buf[i]
+            if b == _STAR:
+                star = i
+                break
+            checksum ^= b
+            if b == _COMMA and nfields < _MAX_FIELDS:
+                nfields += 1
+                fields[nfields] = i + 1
+        if star < 0 or star + 2 >= length or nfields < 1:
+            self.checksum_errors += 1
+            return
+        if buf[star + 1] != _HEX[checksum >> 4] or buf[star + 2] != _HEX[checksum & 0x0F]:
+            self.checksum_errors += 1
+            return
+        # Sentinel so every field i ends at fields[i + 1] - 1
+        fields[nfields + 1] = star + 1
+        self.nfields = nfields + 1
+        self.sentences += 1
+        kind = (buf[3] << 16) | (buf[4] << 8) | buf[5]
+        if kind == GGA:
+            self._gga()
+        elif kind == RMC:
+            self._rmc()
+        elif kind == VTG:
+            self._vtg()
+        elif kind == GST:
+            self._gst()
+        elif kind == ZDA:
+            self._zda()
+        else:
+            return
+        if self.handler:
+            self.handler(self, kind)
+
+    def is_empty(self, i):
+        return i >= self.nfields or self.fields[i + 1] - 1 == self.fields[i]
+
+    def char(self, i):
+        """First byte of field i, or 0 if it's empty."""
+        if self.is_empty(i):
+            return 0
+        return self.buf[self.fields[i]]
+
+    @micropython.native
+    def fixed(self, i, decimals=0, start=0, digits=-1):
+        """Field i as an integer scaled by 10**decimals, or 0 if it's empty.
+
+        start and digits select a sub-range of the field, e.g. the degrees
+        of a ddmm.mmmm coordinate.
+        """
+        if i >= self.nfields:
+            return 0
+        buf = self.buf
+        pos = self.fields[i] + start
+        end = self.fields[i + 1] - 1
+        if digits >= 0 and pos + digits < end:
+            end = pos + digits
+        value = 0
+        negative = False
+        frac = -1
+        while pos < end:
+            b = buf[pos]
+            pos += 1
+            if b == _DOT:
+                frac = 0
+            elif b == 0x2D:
+                negative = True
+            elif frac < decimals:
+                value = value * 10 + b - 0x30
+                if frac >= 0:
+                    frac += 1
+        if frac < 0:
+            frac = 0
+        while frac < decimals:
+            value *= 10
+            frac += 1
+        return -value if negative else value
+
+    def _coordinate(self, i, deg_digits):
+        """ddmm.mmmmm / dddmm.mmmmm field in units of 1e-7 degrees."""
+        if self.is_empty(i):
+            return 0
+        degrees = self.fixed(i, 0, 0, deg_digits)
+        minutes = self.fixed(i, 7, deg_digits)
+        value = degrees * 10000000 + minutes // 60
+        hemisphere = self.char(i + 1)
+        return -value if hemisphere == 0x53 or hemisphere == 0x57 else value
+
+    def _time(self, i):
+        """hhmmss.ss field as milliseconds of the day, or -1 if it's empty."""
+        if self.is_empty(i):
+            return -1
+        return (self.fixed(i, 0, 0, 2) * 3600000 + self.fixed(i, 0, 2, 2) * 60000
+                + self.fixed(i, 3, 4))
+
+    def _gga(self):
+        # $xxGGA,time,lat,N,lon,E,fix,sats,hdop,alt,M,...
+        self.utc_ms = self._time(1)
+        self.lat_e7 = self._coordinate(2, 2)
+        self.lon_e7 = self._coordinate(4, 3)
+        self.fix_quality = self.fixed(6)
+        self.num_sats = self.fixed(7)
+        self.hdop_x100 = self.fixed(8, 2)
+        self.alt_mm = self.fixed(9, 3)
+
+    def _rmc(self):
+        # $xxRMC,time,status,lat,N,lon,E,speed kn,course,ddmmyy,...
+        self.utc_ms = self._time(1)
+        self.rmc_valid = self.char(2) == 0x41
+        self.speed_mm_s = self.fixed(7, 3) * 1852 // 3600
+        self.course_x100 = self.fixed(8, 2)
+        if not self.is_empty(9):
+            self.day = self.fixed(9, 0, 0, 2)
+            self.month = self.fixed(9, 0, 2, 2)
+            self.year = 2000 + self.fixed(9, 0, 4, 2)
+
+    def _vtg(self):
+        # $xxVTG,course T,T,course M,M,speed kn,N,speed km/h,K,...
+        self.course_x100 = self.fixed(1, 2)
+        self.speed_mm_s = self.fixed(7, 3) * 1000 // 3600
+
+    def _gst(self):
+        # $xxGST,time,rms,std major,std minor,orient,std lat,std lon,std alt
+        self.std_lat_mm = self.fixed(6, 3)
+        self.std_lon_mm = self.fixed(7, 3)
+        self.std_alt_mm = self.fixed(8, 3)
+
+    def _zda(self):
+        # $xxZDA,time,dd,mm,yyyy,...
+        self.utc_ms = self._time(1)
+        self.day = self.fixed(2)
+        self.month = self.fixed(3)
+        self.year = self.fixed(4)
@@ -0,0 +1,147 @@
+import time
+import usocket
+import ubinascii
+import uasyncio as asyncio
+from micropython import const
+
+_RECONNECT_MIN_MS = const(1000)
+_RECONNECT_MAX_MS = const(60000)
+
+
+class DnsCache:
+    """getaddrinfo results kept for ttl_ms.
+
+    Lookups block the event loop on MicroPython, so they are only done when
+    an entry expires. If a lookup fails, the expired address is used rather
+    than giving up.
+    """
+    def __init__(self, ttl_ms):
+        self.ttl_ms = ttl_ms
+        self.entries = {}
+
+    def resolve(self, host, port):
+        entry = self.entries.get(host)
+        now = time.ticks_ms()
+        if entry and time.ticks_diff(now, entry[1]) < self.ttl_ms:
+            return entry[0]
+        try:
+            ip = usocket.getaddrinfo(host, port)[0][-1][0]
+        except OSError as e:
+            if entry:
+                print(f"DNS lookup for {host} failed ({e}), using cached {entry[0]}")
+                return entry[0]
+            raise
+        self.entries[host] = (ip, now)
+        return ip
+
+
+class NtripClient:
+    """NTRIP caster session that reconnects on its own.
+
+    run() connects with non-blocking sockets, parses the response headers
+    asynchronously and hands the correction stream to the relay. When the
+    caster closes the connection, goes silent for idle_timeout_ms or a socket
+    error occurs, it reconnects with exponential backoff, sending the latest
+    GGA so the caster can pick a base station again.
+    """
+    def __init__(self, host, port, mountpoint, user, password, dns_ttl_ms,
+                 timeout_ms=10000, idle_timeout_ms=15000):
+        self.host = host
+        self.port = port
+        self.mountpoint = mountpoint
+        self.auth = ubinascii.b2a_base64(f"{user}:{password}".encode()).decode().strip()
+        self.dns = DnsCache(dns_ttl_ms)
+        self.timeout_ms = timeout_ms
+        self.idle_timeout_ms = idle_timeout_ms
+        self.reader = None
+        self.writer = None
+        self.gga = None
+        self.connected_ms = None
+        self.uptime_ms = 0
+        self.sessions = 0
+        self.reconnects = 0
+
+    def is_connected(self):
+        return self.writer is not None
+
+    def session_uptime_ms(self):
+        """Time since the current session started, 0 if disconnected."""
+        if self.connected_ms is None:
+            return 0
+        return time.ticks_diff(time.ticks_ms(), self.connected_ms)
+
+    def send_gga(self, line):
+        """Remember the GGA sentence and send it if connected. Never blocks."""
+        self.gga = bytes(line)
+        if self.writer:
+            try:
+                # Written straight to the socket; any remainder is buffered
+                self.writer.write(self.gga)
+            except OSError as e:
+                print("FAILED to send new coordinates:", e)
+
+    async def connect(self):
+        """Open a session. Raises OSError if the caster can't be reached or refuses."""
+        ip = self.dns.resolve(self.host, self.port)
+        self.reader, self.writer = await asyncio.wait_for_ms(
+            asyncio.open_connection(ip, self.port), self.timeout_ms)
+        request = (
+            "GET /{} HTTP/1.1\r\n"
+            "Host: {}\r\n"
+            "Ntrip-Version: Ntrip/2.0\r\n"
+            "User-Agent: MicroPython NTRIP Client\r\n"
+            "Authorization: Basic {}\r\n"
+        ).format(self.mountpoint, self.host, self.auth)
+        if self.gga:
+            request += "Ntrip-GGA: {}\r\n".format(self.gga.decode().strip())
+        self.writer.write((request + "\r\n").encode())
+        await self.writer.drain()
+
+        status = await asyncio.wait_for_ms(self.reader.readline(), self.timeout_ms)
+        if b" 200" not in status:
+            await self.close()
+            raise OSError("NTRIP caster refused: %s" % status.decode().strip())
+        # NTRIP 1 casters answer "ICY 200 OK" with no headers
+        if not status.startswith(b"ICY"):
+            while True:
+                line = await asyncio.wait_for_ms(self.reader.readline(), self.timeout_ms)
+                if not line or line == b"\r\n":
+                    break
+        if self.gga:
+            self.writer.write(self.gga)
+        self.connected_ms = time.ticks_ms()
+        self.sessions += 1
+        print("Connected to NTRIP caster")
+
+    async def close(self):
+        if self.connected_ms is not None:
+            self.uptime_ms += self.session_uptime_ms()
+            self.connected_ms = None
+        if self.writer:
+            try:
+                self.writer.close()
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+        self.reader = self.writer = None
+
+    async def run(self, relay):
+        """Keep a session up forever, feeding the correction stream to relay."""
+        delay = _RECONNECT_MIN_MS
+        while True:
+            try:
+                await self.connect()
+                delay = _RECONNECT_MIN_MS
+                await relay.run(self.reader, self.idle_timeout_ms)
+            except asyncio.TimeoutError:
+                print("NTRIP caster timed out")
+            except (OSError, EOFError) as e:
+                print("NTRIP session error:", e)
+            uptime = self.session_uptime_ms()
+            await self.close()
+            self.reconnects += 1
+            print(f"NTRIP session lost after {uptime // 1000} s "
+                  f"({self.reconnects} reconnects, {self.uptime_ms // 1000} s connected in total), "
+                  f"retrying in {delay} ms")
+            await asyncio.sleep_ms(delay)
+            delay = min(delay * 2, _RECONNECT_MAX_MS)
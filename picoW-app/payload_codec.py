@@ -0,0 +1,168 @@
+import struct
+import json
+from micropython import const
+
+from config import MOVESENSE_SERIES_LIST, ECG_COMPRESSION, ECG_KEY_INTERVAL
+from sample_block import SampleBlock, MAX_SAMPLE_VALUES, IMU_AXES
+from ecg_codec import EcgDeltaEncoder
+from imu_quant import SCALES
+
+# Binary frame layout (little-endian), version 1:
+#   version u8 | stream u8 | device u8 | flags u8 | seq u16 | body_len u16 |
+#   sensor timestamp ms u32 | UTC ms u64 | body
+# Frames are self-delimiting via body_len, so several frames can be
+# concatenated into one MQTT message. The host-side decoder lives in
+# python_client/decode_frames.py.
+#
+# flags: FLAG_ECG_DELTA marks an ECG body compressed by ecg_codec.py.
+# FLAG_IMU_INT16 marks an IMU body of int16 samples (imu_quant.py):
+#   sensors u8 | count u8 | scale f32 per sensor | int16 values
+# instead of sensors u8 | count u8 | float32 values.
+FRAME_VERSION = const(1)
+HEADER_FORMAT = "<BBBBHHIQ"
+HEADER_SIZE = const(20)
+
+STREAM_IMU = const(1)
+STREAM_ECG = const(2)
+STREAM_HR = const(3)
+STREAM_GNSS = const(4)
+# IMU feature records (imu_features.py) are always sent as JSON
+STREAM_FEATURES = const(5)
+
+FLAG_ECG_DELTA = const(0x01)
+FLAG_IMU_INT16 = const(0x02)
+
+DEVICE_PICO = const(0xFE)
+DEVICE_UNKNOWN = const(0xFF)
+
+FORMAT_JSON = "json"
+FORMAT_BINARY = "binary"
+
+_MAX_FRAME_SIZE = const(512)
+
+# Bounds of a JSON record: the series, Pico id and timestamps, one number
+# at its longest ("-1.234568e+07"), and a whole HR, GNSS or feature record
+_JSON_HEADER_SIZE = const(256)
+_JSON_NUMBER_SIZE = const(13)
+_JSON_RECORD_SIZE = const(512)
+# {"x": , "y": , "z": } and the separator around an IMU sample's numbers
+_JSON_TRIPLET_SIZE = const(24)
+
+
+def max_payload_size(stream, payload_format):
+    """Upper bound on the size of one encoded record of the stream."""
+    if payload_format == FORMAT_BINARY:
+        return _MAX_FRAME_SIZE
+    if stream == STREAM_IMU:
+        return _JSON_HEADER_SIZE + MAX_SAMPLE_VALUES // IMU_AXES * (3 * _JSON_NUMBER_SIZE + _JSON_TRIPLET_SIZE)
+    if stream == STREAM_ECG:
+        return _JSON_HEADER_SIZE + MAX_SAMPLE_VALUES * (_JSON_NUMBER_SIZE + 2)
+    return _JSON_RECORD_SIZE
+
+
+def device_index(ms_series):
+    """Map a Movesense series to its index in MOVESENSE_SERIES_LIST."""
+    try:
+        return MOVESENSE_SERIES_LIST.index(ms_series)
+    except ValueError:
+        return DEVICE_UNKNOWN
+
+
+class FrameEncoder:
+    """Encode sensor records into binary frames.
+
+    The returned memoryview points into a buffer owned by the encoder and is
+    only valid until the next call to encode(). With ECG_COMPRESSION, ECG
+    bodies are delta coded; the encoder then holds each sensor's chain
+    state, so every ECG block must be encoded in order exactly once.
+    """
+    def __init__(self):
+        self.buffer = bytearray(_MAX_FRAME_SIZE)
+        self.view = memoryview(self.buffer)
+        self.seq = {}
+        self.flags = 0
+        self.ecg = EcgDeltaEncoder(ECG_KEY_INTERVAL) if ECG_COMPRESSION else None
+
+    def _next_seq(self, stream):
+        seq = self.seq.get(stream, 0)
+        self.seq[stream] = (seq + 1) & 0xFFFF
+        return seq
+
+    def encode(self, stream, record):
+        self.flags = 0
+        if stream == STREAM_IMU or stream == STREAM_ECG:
+            device = device_index(record.ms_series)
+            body_len = self._imu_body(record) if stream == STREAM_IMU else self._ecg_body(record, device)
+            ts = record.timestamp_ms
+            utc_ms = record.timestamp_utc_ms
+        elif stream == STREAM_HR:
+            body_len = self._hr_body(record)
+            device = device_index(record["Movesense_series"])
+            ts = 0
+            utc_ms = record["Timestamp_UTC_ms"]
+        elif stream == STREAM_GNSS:
+            body_len = self._gnss_body(record)
+            device = DEVICE_PICO
+            ts = 0
+            utc_ms = record["Date_ms"]
+        else:
+            raise ValueError("Unknown stream type")
+        struct.pack_into(HEADER_FORMAT, self.buffer, 0, FRAME_VERSION, stream, device, self.flags,
+                         self._next_seq(stream), body_len, ts, utc_ms)
+        return self.view[:HEADER_SIZE + body_len]
+
+    def _pack_values(self, offset, block, items, item_size):
+        # The whole block is copied through its byte view; array items are
+        # never boxed and no intermediate bytes object is built
+        n = items * block.count * item_size
+        self.buffer[offset:offset + n] = block.raw[:n]
+        return offset + n
+
+    def _imu_body(self, block):
+        sensors = block.sensors
+        struct.pack_into("<BB", self.buffer, HEADER_SIZE, sensors, block.count)
+        offset = HEADER_SIZE + 2
+        if block.quantized:
+            self.flags = FLAG_IMU_INT16
+            for sensor in range(sensors):
+                struct.pack_into("<f", self.buffer, offset, SCALES[sensor])
+                offset += 4
+            offset = self._pack_values(offset, block, 3 * sensors, 2)
+        else:
+            offset = self._pack_values(offset, block, 3 * sensors, 4)
+        return offset - HEADER_SIZE
+
+    def _ecg_body(self, block, device):
+        if self.ecg is not None:
+            self.flags = FLAG_ECG_DELTA
+            return self.ecg.encode(device, block.values, block.count, self.buffer, HEADER_SIZE)
+        struct.pack_into("<H", self.buffer, HEADER_SIZE, block.count)
+        offset = self._pack_values(HEADER_SIZE + 2, block, 1, 4)
+        return offset - HEADER_SIZE
+
+    def _hr_body(self, record):
+        rr = record["rrData"]
+        buf = self.buffer
+        struct.pack_into("<fB", buf, HEADER_SIZE, record["average"], len(rr))
+        offset = HEADER_SIZE + 5
+        for v in rr:
+            struct.pack_into("<H", buf, offset, v)
+            offset += 2
+        return offset - HEADER_SIZE
+
+    def _gnss_body(self, record):
+        # Prefer the exact fixed-point coordinates; single-precision floats
+        # on the Pico can't hold RTK resolution
+        lat = record.get("Latitude_e7")
+        lon = record.get("Longitude_e7")
+        if lat is None:
+            lat = int(record["Latitude"] * 1e7)
+            lon = int(record["Longitude"] * 1e7)
+        struct.pack_into("<iiB", self.buffer, HEADER_SIZE, lat, lon, record.get("Fix_quality", 0))
+        return 9
+
+
+def encode_json(stream, record):
+    if isinstance(record, SampleBlock):
+        record = record.imu_dict() if stream == STREAM_IMU else record.ecg_dict()
+    return json.dumps(record).encode()
@@ -0,0 +1,62 @@
+import time
+
+from payload_codec import FORMAT_BINARY
+
+
+class Batch:
+    """Pack several encoded records into one MQTT message.
+
+    Binary frames are self-delimiting and simply concatenated. JSON records
+    are joined into a JSON array. The buffer is allocated once and reused.
+    oldest_ms is when the batch's first record was produced, for latency.
+    """
+    def __init__(self, topic, payload_format, max_bytes, max_age_ms):
+        self.topic = topic
+        self.binary = payload_format == FORMAT_BINARY
+        self.max_age_ms = max_age_ms
+        self.buffer = bytearray(max_bytes)
+        self.view = memoryview(self.buffer)
+        self.size = 0
+        self.count = 0
+        self.started_ms = 0
+        self.oldest_ms = 0
+
+    def is_empty(self):
+        return self.count == 0
+
+    def add(self, payload, now_ms, produced_ms=None):
+        """Append an encoded record queued at produced_ms. Returns False if it doesn't fit."""
+        n = len(payload)
+        # JSON batches need one byte for the separator and one for the closing bracket
+        extra = 0 if self.binary else 2
+        if self.size + n + extra > len(self.buffer):
+            return False
+        if self.count == 0:
+            self.started_ms = now_ms
+            self.oldest_ms = now_ms if produced_ms is None else produced_ms
+        if not self.binary:
+            self.buffer[self.size] = ord("[") if self.count == 0 else ord(",")
+            self.size += 1
+        self.buffer[self.size:self.size + n] = payload
+        self.size += n
+        self.count += 1
+        return True
+
+    def is_due(self, now_ms):
+        return self.count and time.ticks_diff(now_ms, self.started_ms) >= self.max_age_ms
+
+    def remaining_ms(self, now_ms):
+        """Time left until this batch must be flushed, or None if it's empty."""
+        if not self.count:
+            return None
+        return max(0, self.max_age_ms - time.ticks_diff(now_ms, self.started_ms))
+
+    def payload(self):
+        if not self.binary:
+            self.buffer[self.size] = ord("]")
+            return self.view[:self.size + 1]
+        return self.view[:self.size]
+
+    def reset(self):
+        self.size = 0
+        self.count = 0
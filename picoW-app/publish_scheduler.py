@@ -0,0 +1,96 @@
+from micropython import const
+
+# What happens to a record that waited longer than its stream's deadline
+KEEP = "keep"    # publish it anyway
+SPOOL = "spool"  # move it to the flash spool for replay
+DROP = "drop"    # discard it
+
+# Latency averages are exponential, with weight 1/2**_AVG_SHIFT
+_AVG_SHIFT = const(3)
+
+
+class StreamSchedule:
+    """Scheduling policy and latency statistics of one published stream.
+
+    Lower priority values are served first in every round. weight is the
+    stream's share of a round in quanta, deadline_ms the queueing time
+    after which drop_policy applies. Latency is measured from a record's
+    enqueue to the publish of its batch.
+    """
+    def __init__(self, name, priority, weight, deadline_ms, drop_policy=KEEP):
+        self.name = name
+        self.priority = priority
+        self.weight = weight
+        self.deadline_ms = deadline_ms
+        self.drop_policy = drop_policy
+        self.deficit = 0
+        self.served = 0
+        self.late = 0
+        self.dropped = 0
+        self.spooled = 0
+        self.batches = 0
+        self.latency_avg_ms = 0
+        self.latency_max_ms = 0
+        self.on_latency = None
+
+    def is_late(self, age_ms):
+        return age_ms > self.deadline_ms
+
+    def record_latency(self, latency_ms):
+        """Account the latency of a published batch's oldest record."""
+        self.batches += 1
+        if self.batches == 1:
+            self.latency_avg_ms = latency_ms
+        else:
+            self.latency_avg_ms += (latency_ms - self.latency_avg_ms) >> _AVG_SHIFT
+        if latency_ms > self.latency_max_ms:
+            self.latency_max_ms = latency_ms
+        if self.on_latency:
+            self.on_latency(latency_ms)
+
+
+class PublishScheduler:
+    """Deficit round robin over the stream queues.
+
+    Every round visits the backlogged queues in priority order and adds
+    weight * quantum_bytes to each one's deficit; the queue is then served
+    while its deficit is positive, each record costing its encoded size.
+    A backlog of large IMU frames therefore gets its byte share and no
+    more, while small HR and GNSS records are sent within the same round
+    they arrive in. An emptied queue loses its remaining deficit, so idle
+    streams don't save up credit.
+    """
+    def __init__(self, schedules, queues, quantum_bytes):
+        self.schedules = schedules
+        self.queues = queues
+        self.quantum_bytes = quantum_bytes
+        self.order = sorted(range(len(schedules)), key=lambda i: schedules[i].priority)
+        self.rounds = 0
+
+    def is_backlogged(self):
+        for queue in self.queues:
+            if not queue.is_empty():
+                return True
+        return False
+
+    async def run_round(self, serve):
+        """Serve one round. serve(index) is awaited per record and returns its cost in bytes.
+
+        Returns True if any record was served.
+        """
+        served = False
+        for index in self.order:
+            queue = self.queues[index]
+            schedule = self.schedules[index]
+            if queue.is_empty():
+                schedule.deficit = 0
+                continue
+            schedule.deficit += schedule.weight * self.quantum_bytes
+            while schedule.deficit > 0 and not queue.is_empty():
+                schedule.deficit -= await serve(index)
+                schedule.served += 1
+                served = True
+            if queue.is_empty():
+                schedule.deficit = 0
+        self.rounds += 1
+        return served
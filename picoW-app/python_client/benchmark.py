@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput benchmark for the picoW-app pipeline, run on the host.
+
+Every combination of IMU and ECG rate is run through pipeline_sim for a
+fixed time and reported as delivered samples/s, loss, drop counters and
+end-to-end latency percentiles (sensor notification to broker receipt,
+batching included). With several --speedup values the sensors send that
+many times faster than real time, which finds the highest load the
+pipeline sustains without loss. --alloc adds CPython heap numbers from
+tracemalloc, which slows the run down. --mode compares the IMU stream
+modes: raw samples, activity features only ("summary") or features plus
+decimated samples ("hybrid"); kB/s is everything published to the broker.
+
+Absolute numbers are for the host CPU; compare them between commits, not
+with the Pico.
+
+Usage:
+
+    python benchmark.py [--imu 26,104,208] [--ecg 125,500] [--sensors 2]
+                        [--duration 5] [--speedup 1,4,16] [--mode raw,summary]
+                        [--alloc] [--json]
+"""
+
+import argparse
+import asyncio
+import json
+
+from pipeline_sim import run_pipeline
+
+# Loss below this still counts as sustained: samples still in flight at
+# the end of a run aren't delivered yet
+_SUSTAINED_LOSS_PCT = 1.0
+
+
+def _int_list(text):
+    return [int(value) for value in text.split(",")]
+
+
+def _str_list(text):
+    return text.split(",")
+
+
+def _float_list(text):
+    return [float(value) for value in text.split(",")]
+
+
+def _ms(value):
+    return "-" if value is None else "%.0f" % value
+
+
+def _drops(result):
+    return sum(result["drops"].values()) - result["drops"]["spooled"]
+
+
+def print_header():
+    print("%7s %5s %5s %7s %6s | %9s %6s %5s %5s %5s | %9s %6s %5s %5s %5s | %6s %7s %s" % (
+        "mode", "imu", "ecg", "speedup", "kB/s",
+        "imu smp/s", "loss%", "p50", "p95", "p99",
+        "ecg smp/s", "loss%", "p50", "p95", "p99",
+        "drops", "spooled", "alloc B/rec"))
+
+
+def print_result(result):
+    imu = result["streams"]["imu"]
+    ecg = result["streams"]["ecg"]
+    alloc = result.get("alloc")
+    print("%7s %5d %5d %7.1f %6.1f | %9.0f %6.2f %5s %5s %5s | %9.0f %6.2f %5s %5s %5s | %6d %7d %s" % (
+        result["imu_mode"], result["imu_rate"], result["ecg_rate"], result["speedup"],
+        result["mqtt_bytes_per_s"] / 1000,
+        imu["samples_per_s"], imu["loss_pct"], _ms(imu["p50_ms"]), _ms(imu["p95_ms"]), _ms(imu["p99_ms"]),
+        ecg["samples_per_s"], ecg["loss_pct"], _ms(ecg["p50_ms"]), _ms(ecg["p95_ms"]), _ms(ecg["p99_ms"]),
+        _drops(result), result["drops"]["spooled"],
+        "%.0f" % alloc["heap_growth_bytes_per_record"] if alloc else "-"))
+
+
+def sustained(results):
+    """Highest total sample rate per (imu, ecg) pair that ran without loss."""
+    best = {}
+    for result in results:
+        streams = result["streams"]
+        if max(streams["imu"]["loss_pct"], streams["ecg"]["loss_pct"]) > _SUSTAINED_LOSS_PCT or _drops(result):
+            continue
+        key = (result["imu_mode"], result["imu_rate"], result["ecg_rate"])
+        rate = streams["imu"]["samples_per_s"] + streams["ecg"]["samples_per_s"]
+        best[key] = max(best.get(key, 0), rate)
+    return best
+
+
+async def run_all(args):
+    results = []
+    if not args.json:
+        print_header()
+    for imu_mode in args.mode:
+        for imu_rate in args.imu:
+            for ecg_rate in args.ecg:
+                for speedup in args.speedup:
+                    result = await run_pipeline(args.duration, imu_rate, ecg_rate, args.sensors, speedup,
+                                                measure_alloc=args.alloc, imu_mode=imu_mode)
+                    results.append(result)
+                    if not args.json:
+                        print_result(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--imu", type=_int_list, default=[26, 104, 208], help="IMU rates in Hz")
+    parser.add_argument("--ecg", type=_int_list, default=[125, 500], help="ECG rates in Hz")
+    parser.add_argument("--sensors", type=int, default=2, help="number of simulated sensors")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds of streaming per run")
+    parser.add_argument("--speedup", type=_float_list, default=[1.0], help="sensor speed multipliers")
+    parser.add_argument("--mode", type=_str_list, default=["raw"], help="IMU stream modes: raw, summary, hybrid")
+    parser.add_argument("--alloc", action="store_true", help="measure heap use with tracemalloc")
+    parser.add_argument("--json", action="store_true", help="print raw results as JSON")
+    args = parser.parse_args()
+
+    results = asyncio.run(run_all(args))
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print()
+    for (imu_mode, imu_rate, ecg_rate), rate in sorted(sustained(results).items()):
+        print(f"IMU {imu_rate} Hz ({imu_mode}) + ECG {ecg_rate} Hz x{args.sensors} sensors: "
+              f"sustained {rate:.0f} samples/s without loss")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+"""
+Host-side decoder for the MQTT payloads published by picoW-app.
+
+A payload is either a JSON document or one or more binary frames produced by
+picoW-app/payload_codec.py. Binary frames are concatenated back to back, each
+one starting with a fixed 20 byte header:
+
+    version u8 | stream u8 | device u8 | flags u8 | seq u16 | body_len u16 |
+    sensor timestamp ms u32 | UTC ms u64
+
+ECG frames with FLAG_ECG_DELTA carry delta coded samples (see
+picoW-app/ecg_codec.py). They depend on earlier frames of the same sensor,
+so decode_payload keeps their state in an EcgDeltaDecoder; pass one per
+source if payloads of several gateways are decoded in one process.
+
+IMU frames with FLAG_IMU_INT16 carry int16 samples and one float32 scale
+per sensor (see picoW-app/imu_quant.py). decode_payload returns them in
+the same record layout as float frames; with NumPy installed,
+decode_imu_arrays dequantizes whole payloads into arrays without touching
+single samples in Python.
+
+Usage as a script (requires paho-mqtt):
+
+    python decode_frames.py <broker host> [port]
+"""
+
+import json
+import struct
+import sys
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+FRAME_VERSION = 1
+HEADER = struct.Struct("<BBBBHHIQ")
+
+STREAM_IMU = 1
+STREAM_ECG = 2
+STREAM_HR = 3
+STREAM_GNSS = 4
+
+STREAM_NAMES = {
+    STREAM_IMU: "imu",
+    STREAM_ECG: "ecg",
+    STREAM_HR: "hr",
+    STREAM_GNSS: "gnss",
+}
+
+FLAG_ECG_DELTA = 0x01
+FLAG_IMU_INT16 = 0x02
+
+IMU_ARRAY_NAMES = ("ArrayAcc", "ArrayGyro", "ArrayMagn")
+
+DEVICE_PICO = 0xFE
+
+# Keep in sync with MOVESENSE_SERIES_LIST in picoW-app/config.py
+MOVESENSE_SERIES_LIST = ["174630000192", "213230000105"]
+
+
+class FrameError(ValueError):
+    pass
+
+
+def _xyz_blocks(body, offset, count):
+    values = struct.unpack_from(f"<{count * 3}f", body, offset)
+    return [{"x": values[i], "y": values[i + 1], "z": values[i + 2]}
+            for i in range(0, count * 3, 3)]
+
+
+def _decode_imu(body):
+    sensors, count = struct.unpack_from("<BB", body, 0)
+    block = count * 12
+    result = {
+        "ArrayAcc": _xyz_blocks(body, 2, count),
+        "ArrayGyro": _xyz_blocks(body, 2 + block, count),
+        "ArrayMagn": _xyz_blocks(body, 2 + 2 * block, count) if sensors == 3 else [],
+    }
+    return result
+
+
+def _decode_imu_int16(body):
+    sensors, count = struct.unpack_from("<BB", body, 0)
+    scales = struct.unpack_from(f"<{sensors}f", body, 2)
+    values = struct.unpack_from(f"<{sensors * count * 3}h", body, 2 + 4 * sensors)
+    result = {name: [] for name in IMU_ARRAY_NAMES}
+    for sensor, scale in enumerate(scales):
+        start = sensor * count * 3
+        result[IMU_ARRAY_NAMES[sensor]] = [
+            {"x": values[i] * scale, "y": values[i + 1] * scale, "z": values[i + 2] * scale}
+            for i in range(start, start + count * 3, 3)]
+    return result
+
+
+def dequantize_imu(body, flags=FLAG_IMU_INT16):
+    """Float32 array of shape (sensors, count, 3) from an IMU frame body.
+
+    Needs NumPy. Quantized samples are scaled per sensor in one vectorized
+    multiplication; bodies without FLAG_IMU_INT16 in flags are float32.
+    """
+    sensors, count = struct.unpack_from("<BB", body, 0)
+    n = sensors * count * 3
+    if not flags & FLAG_IMU_INT16:
+        return np.frombuffer(body, "<f4", n, 2).reshape(sensors, count, 3)
+    scales = np.frombuffer(body, "<f4", sensors, 2)
+    values = np.frombuffer(body, "<i2", n, 2 + 4 * sensors).reshape(sensors, count, 3)
+    return values * scales[:, None, None]
+
+
+def decode_imu_arrays(payload, series_list=MOVESENSE_SERIES_LIST):
+    """Decode the IMU frames of a binary payload into NumPy arrays.
+
+    Returns one record per IMU frame, with the header fields of
+    decode_frame and ArrayAcc/ArrayGyro/ArrayMagn as float32 arrays of
+    shape (count, 3); other frames are skipped.
+    """
+    if np is None:
+        raise ImportError("decode_imu_arrays requires numpy")
+    payload = bytes(payload)
+    records = []
+    offset = 0
+    while offset < len(payload):
+        if len(payload) - offset < HEADER.size:
+            raise FrameError("Truncated frame header")
+        version, stream, device, flags, seq, body_len, ts, utc_ms = HEADER.unpack_from(payload, offset)
+        start = offset + HEADER.size
+        offset = start + body_len
+        if version != FRAME_VERSION:
+            raise FrameError(f"Unsupported frame version {version}")
+        if offset > len(payload):
+            raise FrameError("Truncated frame body")
+        if stream != STREAM_IMU:
+            continue
+        samples = dequantize_imu(memoryview(payload)[start:offset], flags)
+        record = {
+            "stream": "imu",
+            "device": device_name(device, series_list),
+            "seq": seq,
+            "flags": flags,
+            "Timestamp_ms": ts,
+            "Timestamp_UTC_ms": utc_ms,
+        }
+        for sensor, name in enumerate(IMU_ARRAY_NAMES):
+            record[name] = samples[sensor] if sensor < len(samples) else np.empty((0, 3), np.float32)
+        records.append(record)
+    return records
+
+
+def _decode_ecg(body):
+    (count,) = struct.unpack_from("<H", body, 0)
+    return {"Samples": list(struct.unpack_from(f"<{count}i", body, 2))}
+
+
+def decode_deltas(body, offset, count, prev):
+    """Decode count zig-zag varint differences starting from prev. Returns (samples, offset)."""
+    samples = []
+    for _ in range(count):
+        z = 0
+        shift = 0
+        while True:
+            byte = body[offset]
+            offset += 1
+            z |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        prev += (z >> 1) ^ -(z & 1)
+        samples.append(prev)
+    return samples, offset
+
+
+class EcgDeltaDecoder:
+    """Chain state of compressed ECG frames, per device and key.
+
+    A frame that doesn't continue its chain (the previous one was lost, or
+    decoding started mid-chain) can't be decoded; it is counted in
+    undecodable and decoding resumes with the next key block. A chain whose
+    tail was spooled waits for the replay, so max_chains covers a long
+    outage.
+    """
+
+    def __init__(self, max_chains=4096):
+        self.max_chains = max_chains
+        self.chains = {}
+        self.undecodable = 0
+
+    def decode(self, device, body):
+        """Samples of one compressed body, or None if its chain is broken."""
+        count, key, chain = struct.unpack_from("<HHB", body, 0)
+        if chain == 0:
+            prev = 0
+        else:
+            state = self.chains.get((device, key))
+            if state is None or state[0] != chain:
+                self.undecodable += 1
+                return None
+            prev = state[1]
+        samples, _ = decode_deltas(body, 5, count, prev)
+        self.chains.pop((device, key), None)
+        self.chains[(device, key)] = (chain + 1, samples[-1] if samples else prev)
+        if len(self.chains) > self.max_chains:
+            del self.chains[next(iter(self.chains))]
+        return samples
+
+
+_ecg_decoder = EcgDeltaDecoder()
+
+
+def _decode_hr(body):
+    average, count = struct.unpack_from("<fB", body, 0)
+    return {"average": average, "rrData": list(struct.unpack_from(f"<{count}H", body, 5))}
+
+
+def _decode_gnss(body):
+    lat, lon, fix = struct.unpack_from("<iiB", body, 0)
+    return {"Latitude": lat / 1e7, "Longitude": lon / 1e7, "Fix_quality": fix}
+
+
+_BODY_DECODERS = {
+    STREAM_IMU: _decode_imu,
+    STREAM_ECG: _decode_ecg,
+    STREAM_HR: _decode_hr,
+    STREAM_GNSS: _decode_gnss,
+}
+
+
+def device_name(index, series_list=MOVESENSE_SERIES_LIST):
+    if index == DEVICE_PICO:
+        return "pico"
+    if index < len(series_list):
+        return series_list[index]
+    return None
+
+
+def decode_frame(payload, offset=0, series_list=MOVESENSE_SERIES_LIST, ecg_decoder=None):
+    """Decode one binary frame starting at offset.
+
+    Returns (record, next_offset). A compressed ECG frame whose chain is
+    broken has empty Samples and "undecodable" set.
+    """
+    if len(payload) - offset < HEADER.size:
+        raise FrameError("Truncated frame header")
+    version, stream, device, flags, seq, body_len, ts, utc_ms = HEADER.unpack_from(payload, offset)
+    if version != FRAME_VERSION:
+        raise FrameError(f"Unsupported frame version {version}")
+    start = offset + HEADER.size
+    end = start + body_len
+    if end > len(payload):
+        raise FrameError("Truncated frame body")
+    decoder = _BODY_DECODERS.get(stream)
+    if decoder is None:
+        raise FrameError(f"Unknown stream type {stream}")
+    record = {
+        "stream": STREAM_NAMES[stream],
+        "device": device_name(device, series_list),
+        "seq": seq,
+        "flags": flags,
+        "Timestamp_ms": ts,
+        "Timestamp_UTC_ms": utc_ms,
+    }
+    body = memoryview(payload)[start:end]
+    if stream == STREAM_ECG and flags & FLAG_ECG_DELTA:
+        samples = (ecg_decoder or _ecg_decoder).decode(device, body)
+        record["Samples"] = samples or []
+        if samples is None:
+            record["undecodable"] = True
+    elif stream == STREAM_IMU and flags & FLAG_IMU_INT16:
+        record.update(_decode_imu_int16(body))
+    else:
+        record.update(decoder(body))
+    return record, end
+
+
+def decode_payload(payload, series_list=MOVESENSE_SERIES_LIST, ecg_decoder=None):
+    """Decode an MQTT payload into a list of records.
+
+    JSON payloads are returned as-is (a single object becomes a one element list).
+    """
+    payload = bytes(payload)
+    if payload[:1] in (b"{", b"["):
+        document = json.loads(payload)
+        return document if isinstance(document, list) else [document]
+    records = []
+    offset = 0
+    while offset < len(payload):
+        record, offset = decode_frame(payload, offset, series_list, ecg_decoder)
+        records.append(record)
+    return records
+
+
+def main(host, port=1883):
+    import paho.mqtt.client as mqtt
+
+    def on_message(client, userdata, message):
+        try:
+            for record in decode_payload(message.payload):
+                print(message.topic, record)
+        except (FrameError, ValueError) as e:
+            print(f"{message.topic}: failed to decode payload: {e}")
+
+    client = mqtt.Client()
+    client.on_message = on_message
+    client.connect(host, port)
+    client.subscribe("sensors/#")
+    client.loop_forever()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python decode_frames.py <broker host> [port]")
+        exit(1)
+    main(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 1883)
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the ECG delta codec on recorded or synthetic ECG.
+
+The samples are cut into blocks like Movesense notifications, encoded with
+picoW-app's own FrameEncoder (run under CPython through mp_shims) and
+decoded with decode_frames.py. Every block is checked to decode to the
+exact input. The report compares bytes per second for the JSON records,
+raw int32 binary frames and delta coded frames, and the encode time per
+block on this machine.
+
+Recorded ECG can be a text/CSV file with one sample per line (the first
+column is used), or a file of JSON records as published on sensors/ecg, one
+record or array per line. Without --file, a synthetic ECG with realistic
+QRS slopes, baseline wander and noise is used.
+
+Usage:
+
+    python ecg_codec_bench.py [--file ecg.csv] [--rate 500] [--seconds 60]
+                              [--block 16] [--key-interval 8]
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import tempfile
+import time
+
+import mp_shims
+from decode_frames import EcgDeltaDecoder, decode_payload
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Gaussian waves (position in the beat 0..1, width, amplitude in uV) of P, Q, R, S and T
+_WAVES = ((0.2, 0.025, 150), (0.36, 0.01, -120), (0.4, 0.012, 1200), (0.44, 0.01, -250), (0.7, 0.05, 300))
+
+
+def synthetic_ecg(rate, seconds, seed=1):
+    """ECG-like int samples in uV: 60-90 bpm beats, baseline wander and noise."""
+    rng = random.Random(seed)
+    samples = []
+    beat_pos = 0.0
+    heart_rate = 70.0
+    for n in range(int(rate * seconds)):
+        t = n / rate
+        value = sum(a * math.exp(-((beat_pos - c) ** 2) / (2 * w * w)) for c, w, a in _WAVES)
+        value += 80 * math.sin(2 * math.pi * 0.25 * t) + rng.gauss(0, 8)
+        samples.append(int(round(value)))
+        beat_pos += heart_rate / 60 / rate
+        if beat_pos >= 1:
+            beat_pos -= 1
+            heart_rate = min(90.0, max(60.0, heart_rate + rng.uniform(-3, 3)))
+    return samples
+
+
+def load_samples(path):
+    samples = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line[0] in "[{":
+                document = json.loads(line)
+                for record in document if isinstance(document, list) else [document]:
+                    samples.extend(int(v) for v in record["Samples"])
+                continue
+            try:
+                samples.append(int(float(line.split(",")[0])))
+            except ValueError:
+                # Header line
+                continue
+    return samples
+
+
+def _load_codec(key_interval):
+    mp_shims.unload_app(APP_DIR)
+    mp_shims.install(APP_DIR, tempfile.mkdtemp(prefix="picow-ecg-"), 0, 0)
+    import config
+    config.ECG_KEY_INTERVAL = key_interval
+    config.ECG_COMPRESSION = True
+    import data_queue
+    import payload_codec
+    return data_queue.ecg_pool, payload_codec
+
+
+def run(samples, rate, block_size, key_interval):
+    pool, payload_codec = _load_codec(key_interval)
+    series = payload_codec.MOVESENSE_SERIES_LIST[0]
+    delta_encoder = payload_codec.FrameEncoder()
+    raw_encoder = payload_codec.FrameEncoder()
+    raw_encoder.ecg = None
+    decoder = EcgDeltaDecoder()
+    sizes = {"json": 0, "raw": 0, "delta": 0}
+    encode_s = 0.0
+    blocks = 0
+    block = pool.acquire()
+    block.ms_series = series
+    block.picoW_id = "bench"
+    for start in range(0, len(samples) - block_size + 1, block_size):
+        chunk = samples[start:start + block_size]
+        for i, v in enumerate(chunk):
+            block.values[i] = v
+        block.count = len(chunk)
+        block.timestamp_ms = start * 1000 // rate
+        block.timestamp_utc_ms = 1700000000000 + block.timestamp_ms
+        sizes["json"] += len(payload_codec.encode_json(payload_codec.STREAM_ECG, block))
+        sizes["raw"] += len(raw_encoder.encode(payload_codec.STREAM_ECG, block))
+        t0 = time.perf_counter()
+        frame = bytes(delta_encoder.encode(payload_codec.STREAM_ECG, block))
+        encode_s += time.perf_counter() - t0
+        sizes["delta"] += len(frame)
+        decoded = decode_payload(frame, ecg_decoder=decoder)[0]["Samples"]
+        if decoded != chunk:
+            raise AssertionError(f"Block at sample {start} decoded to different samples")
+        blocks += 1
+    seconds = blocks * block_size / rate
+    return {
+        "blocks": blocks,
+        "bytes_per_s": {name: size / seconds for name, size in sizes.items()},
+        "ratio_vs_json": sizes["json"] / sizes["delta"],
+        "ratio_vs_raw": sizes["raw"] / sizes["delta"],
+        "encode_us_per_block": encode_s / blocks * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--file", help="recorded ECG, CSV/text samples or JSON records")
+    parser.add_argument("--rate", type=int, default=500, help="sample rate in Hz")
+    parser.add_argument("--seconds", type=float, default=60, help="length of the synthetic ECG")
+    parser.add_argument("--block", type=int, default=16, help="samples per notification")
+    parser.add_argument("--key-interval", type=int, default=8, help="blocks per delta chain")
+    args = parser.parse_args()
+
+    samples = load_samples(args.file) if args.file else synthetic_ecg(args.rate, args.seconds)
+    result = run(samples, args.rate, args.block, args.key_interval)
+    print(f"{len(samples)} samples at {args.rate} Hz, {args.block} per block, key every {args.key_interval} blocks "
+          f"({'recorded' if args.file else 'synthetic'}), all {result['blocks']} blocks decoded losslessly")
+    for name, rate in result["bytes_per_s"].items():
+        print(f"  {name:5s} {rate:9.0f} B/s")
+    print(f"  delta coding is {result['ratio_vs_json']:.1f}x smaller than JSON, "
+          f"{result['ratio_vs_raw']:.1f}x smaller than raw binary")
+    print(f"  encode {result['encode_us_per_block']:.1f} us/block on this host")
+
+
+if __name__ == "__main__":
+    main()
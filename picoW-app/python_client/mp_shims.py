@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+"""
+MicroPython stand-ins that let the picoW-app modules run under CPython.
+
+install() registers fake `micropython`, `machine`, `bluetooth`, `aioble`,
+`network`, `uasyncio`, `usocket`, `ubinascii`, `uselect` and `password`
+modules, adds the ticks_* functions to `time` and mem_free, mem_alloc and
+threshold to `gc`, and points the flash paths in config.py at a scratch
+directory. The app modules are then imported unchanged. Only what
+picoW-app actually uses is implemented.
+
+Sensors are provided by the caller as objects with `serial`, `addr` and
+`connect()` (see pipeline_sim.SimSensor). The GNSS UART is a FakeUart the
+caller feeds with inject().
+"""
+
+import asyncio
+import binascii
+import ctypes
+import gc
+import os
+import select
+import socket
+import sys
+import time
+import types
+
+_TICKS_PERIOD = 1 << 30
+
+
+def _ticks_ms():
+    return int(time.monotonic() * 1000) & (_TICKS_PERIOD - 1)
+
+
+def _ticks_us():
+    return int(time.monotonic() * 1000000) & (_TICKS_PERIOD - 1)
+
+
+def _ticks_diff(a, b):
+    return ((a - b + _TICKS_PERIOD // 2) & (_TICKS_PERIOD - 1)) - _TICKS_PERIOD // 2
+
+
+def _ticks_add(a, b):
+    return (a + b) & (_TICKS_PERIOD - 1)
+
+
+class ThreadSafeFlag:
+    """uasyncio.ThreadSafeFlag: an auto-clearing event, set from anywhere."""
+
+    def __init__(self):
+        self._flag = False
+        self._event = None
+
+    def set(self):
+        self._flag = True
+        if self._event is not None:
+            self._event.set()
+
+    def clear(self):
+        self._flag = False
+        if self._event is not None:
+            self._event.clear()
+
+    async def wait(self):
+        if self._event is None:
+            self._event = asyncio.Event()
+        if self._flag:
+            self._event.set()
+        await self._event.wait()
+        self.clear()
+
+
+async def _sleep_ms(ms):
+    await asyncio.sleep(ms / 1000)
+
+
+async def _wait_for_ms(aw, ms):
+    return await asyncio.wait_for(aw, ms / 1000)
+
+
+async def _readinto(self, buf):
+    data = await self.read(len(buf))
+    buf[:len(data)] = data
+    return len(data)
+
+
+class FakeUart:
+    """machine.UART with an injectable receive buffer and a transmit counter."""
+
+    def __init__(self):
+        self.rx = bytearray()
+        self.tx_bytes = 0
+        self.on_write = None
+        self._readable = None
+
+    def inject(self, data):
+        self.rx += data
+        if self._readable is not None:
+            self._readable.set()
+
+    def any(self):
+        return len(self.rx)
+
+    def readinto(self, buf):
+        n = min(len(buf), len(self.rx))
+        if not n:
+            return None
+        buf[:n] = self.rx[:n]
+        del self.rx[:n]
+        return n
+
+    def write(self, data):
+        self.tx_bytes += len(data)
+        if self.on_write:
+            self.on_write(bytes(data))
+        return len(data)
+
+    async def wait_readable(self):
+        if self._readable is None:
+            self._readable = asyncio.Event()
+        while not self.rx:
+            self._readable.clear()
+            await self._readable.wait()
+
+
+class _DeviceStream:
+    """uasyncio.StreamReader/StreamWriter wrapped around a FakeUart."""
+
+    def __init__(self, device, extra=None):
+        self.device = device
+
+    async def readinto(self, buf):
+        while True:
+            n = self.device.readinto(buf)
+            if n:
+                return n
+            await self.device.wait_readable()
+
+    def write(self, data):
+        self.device.write(data)
+
+    async def drain(self):
+        await asyncio.sleep(0)
+
+
+def _make_uasyncio():
+    module = types.ModuleType("uasyncio")
+    for name in dir(asyncio):
+        if not name.startswith("_"):
+            setattr(module, name, getattr(asyncio, name))
+    module.sleep_ms = _sleep_ms
+    module.wait_for_ms = _wait_for_ms
+    module.ThreadSafeFlag = ThreadSafeFlag
+    # MicroPython builds streams around any object with readinto/write
+    module.StreamReader = _DeviceStream
+    module.StreamWriter = _DeviceStream
+    asyncio.StreamReader.readinto = _readinto
+    return module
+
+
+def _make_micropython():
+    module = types.ModuleType("micropython")
+    module.const = lambda value: value
+    module.native = lambda f: f
+    module.viper = lambda f: f
+    module.mem_info = lambda *args: None
+    module.alloc_emergency_exception_buf = lambda size: None
+    return module
+
+
+def _make_uctypes():
+    module = types.ModuleType("uctypes")
+    # Only what the app uses: a byte view aliasing an array's storage
+    module.addressof = lambda obj: obj.buffer_info()[0]
+    module.bytearray_at = lambda address, size: memoryview((ctypes.c_ubyte * size).from_address(address))
+    return module
+
+
+def _make_machine(uart):
+    module = types.ModuleType("machine")
+
+    class Pin:
+        IN = 0
+        OUT = 1
+        PULL_UP = 1
+        IRQ_FALLING = 2
+
+        def __init__(self, *args, **kwargs):
+            self._value = 0
+
+        def value(self, *args):
+            if args:
+                self._value = args[0]
+            return self._value
+
+        def on(self):
+            self._value = 1
+
+        def off(self):
+            self._value = 0
+
+        def irq(self, *args, **kwargs):
+            pass
+
+    class RTC:
+        def datetime(self, *args):
+            return None
+
+    module.Pin = Pin
+    module.RTC = RTC
+    module.UART = lambda *args, **kwargs: uart
+    module.unique_id = lambda: b"\xe6\x61\x41\x04\x03\x2b\x5c\x2a"
+    module.reset = lambda: None
+    return module
+
+
+def _make_network():
+    module = types.ModuleType("network")
+    module.STA_IF = 0
+
+    class WLAN:
+        def __init__(self, interface):
+            self._connected = False
+
+        def active(self, *args):
+            return True
+
+        def connect(self, ssid, password):
+            self._connected = True
+
+        def isconnected(self):
+            return self._connected
+
+        def ifconfig(self):
+            return ("127.0.0.1", "255.0.0.0", "127.0.0.1", "127.0.0.1")
+
+    module.WLAN = WLAN
+    return module
+
+
+def _make_aioble(sensors):
+    module = types.ModuleType("aioble")
+
+    class Device:
+        def __init__(self, addr_type, addr):
+            self.addr_type = addr_type
+            self.addr = bytes(addr)
+
+        async def connect(self, timeout_ms=None):
+            for sensor in sensors:
+                if sensor.addr == self.addr:
+                    return await sensor.connect()
+            await asyncio.sleep(timeout_ms / 1000 if timeout_ms else 0)
+            raise asyncio.TimeoutError
+
+        def __repr__(self):
+            return "Device(%d, %s)" % (self.addr_type, self.addr.hex(":"))
+
+    class ScanResult:
+        def __init__(self, sensor):
+            self.device = Device(0, sensor.addr)
+            name = ("Movesense " + sensor.serial).encode()
+            self.adv_data = b"\x02\x01\x06"
+            self.resp_data = bytes([len(name) + 1, 0x09]) + name
+
+    class scan:
+        def __init__(self, duration_ms, **kwargs):
+            self.duration_ms = duration_ms
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *args):
+            return False
+
+        async def _results(self):
+            for sensor in sensors:
+                await asyncio.sleep(0.01)
+                yield ScanResult(sensor)
+
+        def __aiter__(self):
+            return self._results()
+
+    module.Device = Device
+    module.scan = scan
+    return module
+
+
+def _make_password(mqtt_port, ntrip_port):
+    module = types.ModuleType("password")
+    module.WIFI_SSID = "sim"
+    module.WIFI_PASSWORD = "sim"
+    module.MQTT_CONFIG = {"server": "127.0.0.1", "port": mqtt_port, "username": None,
+                          "password": None, "ssl_params": {}}
+    module.NTRIP_CONFIG = {"host": "127.0.0.1", "port": ntrip_port, "mountpoint": "SIM",
+                           "username_ntrip": "sim", "password_ntrip": "sim"}
+    return module
+
+
+class Shims:
+    """Handles to the fakes that a simulation drives."""
+
+    def __init__(self, uart, sensors):
+        self.uart = uart
+        self.sensors = sensors
+
+
+def install(app_dir, data_dir, mqtt_port, ntrip_port, sensors=()):
+    """Register the fake modules and patch config.py paths. Returns Shims.
+
+    sensors is a list that may still be filled in afterwards; the fake
+    aioble looks sensors up on every scan and connect.
+    """
+    sensors = sensors if isinstance(sensors, list) else list(sensors)
+    uart = FakeUart()
+    time.ticks_ms = _ticks_ms
+    time.ticks_us = _ticks_us
+    time.ticks_diff = _ticks_diff
+    time.ticks_add = _ticks_add
+    time.sleep_ms = lambda ms: time.sleep(ms / 1000)
+    # The Pico's 192 KiB heap, reported as all free
+    gc.mem_free = lambda: 196608
+    gc.mem_alloc = lambda: 0
+    gc.threshold = lambda *args: -1
+    sys.modules.update({
+        "micropython": _make_micropython(),
+        "uctypes": _make_uctypes(),
+        "uasyncio": _make_uasyncio(),
+        "machine": _make_machine(uart),
+        "bluetooth": types.SimpleNamespace(UUID=lambda value: value),
+        "network": _make_network(),
+        "aioble": _make_aioble(sensors),
+        "usocket": socket,
+        "ubinascii": binascii,
+        "uselect": select,
+        "password": _make_password(mqtt_port, ntrip_port),
+    })
+    if app_dir not in sys.path:
+        sys.path.insert(0, app_dir)
+    os.makedirs(data_dir, exist_ok=True)
+    import config
+    config.SPOOL_DIR = os.path.join(data_dir, "spool")
+    config.BLE_CACHE_PATH = os.path.join(data_dir, "ble_cache.json")
+    return Shims(uart, sensors)
+
+
+def unload_app(app_dir):
+    """Forget every imported picoW-app module so the next run starts from a clean state."""
+    app_dir = os.path.abspath(app_dir)
+    for name, module in list(sys.modules.items()):
+        path = getattr(module, "__file__", None)
+        if path and os.path.dirname(os.path.abspath(path)) == app_dir:
+            del sys.modules[name]
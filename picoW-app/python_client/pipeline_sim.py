@@ -0,0 +1,484 @@
+# -*- coding: utf-8 -*-
+"""
+Run the real picoW-app pipeline on CPython against simulated peripherals.
+
+Simulated Movesense sensors answer subscribe commands over a fake aioble
+link and stream IMU9/ECG/HR notifications at the requested rates,
+including the DATA/DATA_PART2 split of large packets. A fake Bynav
+receiver writes GGA/RMC/ZDA to the GNSS UART, a fake NTRIP caster streams
+RTCM3 frames and a minimal MQTT broker records every message it gets.
+MovesenseDevice, the queues, the GNSS/NTRIP tasks and the publisher are
+the unmodified app modules (see mp_shims.py). imu_mode runs them in one
+of the IMU stream modes of config.IMU_STREAM_MODE; IMU loss is then
+measured against the samples that mode is meant to publish.
+
+Usage:
+
+    python pipeline_sim.py [seconds]
+
+benchmark.py runs this across sensor rates and prints a report.
+"""
+
+import asyncio
+import contextlib
+import io
+import math
+import os
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import mp_shims
+from decode_frames import decode_payload
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PICO_ID = "e6614104032b5c2a"
+METRICS_TOPIC = "sensors/metrics"
+
+_CMD_SUBSCRIBE = 1
+_CMD_UNSUBSCRIBE = 2
+_PACKET_DATA = 2
+_PACKET_DATA_PART2 = 3
+_DATA_PART1_SIZE = 152
+_BLE_QUEUE_SIZE = 64
+
+# Samples per notification, as the sensor firmware packs them
+_IMU_SAMPLES_PER_PACKET = 8
+_ECG_SAMPLES_PER_PACKET = 16
+
+
+def nmea(body):
+    checksum = 0
+    for byte in body.encode():
+        checksum ^= byte
+    return ("$%s*%02X\r\n" % (body, checksum)).encode()
+
+
+def _crc24q(data):
+    crc = 0
+    for byte in data:
+        crc ^= byte << 16
+        for _ in range(8):
+            crc <<= 1
+            if crc & 0x1000000:
+                crc ^= 0x1864CFB
+    return crc & 0xFFFFFF
+
+
+def rtcm_frame(msg_type, payload_len, tow_ms=0):
+    """An RTCM3 frame with a valid CRC; MSM types carry tow_ms as their epoch."""
+    payload = bytearray(max(payload_len, 8))
+    payload[0] = msg_type >> 4
+    payload[1] = (msg_type & 0x0F) << 4
+    struct.pack_into(">I", payload, 3, (tow_ms & 0x3FFFFFFF) << 2)
+    frame = bytes([0xD3, len(payload) >> 8, len(payload) & 0xFF]) + payload
+    crc = _crc24q(frame)
+    return frame + bytes([crc >> 16, (crc >> 8) & 0xFF, crc & 0xFF])
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class _SimLink:
+    """Connection, service and both GSP characteristics of one simulated sensor."""
+
+    def __init__(self, sensor):
+        self.sensor = sensor
+
+    def is_connected(self):
+        return self.sensor.connected
+
+    async def service(self, uuid):
+        return self
+
+    async def characteristic(self, uuid):
+        return self
+
+    async def subscribe(self, notify=True):
+        pass
+
+    async def write(self, data, response=False):
+        self.sensor.command(bytes(data))
+
+    async def notified(self, timeout_ms=None):
+        if not self.sensor.connected:
+            raise OSError("Disconnected")
+        timeout = timeout_ms / 1000 if timeout_ms else None
+        return await asyncio.wait_for(self.sensor.notifications.get(), timeout)
+
+    async def disconnect(self):
+        self.sensor.disconnect()
+
+
+class SimSensor:
+    """A Movesense sensor streaming synthetic data when subscribed.
+
+    The sensor clock advances at the nominal rate; speedup only shortens the
+    wall-clock interval between notifications. sent_at maps
+    (stream, sensor timestamp) to the perf_counter() time the notification
+    was produced, for end-to-end latency.
+    """
+
+    def __init__(self, serial, index, speedup=1.0):
+        self.serial = serial
+        self.addr = bytes([0x0C, 0x8C, 0xDC, 0x00, 0x00, index])
+        self.speedup = speedup
+        self.connected = False
+        self.notifications = asyncio.Queue(_BLE_QUEUE_SIZE)
+        self.tasks = {}
+        self.running = True
+        self.sensor_ms0 = 10000 * (index + 1)
+        self.sent_at = {}
+        self.generated = {"imu": 0, "ecg": 0, "hr": 0}
+        self.ble_overflows = 0
+
+    async def connect(self):
+        self.connected = True
+        return _SimLink(self)
+
+    def disconnect(self):
+        self.connected = False
+        for task in self.tasks.values():
+            task.cancel()
+        self.tasks = {}
+
+    def stop(self):
+        self.running = False
+
+    def command(self, cmd):
+        ref = cmd[1]
+        if cmd[0] == _CMD_UNSUBSCRIBE:
+            task = self.tasks.pop(ref, None)
+            if task:
+                task.cancel()
+            return
+        if cmd[0] != _CMD_SUBSCRIBE:
+            return
+        path = cmd[2:].decode().split("/")
+        if path[1].startswith("IMU"):
+            sensors = 3 if path[1] == "IMU9" else 2
+            coro = self._stream(ref, "imu", int(path[2]), _IMU_SAMPLES_PER_PACKET, sensors)
+        elif path[1] == "ECG":
+            coro = self._stream(ref, "ecg", int(path[2]), _ECG_SAMPLES_PER_PACKET, 0)
+        else:
+            coro = self._stream(ref, "hr", 1, 1, 0)
+        self.tasks[ref] = asyncio.create_task(coro)
+
+    def _notify(self, packet):
+        try:
+            self.notifications.put_nowait(packet)
+        except asyncio.QueueFull:
+            self.ble_overflows += 1
+
+    def _packet(self, ref, kind, timestamp, k, samples, sensors):
+        if kind == "hr":
+            return struct.pack("<BBfH", _PACKET_DATA, ref, 60 + 10 * math.sin(k / 10), 900)
+        header = struct.pack("<BBI", _PACKET_DATA, ref, timestamp)
+        if kind == "ecg":
+            values = [int(1000 * math.sin((k * samples + i) / 20)) for i in range(samples)]
+            return header + struct.pack("<%di" % samples, *values)
+        values = [math.sin((k * samples + i) / 10) for i in range(samples * 3 * sensors)]
+        return header + struct.pack("<%df" % len(values), *values)
+
+    async def _stream(self, ref, kind, rate, samples, sensors):
+        loop = asyncio.get_running_loop()
+        interval = samples / rate / self.speedup
+        start = loop.time()
+        k = 0
+        while self.running and self.connected:
+            timestamp = self.sensor_ms0 + int(k * samples * 1000 / rate)
+            packet = self._packet(ref, kind, timestamp, k, samples, sensors)
+            self.sent_at[(kind, self.serial, timestamp)] = time.perf_counter()
+            self.generated[kind] += samples
+            if len(packet) > _DATA_PART1_SIZE:
+                self._notify(packet[:_DATA_PART1_SIZE])
+                self._notify(bytes([_PACKET_DATA_PART2, ref]) + packet[_DATA_PART1_SIZE:])
+            else:
+                self._notify(packet)
+            k += 1
+            await asyncio.sleep(max(0, start + k * interval - loop.time()))
+
+
+class SimGnss:
+    """Bynav receiver writing RTK-fixed GGA, RMC and ZDA to the UART at rate_hz."""
+
+    def __init__(self, uart, rate_hz=1):
+        self.uart = uart
+        self.rate_hz = rate_hz
+        self.epochs = 0
+
+    async def run(self):
+        while True:
+            now = time.time()
+            t = time.gmtime(now)
+            hhmmss = "%02d%02d%05.2f" % (t.tm_hour, t.tm_min, t.tm_sec + now % 1)
+            lat = "6010.%07d" % (1234567 + self.epochs)
+            self.uart.inject(
+                nmea(f"GNGGA,{hhmmss},{lat},N,02458.7654321,E,4,18,0.6,21.5,M,18.1,M,1.0,0000")
+                + nmea(f"GNRMC,{hhmmss},A,{lat},N,02458.7654321,E,0.02,0.0,"
+                       f"{t.tm_mday:02d}{t.tm_mon:02d}{t.tm_year % 100:02d},,,R")
+                + nmea(f"GNZDA,{hhmmss},{t.tm_mday:02d},{t.tm_mon:02d},{t.tm_year},00,00"))
+            self.epochs += 1
+            await asyncio.sleep(1 / self.rate_hz)
+
+
+class SimCaster:
+    """NTRIP caster answering any mountpoint with an RTCM3 stream."""
+
+    # (message type, payload bytes, period in seconds)
+    MESSAGES = ((1074, 180, 1), (1084, 140, 1), (1094, 160, 1), (1005, 19, 10), (1230, 8, 5))
+
+    def __init__(self):
+        self.bytes_sent = 0
+        self.sessions = 0
+
+    async def _handle(self, reader, writer):
+        self.sessions += 1
+        try:
+            while (await reader.readline()) not in (b"\r\n", b""):
+                pass
+            writer.write(b"ICY 200 OK\r\n")
+            tick = 0
+            while True:
+                tow_ms = int((time.time() + 18) * 1000) % (7 * 86400000)
+                for msg_type, size, period in self.MESSAGES:
+                    if tick % period == 0:
+                        frame = rtcm_frame(msg_type, size, tow_ms)
+                        writer.write(frame)
+                        self.bytes_sent += len(frame)
+                await writer.drain()
+                tick += 1
+                await asyncio.sleep(1)
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        writer.close()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+
+class SimBroker:
+    """MQTT 3.1.1 broker accepting CONNECT/PUBLISH/PINGREQ and acking QoS 1.
+
+    Messages are stored with their arrival time and decoded after the run,
+    so decoding doesn't compete with the pipeline for CPU.
+    """
+
+    def __init__(self):
+        self.messages = []
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                header = (await reader.readexactly(1))[0]
+                length = 0
+                shift = 0
+                while True:
+                    byte = (await reader.readexactly(1))[0]
+                    length |= (byte & 0x7F) << shift
+                    shift += 7
+                    if not byte & 0x80:
+                        break
+                body = await reader.readexactly(length) if length else b""
+                packet_type = header & 0xF0
+                if packet_type == 0x10:
+                    writer.write(b"\x20\x02\x00\x00")
+                elif packet_type == 0x30:
+                    qos = (header >> 1) & 3
+                    topic_len = struct.unpack_from("!H", body)[0]
+                    offset = 2 + topic_len
+                    if qos:
+                        writer.write(b"\x40\x02" + body[offset:offset + 2])
+                        offset += 2
+                    self.messages.append((body[2:2 + topic_len].decode(), body[offset:], time.perf_counter()))
+                elif packet_type == 0xC0:
+                    writer.write(b"\xd0\x00")
+                elif packet_type == 0xE0:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        writer.close()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+
+def _record_kind(record):
+    if "stream" in record:
+        return record["stream"]
+    if "ArrayAcc" in record:
+        return "imu"
+    if "Samples" in record:
+        return "ecg"
+    if "rrData" in record:
+        return "hr"
+    if "Acc_rms" in record:
+        return "features"
+    return "gnss"
+
+
+def _record_samples(kind, record):
+    if kind == "imu":
+        return len(record["ArrayAcc"])
+    if kind == "ecg":
+        return len(record["Samples"])
+    return 1
+
+
+def _collect(broker, sims, series_list):
+    """Decode everything the broker got into per-stream sample counts and latencies."""
+    sent_at = {}
+    for sim in sims:
+        sent_at.update(sim.sent_at)
+    streams = {kind: {"delivered": 0, "records": 0, "latencies_ms": []}
+               for kind in ("imu", "ecg", "hr", "gnss", "features")}
+    for topic, payload, received in broker.messages:
+        if topic == METRICS_TOPIC:
+            continue
+        for record in decode_payload(payload, series_list):
+            kind = _record_kind(record)
+            stats = streams[kind]
+            stats["records"] += 1
+            stats["delivered"] += _record_samples(kind, record)
+            series = record.get("device") or record.get("Movesense_series")
+            produced = sent_at.get((kind, series, record.get("Timestamp_ms")))
+            if produced is not None:
+                stats["latencies_ms"].append((received - produced) * 1000)
+    return streams
+
+
+async def run_pipeline(duration_s=5.0, imu_rate=26, ecg_rate=125, sensors=2, speedup=1.0,
+                       gnss_rate=1, measure_alloc=False, verbose=False, imu_mode="raw"):
+    """Run the pipeline for duration_s of sensor streaming and return a stats dict."""
+    broker = SimBroker()
+    caster = SimCaster()
+    mqtt_port = await broker.start()
+    ntrip_port = await caster.start()
+    data_dir = tempfile.mkdtemp(prefix="picow-sim-")
+    sims = []
+    mp_shims.unload_app(APP_DIR)
+    shims = mp_shims.install(APP_DIR, data_dir, mqtt_port, ntrip_port, sims)
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        import config
+        config.IMU_STREAM_MODE = imu_mode
+        import data_queue
+        import mem_manager
+        import movesense_controller
+        import mqtt
+        import rate_control
+        import startup
+
+        series_list = config.MOVESENSE_SERIES_LIST[:sensors]
+        sims.extend(SimSensor(serial, i, speedup) for i, serial in enumerate(series_list))
+        movesense_controller._MOVESENSE_SERIES_LIST = series_list
+        movesense_controller.IMU_RATE = imu_rate
+        movesense_controller.ECG_RATE = ecg_rate
+        data_queue.state.running_state = True
+        mem_manager.memory.setup()
+        mqtt_client = mqtt.create_mqtt_client()
+        gnss = SimGnss(shims.uart, gnss_rate)
+        tasks = [asyncio.create_task(coro) for coro in (
+            startup.bring_up_network(),
+            movesense_controller.movesense_tasks(PICO_ID),
+            startup.bring_up_gnss(PICO_ID),
+            mqtt.publish_to_mqtt(mqtt_client),
+            mqtt.replay_spool(mqtt_client),
+            mem_manager.memory.run(),
+            gnss.run(),
+        )]
+        if config.RATE_CONTROL_ENABLED:
+            tasks.append(asyncio.create_task(rate_control.control_rates()))
+
+        # Measure from the first notification on, not from boot
+        while not any(sim.sent_at for sim in sims):
+            await asyncio.sleep(0.01)
+        if measure_alloc:
+            tracemalloc.start()
+            heap_start = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        await asyncio.sleep(duration_s)
+        for sim in sims:
+            sim.stop()
+        elapsed = time.perf_counter() - started
+        # Let the last batches age out and get acked
+        await asyncio.sleep(config.MQTT_BATCH_MAX_AGE_MS / 1000 + 1)
+        if measure_alloc:
+            heap_end, heap_peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await mqtt_client.disconnect()
+
+    streams = _collect(broker, sims, config.MOVESENSE_SERIES_LIST)
+    records = 0
+    for kind, stats in streams.items():
+        if kind == "gnss":
+            generated = gnss.epochs
+        elif kind == "features":
+            generated = sum(ms.features.windows for ms in movesense_controller._devices.values() if ms.features)
+        else:
+            generated = sum(sim.generated.get(kind, 0) for sim in sims)
+        if kind == "imu" and imu_mode == "hybrid":
+            generated //= config.IMU_DECIMATION
+        elif kind == "imu" and imu_mode == "summary":
+            generated = 0
+        latencies = stats.pop("latencies_ms")
+        stats["generated"] = generated
+        stats["samples_per_s"] = stats["delivered"] / elapsed
+        stats["loss_pct"] = 100 * max(0, generated - stats["delivered"]) / generated if generated else 0
+        stats["p50_ms"] = percentile(latencies, 0.50)
+        stats["p95_ms"] = percentile(latencies, 0.95)
+        stats["p99_ms"] = percentile(latencies, 0.99)
+        records += stats["records"]
+    result = {
+        "imu_mode": imu_mode,
+        "imu_rate": imu_rate,
+        "ecg_rate": ecg_rate,
+        "sensors": sensors,
+        "speedup": speedup,
+        "elapsed_s": elapsed,
+        "streams": streams,
+        "drops": {
+            "ble_overflows": sum(sim.ble_overflows for sim in sims),
+            "imu_queue": data_queue.imu_queue.drops,
+            "ecg_queue": data_queue.ecg_queue.drops,
+            "hr_queue": data_queue.hr_queue.drops,
+            "gnss_queue": data_queue.gnss_queue.drops,
+            "imu_pool_misses": data_queue.imu_pool.misses,
+            "ecg_pool_misses": data_queue.ecg_pool.misses,
+            "spooled": mqtt._spool.written,
+        },
+        "rtcm": {"caster_bytes": caster.bytes_sent, "uart_bytes": shims.uart.tx_bytes},
+        "mqtt_messages": len(broker.messages),
+        "mqtt_bytes_per_s": sum(len(payload) for topic, payload, _ in broker.messages
+                                if topic != METRICS_TOPIC) / elapsed,
+    }
+    if config.TELEMETRY_ENABLED:
+        import telemetry
+        result["telemetry"] = telemetry.summary()
+    if measure_alloc:
+        # CPython heap, a regression signal rather than the Pico's numbers
+        result["alloc"] = {
+            "heap_growth_bytes_per_record": (heap_end - heap_start) / records if records else 0,
+            "peak_heap_kib": (heap_peak - heap_start) / 1024,
+        }
+    broker.server.close()
+    caster.server.close()
+    return result
+
+
+if __name__ == "__main__":
+    import json
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5.0
+    print(json.dumps(asyncio.run(run_pipeline(seconds, verbose=True)), indent=2))
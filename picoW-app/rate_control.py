@@ -0,0 +1,155 @@
+import uasyncio as asyncio
+
+import movesense_controller
+from movesense_controller import IMU_RATES, ECG_RATES
+from config import (RATE_CHECK_INTERVAL_MS, RATE_HIGH_FILL_PCT, RATE_LOW_FILL_PCT, RATE_HIGH_LATENCY_PCT,
+                    RATE_UP_CHECKS, RATE_UP_CHECKS_MAX, MEM_CRITICAL_BYTES, TELEMETRY_ENABLED)
+from data_queue import imu_queue, ecg_queue, imu_pool, ecg_pool
+from mem_manager import memory, NORMAL
+from mqtt import stream_schedule
+
+CONGESTED = -1
+HOLD = 0
+CALM = 1
+
+
+def ladder_index(rates, rate):
+    """Index of the highest supported rate not above rate."""
+    index = 0
+    for i, candidate in enumerate(rates):
+        if candidate <= rate:
+            index = i
+    return index
+
+
+class RateController:
+    """Trade IMU/ECG resolution for continuity when the pipeline falls behind.
+
+    Every RATE_CHECK_INTERVAL_MS the IMU and ECG queues, their drop and
+    expiry counters, their publish latency and the heap are assessed. A
+    congested check steps one rung down the rate ladders, IMU before ECG,
+    since IMU is also what the publisher degrades first. Stepping back up
+    goes ECG first, one rung per RATE_UP_CHECKS calm checks in a row. If a
+    step up is followed by congestion before the next one, the link can't
+    carry that rate yet and the calm checks needed are doubled, up to
+    RATE_UP_CHECKS_MAX, until a full calm period at the ceilings resets it.
+    """
+    def __init__(self, imu_rate, ecg_rate):
+        self.imu_ceiling = ladder_index(IMU_RATES, imu_rate)
+        self.ecg_ceiling = ladder_index(ECG_RATES, ecg_rate)
+        self.imu_index = self.imu_ceiling
+        self.ecg_index = self.ecg_ceiling
+        self.calm_checks = 0
+        self.up_checks = RATE_UP_CHECKS
+        self.stepped_up = False
+        self.last_losses = self._losses()
+        self.step_downs = 0
+        self.step_ups = 0
+        self.last_reason = None
+
+    @staticmethod
+    def _losses():
+        losses = imu_queue.drops + ecg_queue.drops + imu_pool.misses + ecg_pool.misses
+        for name in ("imu", "ecg"):
+            schedule = stream_schedule(name)
+            losses += schedule.dropped + schedule.spooled
+        return losses
+
+    def assess(self):
+        """CONGESTED, HOLD or CALM; the reason for congestion is kept in last_reason."""
+        fill_pct = 0
+        for queue in (imu_queue, ecg_queue):
+            fill_pct = max(fill_pct, queue.get_length() * 100 // queue.max_len)
+        latency_pct = 0
+        for name in ("imu", "ecg"):
+            schedule = stream_schedule(name)
+            latency_pct = max(latency_pct, schedule.latency_avg_ms * 100 // schedule.deadline_ms)
+        losses = self._losses()
+        new_losses = losses - self.last_losses
+        self.last_losses = losses
+        if new_losses:
+            self.last_reason = f"{new_losses} records lost"
+        elif fill_pct >= RATE_HIGH_FILL_PCT:
+            self.last_reason = f"queues {fill_pct}% full"
+        elif latency_pct >= RATE_HIGH_LATENCY_PCT:
+            self.last_reason = f"latency at {latency_pct}% of deadline"
+        elif memory.free_after_gc and memory.free_after_gc < MEM_CRITICAL_BYTES:
+            self.last_reason = "heap critical"
+        else:
+            if fill_pct <= RATE_LOW_FILL_PCT and latency_pct < RATE_HIGH_LATENCY_PCT // 2 and memory.level == NORMAL:
+                return CALM
+            return HOLD
+        return CONGESTED
+
+    def rates(self):
+        return IMU_RATES[self.imu_index], ECG_RATES[self.ecg_index]
+
+    def step_down(self):
+        """Lower one rate by a rung. Returns False if both are at the bottom."""
+        self.calm_checks = 0
+        if self.stepped_up:
+            self.up_checks = min(self.up_checks * 2, RATE_UP_CHECKS_MAX)
+        self.stepped_up = False
+        if self.imu_index > 0:
+            self.imu_index -= 1
+        elif self.ecg_index > 0:
+            self.ecg_index -= 1
+        else:
+            return False
+        self.step_downs += 1
+        return True
+
+    def step_up(self):
+        """Raise one rate by a rung after enough calm checks. Returns True if a rate changed."""
+        self.calm_checks += 1
+        if self.calm_checks < self.up_checks:
+            return False
+        self.calm_checks = 0
+        if self.ecg_index < self.ecg_ceiling:
+            self.ecg_index += 1
+        elif self.imu_index < self.imu_ceiling:
+            self.imu_index += 1
+        else:
+            # A full calm period at the ceilings: back to the normal pace
+            self.up_checks = RATE_UP_CHECKS
+            self.stepped_up = False
+            return False
+        self.stepped_up = True
+        self.step_ups += 1
+        return True
+
+    def update(self):
+        """Assess the pipeline and move along the ladders. Returns True if the rates changed."""
+        verdict = self.assess()
+        if verdict == CONGESTED:
+            return self.step_down()
+        if verdict == CALM:
+            return self.step_up()
+        # Neither calm nor congested: a step up so far hasn't hurt
+        self.calm_checks = 0
+        return False
+
+    async def run(self):
+        """Task: apply the controller's rates to every streaming sensor."""
+        while True:
+            await asyncio.sleep_ms(RATE_CHECK_INTERVAL_MS)
+            before = self.rates()
+            if not self.update():
+                continue
+            imu_rate, ecg_rate = self.rates()
+            if imu_rate < before[0] or ecg_rate < before[1]:
+                print(f"Rate control: {self.last_reason}, lowering to IMU {imu_rate} Hz, ECG {ecg_rate} Hz")
+            else:
+                print(f"Rate control: link recovered, raising to IMU {imu_rate} Hz, ECG {ecg_rate} Hz")
+            await movesense_controller.set_rates(imu_rate, ecg_rate)
+
+
+async def control_rates():
+    """Task: run a RateController with the configured rates as ceilings."""
+    controller = RateController(movesense_controller.IMU_RATE, movesense_controller.ECG_RATE)
+    if TELEMETRY_ENABLED:
+        import telemetry
+        telemetry.gauge("imu_rate", lambda: IMU_RATES[controller.imu_index])
+        telemetry.gauge("ecg_rate", lambda: ECG_RATES[controller.ecg_index])
+        telemetry.gauge("rate_step_downs", lambda: controller.step_downs)
+    await controller.run()
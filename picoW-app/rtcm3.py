@@ -0,0 +1,165 @@
+import time
+import micropython
+from array import array
+from micropython import const
+
+# RTCM 3 frame: 0xD3 | 6 reserved bits + 10-bit length | payload | CRC-24Q
+# The message type is the first 12 bits of the payload.
+_PREAMBLE = const(0xD3)
+_HEADER_SIZE = const(3)
+_CRC_SIZE = const(3)
+_MAX_FRAME = const(1029)
+_CRC24Q_POLY = const(0x1864CFB)
+
+# GPS TOW is GPS time, UTC is behind it by the leap seconds
+_GPS_LEAP_MS = const(18000)
+_DAY_MS = const(86400000)
+
+
+def _crc24q_table():
+    table = array("I", [0] * 256)
+    for i in range(256):
+        crc = i << 16
+        for _ in range(8):
+            crc <<= 1
+            if crc & 0x1000000:
+                crc ^= _CRC24Q_POLY
+        table[i] = crc & 0xFFFFFF
+    return table
+
+
+_CRC_TABLE = _crc24q_table()
+
+
+@micropython.native
+def crc24q(data, n):
+    table = _CRC_TABLE
+    crc = 0
+    for i in range(n):
+        crc = ((crc << 8) & 0xFFFFFF) ^ table[(crc >> 16) ^ data[i]]
+    return crc
+
+
+class Rtcm3Framer:
+    """Split an NTRIP byte stream into CRC-checked RTCM 3 frames.
+
+    feed() copies bytes into a frame buffer and calls handler(frame) with a
+    memoryview of every valid frame whose type isn't in drop_types. Bytes
+    outside a frame are discarded and counted. A frame failing CRC-24Q is
+    counted and hunting resumes one byte past its preamble, so a real frame
+    hidden behind a false preamble isn't lost. The view is only valid
+    during the callback.
+    """
+    def __init__(self, handler, drop_types=()):
+        self.handler = handler
+        self.drop_types = drop_types
+        self.buf = bytearray(_MAX_FRAME)
+        self.view = memoryview(self.buf)
+        self.pos = 0
+        self.frame_len = 0
+        self.rejected = 0
+        self.frames = 0
+        self.crc_errors = 0
+        self.filtered = 0
+        self.skipped_bytes = 0
+        self.type_counts = {}
+        self.window_counts = {}
+        self.window_start_ms = time.ticks_ms()
+        self.last_frame_ms = None
+        self.gps_epoch_ms = None
+
+    def reset(self):
+        """Drop any partial frame, e.g. when the stream restarts."""
+        self.pos = 0
+
+    def feed(self, data, n=-1):
+        """Consume n bytes from data (all of it by default)."""
+        if n < 0:
+            n = len(data)
+        data = memoryview(data)
+        i = self._consume(data, 0, n)
+        while self.rejected:
+            # A false preamble or a frame failing CRC: the bytes after its
+            # preamble may hold the real frame start, so hunt again from
+            # there. Only this error path copies.
+            retry = bytes(self.view[1:self.rejected]) + bytes(data[i:n])
+            self.rejected = 0
+            self.skipped_bytes += 1
+            data = memoryview(retry)
+            n = len(retry)
+            i = self._consume(data, 0, n)
+
+    def _consume(self, data, i, n):
+        """Frame data[i:n]. Returns where it stopped, early with the bad frame's length in rejected."""
+        buf = self.buf
+        while i < n:
+            pos = self.pos
+            if pos == 0:
+                # Hunt for the preamble, only while out of sync
+                if data[i] != _PREAMBLE:
+                    self.skipped_bytes += 1
+                    i += 1
+                    continue
+            if pos < _HEADER_SIZE:
+                buf[pos] = data[i]
+                self.pos = pos + 1
+                i += 1
+                if self.pos == _HEADER_SIZE:
+                    if buf[1] & 0xFC:
+                        # Reserved bits set: a false preamble
+                        self.pos = 0
+                        self.rejected = _HEADER_SIZE
+                        return i
+                    self.frame_len = _HEADER_SIZE + (((buf[1] & 0x03) << 8) | buf[2]) + _CRC_SIZE
+                continue
+            take = min(self.frame_len - pos, n - i)
+            buf[pos:pos + take] = data[i:i + take]
+            self.pos = pos + take
+            i += take
+            if self.pos == self.frame_len:
+                self.pos = 0
+                if not self._frame(self.frame_len):
+                    self.crc_errors += 1
+                    self.rejected = self.frame_len
+                    return i
+        return i
+
+    def _frame(self, length):
+        """Check and dispatch the frame in buf[:length]. Returns False if its CRC is wrong."""
+        buf = self.buf
+        body = length - _CRC_SIZE
+        crc = (buf[body] << 16) | (buf[body + 1] << 8) | buf[body + 2]
+        if crc24q(buf, body) != crc:
+            return False
+        self.frames += 1
+        self.last_frame_ms = time.ticks_ms()
+        msg_type = (buf[3] << 4) | (buf[4] >> 4) if length > _HEADER_SIZE + _CRC_SIZE + 1 else 0
+        self.type_counts[msg_type] = self.type_counts.get(msg_type, 0) + 1
+        self.window_counts[msg_type] = self.window_counts.get(msg_type, 0) + 1
+        if 1071 <= msg_type <= 1077 and length >= _HEADER_SIZE + 7 + _CRC_SIZE:
+            # GPS MSM: type 12 bits, station id 12 bits, then 30-bit TOW in ms
+            tow = (((buf[6] << 24) | (buf[7] << 16) | (buf[8] << 8) | buf[9]) >> 2) & 0x3FFFFFFF
+            self.gps_epoch_ms = (tow - _GPS_LEAP_MS) % _DAY_MS
+        if msg_type in self.drop_types:
+            self.filtered += 1
+            return True
+        self.handler(self.view[:length])
+        return True
+
+    def correction_age_ms(self, utc_ms_of_day):
+        """Age of the last GPS MSM epoch against receiver UTC ms of day, or None."""
+        if self.gps_epoch_ms is None or utc_ms_of_day < 0:
+            return None
+        return (utc_ms_of_day - self.gps_epoch_ms) % _DAY_MS
+
+    def rates(self, now_ms):
+        """Frames per second by message type since the last call."""
+        elapsed = time.ticks_diff(now_ms, self.window_start_ms)
+        if elapsed <= 0:
+            return {}
+        rates = {}
+        for msg_type, count in self.window_counts.items():
+            rates[msg_type] = round(count * 1000 / elapsed, 2)
+        self.window_counts = {}
+        self.window_start_ms = now_ms
+        return rates
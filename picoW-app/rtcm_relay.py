@@ -0,0 +1,109 @@
+import time
+import uasyncio as asyncio
+from micropython import const
+
+from config import RTCM_CONGESTION_DROP_TYPES, RTCM_CONGESTED_PCT, RTCM_CLEAR_PCT
+from rtcm3 import Rtcm3Framer
+
+_CHUNK_SIZE = const(512)
+_STATS_INTERVAL_MS = const(30000)
+# A UART drain slower than this means corrections arrive faster than the
+# UART can take them
+_STALL_MS = const(20)
+
+
+class RtcmRelay:
+    """Forward NTRIP correction bytes to the GNSS UART as soon as they arrive.
+
+    Both ends are uasyncio streams, so the task sleeps until the caster
+    stream has data and while the UART drains; nothing is polled. Bytes are read into
+    one reused buffer and framed by Rtcm3Framer, so only CRC-valid frames
+    not in drop_types reach the UART. bytes_per_s (from the caster),
+    forwarded_per_s (to the UART) and uart_load_pct, from the forwarded
+    bytes, are updated about once a second, and stalls counts drains that took longer than _STALL_MS. While the UART is congested, RTCM_CONGESTION_DROP_TYPES
+    are dropped on top of drop_types. utc_ms_of_day, if given, returns the
+    receiver's current UTC time for the correction age.
+    """
+    def __init__(self, rtk_uart, baud_rate, drop_types=(), utc_ms_of_day=None):
+        self.sink = asyncio.StreamWriter(rtk_uart, {})
+        self.buffer = bytearray(_CHUNK_SIZE)
+        self.framer = Rtcm3Framer(self._forward, drop_types)
+        self.drop_types = drop_types
+        self.congested_drop_types = tuple(drop_types) + RTCM_CONGESTION_DROP_TYPES
+        self.congested = False
+        self.congestions = 0
+        self.utc_ms_of_day = utc_ms_of_day
+        # 8N1: ten bit times per byte
+        self.uart_bytes_per_s = baud_rate // 10
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.stalls = 0
+        self.max_drain_ms = 0
+        self.bytes_per_s = 0
+        self.forwarded_per_s = 0
+        self.uart_load_pct = 0
+        self.window_bytes = 0
+        self.window_out = 0
+        self.window_start_ms = time.ticks_ms()
+        self.last_log_ms = self.window_start_ms
+
+    def _forward(self, frame):
+        self.sink.write(frame)
+        self.bytes_out += len(frame)
+        self.window_out += len(frame)
+
+    def _update_congestion(self):
+        """Throttle non-essential message types while the UART can't keep up."""
+        if not self.congested and self.uart_load_pct >= RTCM_CONGESTED_PCT:
+            self.congested = True
+            self.congestions += 1
+            self.framer.drop_types = self.congested_drop_types
+            print(f"RTCM relay: UART load {self.uart_load_pct}%, dropping {RTCM_CONGESTION_DROP_TYPES}")
+        elif self.congested and self.uart_load_pct < RTCM_CLEAR_PCT:
+            self.congested = False
+            self.framer.drop_types = self.drop_types
+            print(f"RTCM relay: UART load {self.uart_load_pct}%, forwarding all types again")
+
+    def _account(self, n, drain_ms, now):
+        self.bytes_in += n
+        self.window_bytes += n
+        if drain_ms > self.max_drain_ms:
+            self.max_drain_ms = drain_ms
+        if drain_ms >= _STALL_MS:
+            self.stalls += 1
+        elapsed = time.ticks_diff(now, self.window_start_ms)
+        if elapsed >= 1000:
+            self.bytes_per_s = self.window_bytes * 1000 // elapsed
+            self.forwarded_per_s = self.window_out * 1000 // elapsed
+            self.uart_load_pct = self.forwarded_per_s * 100 // self.uart_bytes_per_s
+            self.window_bytes = 0
+            self.window_out = 0
+            self.window_start_ms = now
+            self._update_congestion()
+        if time.ticks_diff(now, self.last_log_ms) >= _STATS_INTERVAL_MS:
+            self.last_log_ms = now
+            framer = self.framer
+            age = framer.correction_age_ms(self.utc_ms_of_day()) if self.utc_ms_of_day else None
+            print(f"RTCM relay: {self.bytes_per_s} B/s in, {self.forwarded_per_s} B/s out, UART load {self.uart_load_pct}%, "
+                  f"{self.stalls} stalls, max drain {self.max_drain_ms} ms, "
+                  f"{framer.crc_errors} CRC errors, {framer.filtered} filtered, correction age {age} ms")
+            print(f"RTCM message rates (1/s): {framer.rates(now)}")
+
+    async def run(self, source, idle_timeout_ms):
+        """Relay from the source stream until it closes.
+
+        Socket errors propagate, and asyncio.TimeoutError is raised if no
+        data arrives for idle_timeout_ms.
+        """
+        self.framer.reset()
+        while True:
+            n = await asyncio.wait_for_ms(source.readinto(self.buffer), idle_timeout_ms)
+            if not n:
+                print("No RTK correction data")
+                return
+            start = time.ticks_ms()
+            # Valid frames are handed to the UART writer from inside feed()
+            self.framer.feed(self.buffer, n)
+            await self.sink.drain()
+            now = time.ticks_ms()
+            self._account(n, time.ticks_diff(now, start), now)
@@ -0,0 +1,100 @@
+import uctypes
+from array import array
+from micropython import const
+
+from imu_quant import SCALES
+
+# Largest notification after DATA/DATA_PART2 reassembly is 308 bytes:
+# 2 byte header + 4 byte timestamp + up to 302 bytes of 4 byte samples
+MAX_SAMPLE_VALUES = const(75)
+
+IMU_AXES = const(3)
+
+
+class SampleBlock:
+    """Columnar record for one Movesense notification.
+
+    IMU values are stored like the notification: all acc xyz triplets, then
+    gyro, then magn, as floats or, in an "h" pool, as int16 quantized by
+    imu_quant.py. ECG values are the raw int32 samples. raw is a byte view
+    of the same storage, for copying values without unpacking them.
+    """
+    def __init__(self, pool, typecode):
+        self.pool = pool
+        self.values = array(typecode, [0] * MAX_SAMPLE_VALUES)
+        self.quantized = typecode == "h"
+        item_size = 2 if self.quantized else 4
+        self.raw = memoryview(uctypes.bytearray_at(uctypes.addressof(self.values), MAX_SAMPLE_VALUES * item_size))
+        self.count = 0
+        self.sensors = 0
+        self.ms_series = None
+        self.picoW_id = None
+        self.timestamp_ms = 0
+        self.timestamp_utc_ms = 0
+
+    def release(self):
+        self.pool.release(self)
+
+    def imu_dict(self):
+        """Expand an IMU block into the original JSON record layout."""
+        values = self.values
+        n = self.count
+        arrays = []
+        for sensor in range(3):
+            axis = []
+            if sensor < self.sensors:
+                scale = SCALES[sensor] if self.quantized else 1
+                for i in range(sensor * n * IMU_AXES, (sensor + 1) * n * IMU_AXES, IMU_AXES):
+                    axis.append({"x": round(values[i] * scale, 3), "y": round(values[i + 1] * scale, 3),
+                                 "z": round(values[i + 2] * scale, 3)})
+            arrays.append(axis)
+        return {
+            "Movesense_series": self.ms_series,
+            "Pico_ID": self.picoW_id,
+            "Timestamp_UTC": self.timestamp_utc_ms // 1000,
+            "Timestamp_UTC_ms": self.timestamp_utc_ms,
+            "Timestamp_ms": self.timestamp_ms,
+            "ArrayAcc": arrays[0],
+            "ArrayGyro": arrays[1],
+            "ArrayMagn": arrays[2],
+        }
+
+    def ecg_dict(self):
+        return {
+            "Movesense_series": self.ms_series,
+            "Pico_ID": self.picoW_id,
+            "Timestamp_UTC": self.timestamp_utc_ms // 1000,
+            "Timestamp_UTC_ms": self.timestamp_utc_ms,
+            "Timestamp_ms": self.timestamp_ms,
+            "Samples": list(self.values[:self.count]),
+        }
+
+
+class BlockPool:
+    """Fixed set of SampleBlocks allocated once at boot.
+
+    Blocks are handed out from a preallocated stack, so acquire/release
+    never resize a list. When the pool is empty acquire returns None and
+    the caller drops the notification.
+    """
+    def __init__(self, size, typecode):
+        self.stack = [SampleBlock(self, typecode) for _ in range(size)]
+        self.free = size
+        self.misses = 0
+
+    def acquire(self):
+        if self.free == 0:
+            self.misses += 1
+            return None
+        self.free -= 1
+        return self.stack[self.free]
+
+    def release(self, block):
+        self.stack[self.free] = block
+        self.free += 1
+
+
+def release_record(record):
+    """Return a queued record to its pool once it has been consumed or dropped."""
+    if isinstance(record, SampleBlock):
+        record.release()
@@ -0,0 +1,159 @@
+import os
+import struct
+import binascii
+from micropython import const
+
+# Segment file: header (magic, segment seq) followed by records.
+# Record: topic index u8 | length u16 | crc32 u32 | payload
+# A segment is only ever appended to, so after a power cut the worst case is
+# a torn last record, which fails its length or CRC check and ends the segment.
+_SEGMENT_MAGIC = b"SPL1"
+_SEGMENT_HEADER = "<4sI"
+_SEGMENT_HEADER_SIZE = const(8)
+_RECORD_HEADER = "<BHI"
+_RECORD_HEADER_SIZE = const(7)
+
+
+class Spool:
+    """Append-only segmented store for MQTT payloads on the flash filesystem.
+
+    Records are written to the newest segment and read back from the oldest.
+    When the total size goes over max_bytes, the oldest segment is deleted.
+    """
+    def __init__(self, directory, segment_bytes, max_bytes, max_record):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.record_buf = bytearray(max_record)
+        self.record_view = memoryview(self.record_buf)
+        self.write_header = bytearray(_RECORD_HEADER_SIZE)
+        self.read_header = bytearray(_RECORD_HEADER_SIZE)
+        self.peeked = 0
+        self.writer = None
+        self.write_seq = None
+        self.write_size = 0
+        self.reader = None
+        self.read_seq = None
+        self.read_offset = 0
+        self.evicted = 0
+        self.rejected = 0
+        self.written = 0
+        self.replayed = 0
+        try:
+            os.mkdir(directory)
+        except OSError:
+            pass
+        self.segments = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith(".seg"))
+        self.total_bytes = sum(self._size(seq) for seq in self.segments)
+        self.next_seq = self.segments[-1] + 1 if self.segments else 0
+
+    def _path(self, seq):
+        return "%s/%08d.seg" % (self.directory, seq)
+
+    def _size(self, seq):
+        try:
+            return os.stat(self._path(seq))[6]
+        except OSError:
+            return 0
+
+    def is_empty(self):
+        return not self.segments
+
+    def _open_segment(self):
+        seq = self.next_seq
+        self.next_seq += 1
+        self.writer = open(self._path(seq), "wb")
+        self.writer.write(struct.pack(_SEGMENT_HEADER, _SEGMENT_MAGIC, seq))
+        self.writer.flush()
+        self.segments.append(seq)
+        self.write_seq = seq
+        self.write_size = _SEGMENT_HEADER_SIZE
+        self.total_bytes += _SEGMENT_HEADER_SIZE
+
+    def _close_writer(self):
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+            self.write_seq = None
+
+    def _remove_segment(self, seq):
+        if seq == self.read_seq:
+            self.reader.close()
+            self.reader = None
+            self.read_seq = None
+        if seq == self.write_seq:
+            self._close_writer()
+        self.total_bytes -= self._size(seq)
+        self.segments.remove(seq)
+        try:
+            os.remove(self._path(seq))
+        except OSError:
+            pass
+
+    def append(self, topic_index, payload):
+        """Store one payload. Evicts the oldest segments to stay within max_bytes.
+
+        Returns False, and counts it in rejected, if the payload doesn't fit
+        record_buf and so could never be replayed.
+        """
+        n = len(payload)
+        if n > len(self.record_buf):
+            self.rejected += 1
+            return False
+        if self.writer is None or self.write_size + _RECORD_HEADER_SIZE + n > self.segment_bytes:
+            self._close_writer()
+            self._open_segment()
+        crc = binascii.crc32(payload)
+        struct.pack_into(_RECORD_HEADER, self.write_header, 0, topic_index, n, crc)
+        self.writer.write(self.write_header)
+        self.writer.write(payload)
+        self.writer.flush()
+        self.write_size += _RECORD_HEADER_SIZE + n
+        self.total_bytes += _RECORD_HEADER_SIZE + n
+        self.written += 1
+        while self.total_bytes > self.max_bytes and len(self.segments) > 1:
+            self._remove_segment(self.segments[0])
+            self.evicted += 1
+        return True
+
+    def _open_reader(self):
+        seq = self.segments[0]
+        if seq == self.write_seq:
+            # Never read the segment that is still being appended to
+            self._close_writer()
+        self.reader = open(self._path(seq), "rb")
+        header = self.reader.read(_SEGMENT_HEADER_SIZE)
+        if len(header) != _SEGMENT_HEADER_SIZE or struct.unpack(_SEGMENT_HEADER, header) != (_SEGMENT_MAGIC, seq):
+            self.reader.close()
+            self.reader = None
+            return False
+        self.read_seq = seq
+        self.read_offset = _SEGMENT_HEADER_SIZE
+        return True
+
+    def peek(self):
+        """Return (topic_index, payload) of the oldest record, or None.
+
+        The payload is a view into a reused buffer. Call consume() once it
+        has been published to move on to the next record.
+        """
+        while self.segments:
+            if self.reader is None and not self._open_reader():
+                self._remove_segment(self.segments[0])
+                continue
+            self.reader.seek(self.read_offset)
+            if self.reader.readinto(self.read_header) == _RECORD_HEADER_SIZE:
+                topic_index, n, crc = struct.unpack(_RECORD_HEADER, self.read_header)
+                if n <= len(self.record_buf):
+                    payload = self.record_view[:n]
+                    if self.reader.readinto(payload) == n and binascii.crc32(payload) == crc:
+                        self.peeked = _RECORD_HEADER_SIZE + n
+                        return topic_index, payload
+            # End of segment or a torn record
+            self._remove_segment(self.read_seq)
+        return None
+
+    def consume(self):
+        self.read_offset += self.peeked
+        self.peeked = 0
+        self.replayed += 1
@@ -0,0 +1,60 @@
+import time
+import uasyncio as asyncio
+
+from wifi_connection import connect_wifi
+from mqtt import connect_mqtt, keep_mqtt_connected
+from bynav_GNSS import gnss_setup, gnss_task
+from data_queue import imu_queue, ecg_queue, hr_queue, gnss_queue, wait_signal
+
+_boot_ms = time.ticks_ms()
+
+_WIFI_RETRY_MIN_MS = 1000
+_WIFI_RETRY_MAX_MS = 30000
+# Stop waiting for streams that never produce data, e.g. GNSS indoors
+_FIRST_SAMPLE_TIMEOUT_MS = 600000
+
+wifi_ready = asyncio.Event()
+
+
+def since_boot_ms(ticks=None):
+    return time.ticks_diff(time.ticks_ms() if ticks is None else ticks, _boot_ms)
+
+
+def mark(stage):
+    print(f"Startup: {stage} after {since_boot_ms()} ms")
+
+
+async def bring_up_network():
+    """Task: Wi-Fi, then MQTT, then keep the broker connection alive."""
+    delay = _WIFI_RETRY_MIN_MS
+    while not await connect_wifi():
+        await asyncio.sleep_ms(delay)
+        delay = min(delay * 2, _WIFI_RETRY_MAX_MS)
+    mark("Wi-Fi ready")
+    wifi_ready.set()
+    mqtt_client = await connect_mqtt()
+    if mqtt_client.is_connected():
+        mark("MQTT ready")
+    await keep_mqtt_connected(mqtt_client)
+
+
+async def bring_up_gnss(picoW_id):
+    """Task: wait for a GNSS fix, then attach NTRIP corrections once Wi-Fi is up."""
+    ntrip, rtk_uart, gga = await gnss_setup()
+    mark("GNSS fix")
+    await wifi_ready.wait()
+    await gnss_task(ntrip, rtk_uart, picoW_id)
+
+
+async def report_first_sample(name, queue):
+    """Log the time from boot to the queue's first sample, sleeping until it's pushed."""
+    if await wait_signal(queue.started, max(0, _FIRST_SAMPLE_TIMEOUT_MS - since_boot_ms())):
+        print(f"Startup: first {name} sample after {since_boot_ms(queue.first_push_ms)} ms")
+    else:
+        print(f"Startup: no {name} sample yet")
+
+
+async def report_first_samples():
+    """Task: log the time from boot to the first sample of every stream."""
+    await asyncio.gather(report_first_sample("IMU", imu_queue), report_first_sample("ECG", ecg_queue),
+                         report_first_sample("HR", hr_queue), report_first_sample("GNSS", gnss_queue))
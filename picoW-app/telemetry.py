@@ -0,0 +1,130 @@
+import gc
+import time
+from array import array
+from micropython import const
+
+# Only imported when config.TELEMETRY_ENABLED is set; every call site is
+# guarded by that flag, so with it off nothing here is loaded or run.
+
+# Histogram bucket i holds values below 2**i, the last one everything larger
+_BUCKETS = const(20)
+
+_counters = {}
+_histograms = {}
+_gauges = {}
+_last_ms = time.ticks_ms()
+
+
+class Counter:
+    """Monotonic count; the summary reports the total and the rate since the last summary."""
+    def __init__(self):
+        self.value = 0
+        self.reported = 0
+
+    def add(self, n=1):
+        self.value += n
+
+
+class Histogram:
+    """Distribution of small non-negative ints in power-of-two buckets.
+
+    add() is a few integer operations and never allocates. Percentiles are
+    the upper bound of the bucket they fall in, so they are within a factor
+    of two; count, mean and max are exact. The histogram restarts after
+    every summary.
+    """
+    def __init__(self):
+        self.buckets = array("I", [0] * _BUCKETS)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        if value < 0:
+            value = 0
+        i = 0
+        v = value
+        while v and i < _BUCKETS - 1:
+            v >>= 1
+            i += 1
+        self.buckets[i] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, pct):
+        if not self.count:
+            return None
+        rank = (self.count * pct + 99) // 100
+        seen = 0
+        for i in range(_BUCKETS):
+            seen += self.buckets[i]
+            if seen >= rank:
+                return min((1 << i) - 1, self.max)
+        return self.max
+
+    def reset(self):
+        for i in range(_BUCKETS):
+            self.buckets[i] = 0
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+
+def counter(name):
+    """The counter registered under name, created on first use."""
+    metric = _counters.get(name)
+    if metric is None:
+        metric = _counters[name] = Counter()
+    return metric
+
+
+def histogram(name):
+    """The histogram registered under name, created on first use."""
+    metric = _histograms.get(name)
+    if metric is None:
+        metric = _histograms[name] = Histogram()
+    return metric
+
+
+def gauge(name, read):
+    """Report read() under name in every summary. A later registration replaces it."""
+    _gauges[name] = read
+
+
+def summary():
+    """Snapshot of every metric as a JSON-ready dict; rates and histograms restart."""
+    global _last_ms
+    now = time.ticks_ms()
+    elapsed = max(1, time.ticks_diff(now, _last_ms))
+    _last_ms = now
+    counters = {}
+    rates = {}
+    for name, metric in _counters.items():
+        counters[name] = metric.value
+        rates[name] = (metric.value - metric.reported) * 1000 // elapsed
+        metric.reported = metric.value
+    histograms = {}
+    for name, metric in _histograms.items():
+        if metric.count:
+            histograms[name] = {
+                "n": metric.count,
+                "mean": metric.total // metric.count,
+                "p50": metric.percentile(50),
+                "p95": metric.percentile(95),
+                "max": metric.max,
+            }
+        metric.reset()
+    gauges = {}
+    for name, read in _gauges.items():
+        gauges[name] = read()
+    return {
+        "interval_ms": elapsed,
+        "mem_free": gc.mem_free(),
+        "mem_alloc": gc.mem_alloc(),
+        "counters": counters,
+        "rates_per_s": rates,
+        "histograms": histograms,
+        "gauges": gauges,
+    }
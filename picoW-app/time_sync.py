@@ -0,0 +1,194 @@
+import time
+from micropython import const
+
+_DAY_MS = const(86400000)
+_TICKS_PERIOD = const(0x40000000)
+_TICKS_HALF = const(0x20000000)
+
+# GNSS time further than this from the clock is a step, not jitter
+_STEP_MS = const(500)
+# A sensor offset this much later than predicted for _SENSOR_RESYNC_COUNT
+# notifications in a row means the sensor restarted, not a delivery hiccup
+_SENSOR_RESYNC_MS = const(2000)
+_SENSOR_RESYNC_COUNT = const(5)
+# Sensor time over which the lowest-latency offset is taken for drift
+_DRIFT_WINDOW_MS = const(10000)
+
+
+def days_from_civil(year, month, day):
+    """Days since 1970-01-01 of a proleptic Gregorian date."""
+    if month <= 2:
+        year -= 1
+    era = year // 400
+    yoe = year - era * 400
+    doy = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+
+def _wrap(value):
+    """Fold a ticks-domain value into [-2**29, 2**29)."""
+    return ((value + _TICKS_HALF) & (_TICKS_PERIOD - 1)) - _TICKS_HALF
+
+
+class UtcClock:
+    """UTC in milliseconds, kept on the Pico's ticks_ms and disciplined by GNSS.
+
+    The clock is an anchor pair (UTC ms, ticks_ms). Every ZDA/RMC moves the
+    anchor: small errors are smoothed, large ones are stepped. Until the
+    first GNSS time arrives the RTC is used, at one second resolution.
+    """
+    def __init__(self):
+        self.synced = False
+        self.syncs = 0
+        self.steps = 0
+        self.last_error_ms = 0
+        self.anchor_ticks = time.ticks_ms()
+        self.anchor_utc_ms = self._rtc_ms()
+
+    @staticmethod
+    def _rtc_ms():
+        # Ports with a 2000 epoch are shifted to the Unix epoch
+        epoch_shift = 946684800 if time.gmtime(0)[0] == 2000 else 0
+        return (int(time.time()) + epoch_shift) * 1000
+
+    def utc_at_ticks(self, ticks):
+        return self.anchor_utc_ms + time.ticks_diff(ticks, self.anchor_ticks)
+
+    def now_ms(self):
+        return self.utc_at_ticks(time.ticks_ms())
+
+    def set_from_gnss(self, year, month, day, ms_of_day, ticks=None):
+        """Discipline the clock with a GNSS date and time received at ticks."""
+        if ticks is None:
+            ticks = time.ticks_ms()
+        if year < 2020 or not 1 <= month <= 12 or not 1 <= day <= 31 or ms_of_day < 0:
+            return
+        days = days_from_civil(year, month, day)
+        gnss_ms = days * _DAY_MS + ms_of_day
+        error = gnss_ms - self.utc_at_ticks(ticks)
+        self.last_error_ms = error
+        self.syncs += 1
+        if not self.synced or error > _STEP_MS or error < -_STEP_MS:
+            if self.synced:
+                self.steps += 1
+            self.anchor_utc_ms = gnss_ms
+            self._set_rtc(year, month, day, ms_of_day, days)
+            self.synced = True
+        else:
+            # UART read jitter is averaged out over a few fixes
+            self.anchor_utc_ms = gnss_ms - error + error // 4
+        self.anchor_ticks = ticks
+
+    @staticmethod
+    def _set_rtc(year, month, day, ms_of_day, days):
+        try:
+            import machine
+            seconds = ms_of_day // 1000
+            # 1970-01-01 was a Thursday, RTC weekdays start from Monday = 0
+            machine.RTC().datetime((year, month, day, (days + 3) % 7,
+                                    seconds // 3600, seconds // 60 % 60, seconds % 60, 0))
+        except (ImportError, OSError, AttributeError):
+            pass
+
+    def utc_from_ms_of_day(self, ms_of_day):
+        """Full UTC ms for a GNSS time of day, taking the date from the clock."""
+        now = self.now_ms()
+        day_start = now - now % _DAY_MS
+        utc = day_start + ms_of_day
+        # A fix from just before midnight processed just after it
+        if utc - now > _DAY_MS // 2:
+            utc -= _DAY_MS
+        elif now - utc > _DAY_MS // 2:
+            utc += _DAY_MS
+        return utc
+
+
+utc_clock = UtcClock()
+
+
+class SensorClock:
+    """Map a Movesense ms counter to UTC via the Pico's ticks_ms.
+
+    BLE delivery only ever adds latency, so the smallest seen offset between
+    arrival ticks and sensor ms is the best estimate of the true offset.
+    The lowest offset of each _DRIFT_WINDOW_MS window of sensor time gives
+    one point; the slope between windows is the drift, smoothed as an
+    integer ppm value. Everything stays in small ints until the final UTC
+    addition.
+    """
+    def __init__(self, clock=utc_clock):
+        self.clock = clock
+        self.resyncs = 0
+        self.reset()
+
+    def reset(self):
+        self.base_offset = None
+        self.base_sensor_ms = 0
+        self.late = 0
+        self.windows = 0
+        self.drift_ppm = 0
+        self.window_start = 0
+        self.window_min = 0
+        self.window_sensor_ms = 0
+        self.prev_min = None
+        self.prev_sensor_ms = 0
+
+    def _start(self, offset, sensor_ms):
+        self.base_offset = offset
+        self.base_sensor_ms = sensor_ms
+        self.window_start = sensor_ms
+        self.window_min = offset
+        self.window_sensor_ms = sensor_ms
+
+    def predict(self, sensor_ms):
+        return self.base_offset + self.drift_ppm * (sensor_ms - self.base_sensor_ms) // 1000000
+
+    def to_utc_ms(self, sensor_ms, arrival_ticks=None):
+        """UTC ms of a sensor timestamp, updating the offset and drift estimate."""
+        if arrival_ticks is None:
+            arrival_ticks = time.ticks_ms()
+        sensor_ticks = sensor_ms & (_TICKS_PERIOD - 1)
+        observed = _wrap(arrival_ticks - sensor_ticks)
+        if self.base_offset is None:
+            self._start(observed, sensor_ms)
+        offset = self.predict(sensor_ms)
+        error = _wrap(observed - offset)
+        if error > _SENSOR_RESYNC_MS:
+            self.late += 1
+            if self.late >= _SENSOR_RESYNC_COUNT:
+                self.resyncs += 1
+                self.reset()
+                self._start(observed, sensor_ms)
+                offset = observed
+        elif error < 0:
+            # Faster delivery than predicted: the estimate was too late
+            offset = observed
+            self.base_offset = observed
+            self.base_sensor_ms = sensor_ms
+        if error <= _SENSOR_RESYNC_MS:
+            self.late = 0
+        if _wrap(observed - self.window_min) < 0:
+            self.window_min = observed
+            self.window_sensor_ms = sensor_ms
+        if sensor_ms - self.window_start >= _DRIFT_WINDOW_MS:
+            self._close_window(sensor_ms)
+        return self.clock.utc_at_ticks((sensor_ticks + offset) & (_TICKS_PERIOD - 1))
+
+    def _close_window(self, sensor_ms):
+        if self.prev_min is not None:
+            elapsed = self.window_sensor_ms - self.prev_sensor_ms
+            if elapsed > 0:
+                slope = _wrap(self.window_min - self.prev_min) * 1000000 // elapsed
+                if self.windows == 1:
+                    self.drift_ppm = slope
+                else:
+                    self.drift_ppm += (slope - self.drift_ppm) // 4
+        self.windows += 1
+        self.prev_min = self.window_min
+        self.prev_sensor_ms = self.window_sensor_ms
+        self.base_offset = self.window_min
+        self.base_sensor_ms = self.window_sensor_ms
+        self.window_start = sensor_ms
+        # Any offset seen in the next window replaces this
+        self.window_min = self.predict(sensor_ms) + _SENSOR_RESYNC_MS
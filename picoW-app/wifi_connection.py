@@ -18,4 +18,5 @@ async def connect_wifi(ssid=WIFI_SSID, password=WIFI_PASSWORD):
         print(f"Connecting wifi...")
         await asyncio.sleep(1)
     if wlan.isconnected():
-        print("Connected to Wifi: ", wlan.ifconfig())
\ No newline at end of file
+        print("Connected to Wifi: ", wlan.ifconfig())
+    return wlan.isconnected()